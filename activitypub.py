@@ -1,5 +1,6 @@
 """ActivityPub protocol implementation."""
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import datetime
 from hashlib import sha256
@@ -7,9 +8,12 @@ import itertools
 import logging
 import os
 import re
+from threading import BoundedSemaphore, Lock
+import time
 from urllib.parse import quote_plus, urljoin, urlparse
 from unittest.mock import MagicMock
 
+import cachetools
 from flask import abort, g, redirect, request
 from google.cloud import ndb
 from google.cloud.ndb.query import FilterNode, OR, Query
@@ -62,6 +66,11 @@ CONNEG_HEADERS_AS2_HTML = {
 
 HTTP_SIG_HEADERS = ('Date', 'Host', 'Digest', '(request-target)')
 
+# for ActivityPub.send_batch
+SEND_BATCH_WORKERS = 20
+SEND_RETRIES = 2
+SEND_RETRY_DELAY_S = 1
+
 SECURITY_CONTEXT = 'https://w3id.org/security/v1'
 
 # https://www.w3.org/ns/activitystreams#did-core
@@ -71,6 +80,12 @@ AKA_CONTEXT = {'alsoKnownAs': {'@id': 'as:alsoKnownAs', '@type': '@id'}}
 # https://seb.jambor.dev/posts/understanding-activitypub-part-4-threads/#the-instance-actor
 _INSTANCE_ACTOR = None
 
+# verified public keys, maps keyId to (signing actor id, public key PEM,
+# deleted) tuple. deleted entries have key None. see ActivityPub.verify_signature
+PUBLIC_KEYS_CACHE_EXPIRATION = datetime.timedelta(hours=1)
+public_keys = cachetools.TTLCache(10000, PUBLIC_KEYS_CACHE_EXPIRATION.total_seconds())
+public_keys_lock = Lock()
+
 OLD_ACCOUNT_EXEMPT_DOMAINS = (
     'channel.org',
     'newsmast.community',
@@ -129,6 +144,8 @@ class ActivityPub(User, Protocol):
     ''
     SEND_REPLIES_TO_ORIG_POSTS_MENTIONS = True
     'https://github.com/snarfed/bridgy-fed/issues/1608 , https://github.com/snarfed/bridgy-fed/issues/1218'
+    SEND_BATCH_SIZE = 100
+    'fan out to shared inboxes in batches, see :meth:`send_batch`'
 
     webfinger_addr = ndb.StringProperty()
     """Populated by :meth:`reload_profile`."""
@@ -324,6 +341,65 @@ class ActivityPub(User, Protocol):
 
         return signed_post(inbox_url, data=activity, from_user=from_user).ok
 
+    @classmethod
+    def send_batch(to_cls, obj, inbox_urls, from_user=None, orig_obj_id=None):
+        """Delivers an activity to multiple inbox URLs concurrently.
+
+        Converts and serializes the activity and prepares its HTTP Signature
+        once, then POSTs it to all of the inboxes in parallel. Retries each inbox
+        individually on connection failures, 5xx, and 429.
+
+        See :meth:`protocol.Protocol.send_batch` for details.
+        """
+        if not from_user:
+            logger.info('Skipping sending, no from_user!')
+            return {url: False for url in inbox_urls}
+
+        results = {}
+        for url in inbox_urls:
+            if to_cls.is_blocklisted(url):
+                logger.info(f'Skipping sending to blocklisted {url}')
+                results[url] = False
+
+        inbox_urls = [url for url in inbox_urls if url not in results]
+        if not inbox_urls:
+            return results
+
+        orig_obj = None
+        if orig_obj_id:
+            orig_obj = to_cls.convert(Object.get_by_id(orig_obj_id),
+                                      from_user=from_user)
+        activity = to_cls.convert(obj, from_user=from_user, orig_obj=orig_obj)
+        logger.debug(f'Sending AS2 object: {json_dumps(activity, indent=2)}')
+        data = json_dumps(activity).encode()
+
+        # prepare the signature here, not in the worker threads, since loading
+        # the user's key and id may need the datastore
+        auth = signature_auth(from_user)
+
+        def post(url):
+            for retry in range(SEND_RETRIES + 1):
+                if retry:
+                    time.sleep(SEND_RETRY_DELAY_S * retry)
+                try:
+                    resp = signed_post(url, data=data, from_user=from_user,
+                                       auth=auth, gateway=False)
+                    resp.raise_for_status()
+                    return True
+                except requests.RequestException as e:
+                    status = e.response.status_code if e.response is not None else None
+                    if retry < SEND_RETRIES and (status is None or status >= 500
+                                                 or status == 429):
+                        logger.info(f'Retrying {url} after {e}')
+                        continue
+                    logger.info(f'Failed sending to {url}: {e}')
+                    return e
+
+        with ThreadPoolExecutor(max_workers=SEND_BATCH_WORKERS) as executor:
+            results.update(zip(inbox_urls, executor.map(post, inbox_urls)))
+
+        return results
+
     @classmethod
     def fetch(cls, obj, **kwargs):
         """Tries to fetch an AS2 object.
@@ -668,6 +744,84 @@ class ActivityPub(User, Protocol):
         if digest.removeprefix('SHA-256=').removeprefix('sha-256=') != expected:
             error('Invalid Digest', status=401)
 
+        # can't use request.full_path because it includes a trailing ? even if
+        # it wasn't in the request. https://github.com/pallets/flask/issues/2867
+        path_query = request.url.removeprefix(request.host_url.rstrip('/'))
+
+        def verify(key):
+            logger.debug(f'Verifying signature for {path_query} with key {sig_fields["keyid"]}')
+            return HeaderVerifier(headers, key,
+                                  required_headers=['Digest'],
+                                  method=request.method,
+                                  path=path_query,
+                                  sign_header='signature',
+                                  ).verify()
+
+        verified = False
+        with public_keys_lock:
+            cached = public_keys.get(key_id)
+        if cached:
+            actor_id, key, deleted = cached
+            if deleted:
+                abort(202, f'Ignoring, signer {key_id} is already deleted')
+            try:
+                verified = verify(key)
+            except BaseException as e:
+                logger.info(f'sig verification with cached key failed: {e}')
+            if not verified:
+                # maybe they rotated their key. reload it and try again.
+                logger.info(f'Cached key for {key_id} failed, reloading')
+                with public_keys_lock:
+                    public_keys.pop(key_id, None)
+
+        if not verified:
+            actor_id, key = cls._load_public_key(key_id, activity)
+            try:
+                verified = verify(key)
+            except BaseException as e:
+                error(f'sig verification failed: {e}', status=401)
+
+        if not verified:
+            error('sig failed', status=401)
+
+        logger.debug('sig ok')
+        if (activity.get('type') in ('Delete', 'Update')
+                and as1.get_object(activity).get('id') in (actor_id, key_id)):
+            # they're updating or deleting their own profile, don't use any of
+            # their cached keys next time
+            cls.evict_public_keys(actor_id)
+        else:
+            with public_keys_lock:
+                public_keys[key_id] = actor_id, key, False
+
+        return actor_id
+
+    @staticmethod
+    def evict_public_keys(actor_id):
+        """Evicts all of an actor's keys from :attr:`public_keys`.
+
+        Args:
+          actor_id (str): signing actor id, ie the keys' owner
+        """
+        with public_keys_lock:
+            for key_id, (owner, _, _) in list(public_keys.items()):
+                if owner == actor_id:
+                    public_keys.pop(key_id, None)
+
+    @classmethod
+    def _load_public_key(cls, key_id, activity):
+        """Loads and extracts the public key for a given ``keyId``.
+
+        Raises :class:`werkzeug.exceptions.HTTPError` if the key can't be
+        loaded.
+
+        Args:
+          key_id (str): ``keyId`` from an HTTP Signature, without fragment
+          activity (dict): AS2 activity being verified
+
+        Returns:
+          (str, str) tuple: (signing actor id, public key PEM)
+        """
         try:
             key_actor = cls._load_key(key_id)
         except BadGateway:
@@ -682,6 +836,8 @@ class ActivityPub(User, Protocol):
                 raise
 
         if key_actor and key_actor.deleted:
+            with public_keys_lock:
+                public_keys[key_id] = key_actor.key.id(), None, True
             abort(202, f'Ignoring, signer {key_id} is already deleted')
         elif not key_actor or not key_actor.as1:
             error(f"Couldn't load {key_id} to verify signature", status=401)
@@ -691,26 +847,7 @@ class ActivityPub(User, Protocol):
         if not key:
             error(f'No public key for {key_id}', status=401)
 
-        # can't use request.full_path because it includes a trailing ? even if
-        # it wasn't in the request. https://github.com/pallets/flask/issues/2867
-        path_query = request.url.removeprefix(request.host_url.rstrip('/'))
-        logger.debug(f'Verifying signature for {path_query} with key {sig_fields["keyid"]}')
-        try:
-            verified = HeaderVerifier(headers, key,
-                                      required_headers=['Digest'],
-                                      method=request.method,
-                                      path=path_query,
-                                      sign_header='signature',
-                                      ).verify()
-        except BaseException as e:
-            error(f'sig verification failed: {e}', status=401)
-
-        if verified:
-            logger.debug('sig ok')
-        else:
-            error('sig failed', status=401)
-
-        return key_actor.key.id()
+        return key_actor.key.id(), key
 
     @classmethod
     def _load_key(cls, key_id, follow_owner=True):
@@ -753,13 +890,121 @@ class ActivityPub(User, Protocol):
         return actor
 
 
+class DeliveryClient:
+    """HTTP client for signed ActivityPub requests, pooled by host.
+
+    Keeps a session from :func:`util.make_session` for each host, so that
+    repeated requests to the same instance, eg mastodon.social, reuse
+    connections instead of paying for a DNS lookup and TLS handshake every
+    time. Also caps concurrent requests to each host, and records each host's
+    health with :func:`memcache.record_host_request`.
+
+    :meth:`get` and :meth:`post` go through :func:`util.requests_get` and
+    :func:`util.requests_post` with those sessions, so they keep webutil's SSRF
+    protection, cookie handling, response size limit, and ``gateway`` error
+    handling.
+    """
+    MAX_HOSTS = 1000
+    MAX_PER_HOST = 10
+
+    def __init__(self, new_session=None):
+        """Constructor.
+
+        Args:
+          new_session (callable): optional, returns a new session object with
+            ``get`` and ``post`` methods for a host. Defaults to
+            :func:`util.make_session`.
+        """
+        self.new_session = new_session or util.make_session
+        self.hosts = cachetools.LRUCache(self.MAX_HOSTS)  # host => (session, semaphore)
+        self.lock = Lock()
+
+    def _host(self, host):
+        with self.lock:
+            if not (entry := self.hosts.get(host)):
+                entry = self.hosts[host] = (self.new_session(),
+                                            BoundedSemaphore(self.MAX_PER_HOST))
+        return entry
+
+    def get(self, url, **kwargs):
+        return self._request(util.requests_get, url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._request(util.requests_post, url, **kwargs)
+
+    def _request(self, fn, url, **kwargs):
+        host = util.domain_from_link(url, minimize=False)
+        session, semaphore = self._host(host)
+
+        with semaphore:
+            start = time.perf_counter()
+            try:
+                resp = fn(url, session=session, **kwargs)
+                # read the body now so that the connection goes back to the
+                # pool. requests_fn has already replaced it if it was too big.
+                resp.content
+            except BaseException as e:
+                # with gateway=True, requests_fn converts request errors to HTTP
+                # exceptions, so look at the original
+                err = e if isinstance(e, requests.RequestException) else e.__context__
+                if isinstance(err, (requests.ConnectionError, requests.Timeout)):
+                    memcache.record_host_request(host, ok=False)
+                elif (isinstance(err, requests.HTTPError)
+                      and err.response is not None):
+                    memcache.record_host_request(
+                        host, ok=err.response.status_code not in range(500, 600),
+                        latency=time.perf_counter() - start)
+                raise
+
+        memcache.record_host_request(host, ok=resp.status_code not in range(500, 600),
+                                     latency=time.perf_counter() - start)
+        return resp
+
+
+delivery_client = DeliveryClient()
+
+
 def signed_get(url, from_user=None, **kwargs):
-    return signed_request(util.requests_get, url, from_user=from_user, **kwargs)
+    return signed_request(delivery_client.get, url, from_user=from_user, **kwargs)
 
 
 def signed_post(url, from_user, **kwargs):
     assert from_user
-    return signed_request(util.requests_post, url, from_user=from_user, **kwargs)
+    return signed_request(delivery_client.post, url, from_user=from_user, **kwargs)
+
+
+def signature_auth(from_user):
+    """Returns a requests auth object that adds a user's HTTP Signature.
+
+    Args:
+      from_user (models.User): user to sign requests as. If not provided, or
+        an :class:`ActivityPub` user, uses the instance actor.
+
+    Returns:
+      httpsig.requests_auth.HTTPSignatureAuth:
+    """
+    if not from_user or isinstance(from_user, ActivityPub):
+        # ActivityPub users are remote, so we don't have their keys
+        from_user = instance_actor()
+
+    # (request-target) is a special HTTP Signatures header that some fediverse
+    # implementations require, eg Peertube.
+    # https://datatracker.ietf.org/doc/html/draft-cavage-http-signatures-12#section-2.3
+    # https://www.w3.org/wiki/SocialCG/ActivityPub/Authentication_Authorization#Signing_requests_using_HTTP_Signatures
+    # https://docs.joinmastodon.org/spec/security/#http
+    key_id = f'{from_user.id_as(ActivityPub)}#key'
+    return _signature_auth(key_id, from_user)
+
+
+# constructing and parsing RSA private keys is expensive, so cache signers. the
+# cache key includes the key material, so rotating a user's key misses.
+@cachetools.cached(cachetools.LRUCache(10000),
+                   key=lambda key_id, user: (key_id, user.key, user.mod),
+                   lock=Lock())
+def _signature_auth(key_id, user):
+    return HTTPSignatureAuth(secret=user.private_pem(), key_id=key_id,
+                             algorithm='rsa-sha256', sign_header='signature',
+                             headers=HTTP_SIG_HEADERS)
 
 
 def signed_request(fn, url, data=None, headers=None, from_user=None,
@@ -769,13 +1014,15 @@ def signed_request(fn, url, data=None, headers=None, from_user=None,
     https://swicg.github.io/activitypub-http-signature/
 
     Args:
-      fn (callable): :func:`util.requests_get` or  :func:`util.requests_post`
+      fn (callable): :meth:`DeliveryClient.get` or :meth:`DeliveryClient.post`
       url (str):
-      data (dict): optional AS2 object
+      data (dict or bytes): optional AS2 object, or already serialized AS2 JSON
       from_user (models.User): user to sign request as; optional. If not
         provided, uses the default user ``@fed.brid.gy@fed.brid.gy``.
       _redirect_count: internal, used to count redirects followed so far
-      kwargs: passed through to requests
+      kwargs: passed through to requests. May include ``auth``, a
+        :class:`HTTPSignatureAuth` from :func:`signature_auth` for ``from_user``
+        to reuse across requests.
 
     Returns:
       requests.Response:
@@ -788,7 +1035,7 @@ def signed_request(fn, url, data=None, headers=None, from_user=None,
         # ActivityPub users are remote, so we don't have their keys
         from_user = instance_actor()
 
-    if data:
+    if data and not isinstance(data, bytes):
         logger.debug(f'Sending AS2 object: {json_dumps(data, indent=2)}')
         data = json_dumps(data).encode()
 
@@ -806,28 +1053,19 @@ def signed_request(fn, url, data=None, headers=None, from_user=None,
     }
 
     logger.debug(f"Signing with {from_user.key.id()} 's key")
-
-    # (request-target) is a special HTTP Signatures header that some fediverse
-    # implementations require, eg Peertube.
-    # https://datatracker.ietf.org/doc/html/draft-cavage-http-signatures-12#section-2.3
-    # https://www.w3.org/wiki/SocialCG/ActivityPub/Authentication_Authorization#Signing_requests_using_HTTP_Signatures
-    # https://docs.joinmastodon.org/spec/security/#http
-    key_id = f'{from_user.id_as(ActivityPub)}#key'
-    auth = HTTPSignatureAuth(secret=from_user.private_pem(), key_id=key_id,
-                             algorithm='rsa-sha256', sign_header='signature',
-                             headers=HTTP_SIG_HEADERS)
+    auth = kwargs.pop('auth', None) or signature_auth(from_user)
 
     # make HTTP request
     kwargs.setdefault('gateway', True)
     resp = fn(url, data=data, auth=auth, headers=headers, allow_redirects=False,
               **kwargs)
 
-    if fn == util.requests_get:
+    if fn == delivery_client.get:
         assert not isinstance(resp, MagicMock), \
             f'unit test missing a mock HTTP response for {url}'
 
     # handle GET redirects manually so that we generate a new HTTP signature
-    if resp.is_redirect and fn == util.requests_get:
+    if resp.is_redirect and fn == delivery_client.get:
         new_url = urljoin(url, resp.headers['Location'])
         if _redirect_count is None:
             _redirect_count = 0
@@ -835,7 +1073,7 @@ def signed_request(fn, url, data=None, headers=None, from_user=None,
             raise TooManyRedirects(response=resp)
 
         return signed_request(fn, new_url, data=data, from_user=from_user,
-                              headers=headers, _redirect_count=_redirect_count + 1,
+                              headers=headers, auth=auth, _redirect_count=_redirect_count + 1,
                               **kwargs)
 
     type = common.content_type(resp)
@@ -1398,13 +1636,14 @@ def follower_collection(id, collection):
         'first': page,
     }
 
-    # count total if it's small, <= 1k. we should eventually precompute this
-    # so that we can always return it cheaply.
-    prop = Follower.to if collection == 'followers' else Follower.from_
-    count = Follower.query(prop == user.key, Follower.status == 'active')\
-                    .count(limit=1001)
-    if count != 1001:
-        ret['totalItems'] = count
+    # precomputed by FollowerCounter. we don't count protocol bot users'
+    # followers, so leave their totals out. also leave it out if we don't know
+    # it yet, ie the counter isn't initialized and there are more than 1k.
+    if user.key.id() not in PROTOCOL_DOMAINS:
+        num_followers, num_following = user.count_followers()
+        count = num_followers if collection == 'followers' else num_following
+        if count is not None:
+            ret['totalItems'] = count
 
     logger.debug(f'Returning {json_dumps(collection, indent=2)}')
     return ret, {
@@ -2,11 +2,13 @@
 
 https://atproto.com/
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 import itertools
 import logging
 import os
 import re
+import time
 from urllib.parse import urlparse
 
 from arroba import did
@@ -53,15 +55,18 @@ import common
 from common import (
     CACHE_CONTROL,
     DOMAIN_RE,
+    DID_CHANGES_FEED,
     DOMAINS,
     error,
     FlashErrors,
+    NDB_CONTEXT_KWARGS,
     PRIMARY_DOMAIN,
     SUPERDOMAIN,
     USER_AGENT,
 )
 from flask_app import app
 import ids
+import memcache
 from models import Follower, Object, PROTOCOLS, Target, User
 from protocol import Protocol
 import web
@@ -84,6 +89,13 @@ COLLECTION_TO_TYPE = {
   'app.bsky.graph.follow': 'follow',
 }
 
+# ATProto._convert fetches blobs and link previews in parallel, in a thread
+# pool this big, and gives up on any that aren't done by the deadline.
+BLOB_FETCH_WORKERS = int(os.environ.get('BLOB_FETCH_WORKERS', 8))
+BLOB_FETCH_DEADLINE = timedelta(seconds=20)
+blob_executor = ThreadPoolExecutor(max_workers=BLOB_FETCH_WORKERS,
+                                   thread_name_prefix='fetch_blob')
+
 DNS_GCP_PROJECT = 'brid-gy'
 DNS_ZONE = 'brid-gy'
 DNS_TTL = 10800  # seconds
@@ -444,14 +456,18 @@ class ATProto(User, Protocol):
                 return
             elif repo.status == TOMBSTONED:
                 # tombstoned repos can't be reactivated, have to wipe and start fresh
-                user.copies = []
+                for copy in list(user.copies):
+                    user.remove('copies', copy)
                 if user.obj:
-                    user.obj.copies = []
+                    for copy in list(user.obj.copies):
+                        user.obj.remove('copies', copy)
                     user.obj.put()
                 # fall through to create new DID, repo
             else:
                 # deactivated or deleted
                 arroba.server.storage.activate_repo(repo)
+                memcache.append_to_feed(DID_CHANGES_FEED,
+                                        ('bridged', copy_did, True))
                 common.create_task(queue='atproto-commit')
                 if handle.endswith(SUPERDOMAIN):
                     cls.set_dns(handle=handle, did=copy_did)
@@ -506,6 +522,7 @@ class ATProto(User, Protocol):
             callback=lambda _: common.create_task(queue='atproto-commit'),
             signing_key=did_plc.signing_key, rotation_key=did_plc.rotation_key,
             initial_writes=initial_writes)
+        memcache.append_to_feed(DID_CHANGES_FEED, ('bridged', did_plc.did, True))
 
         # create user profile. can't include this in initial writes because
         # bluesky.to_as1 in convert fetches the pinned post, which with our
@@ -721,6 +738,7 @@ class ATProto(User, Protocol):
             if atp_base_id == did:
                 logger.info(f'Deactivating bridged ATProto account {did} !')
                 arroba.server.storage.deactivate_repo(repo)
+                memcache.append_to_feed(DID_CHANGES_FEED, ('bridged', did, False))
                 to_cls.remove_dns(user.handle_as('atproto'))
                 return True
 
@@ -907,19 +925,42 @@ class ATProto(User, Protocol):
         blobs = {}  # maps str URL to dict blob object
         aspect_ratios = {}  # maps str URL to (int width, int height) tuple
 
+        # fetch blobs and link previews in parallel, with a shared deadline
+        deadline = time.monotonic() + BLOB_FETCH_DEADLINE.total_seconds()
+        fetches = {}  # maps str URL to Future, for blobs we haven't waited on
+
+        def submit(fn, *args, **kwargs):
+            def run():
+                with ndb_client.context(**NDB_CONTEXT_KWARGS), app.app_context():
+                    return fn(*args, **kwargs)
+            return blob_executor.submit(run)
+
+        def result(future):
+            """Returns the future's result. Raises TimeoutError after deadline."""
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+
         def fetch_blob(url, blob_field, name, check_size=True, check_type=True):
-            if url and url not in blobs:
+            if url and url not in blobs and url not in fetches:
                 max_size = blob_field[name].get('maxSize') if check_size else None
                 accept = blob_field[name].get('accept') if check_type else None
+                fetches[url] = submit(
+                    AtpRemoteBlob.get_or_create, url=url,
+                    get_fn=util.requests_get, max_size=max_size,
+                    accept_types=accept)
+
+        def wait_for_blobs():
+            for url, future in fetches.items():
                 try:
-                    blob = AtpRemoteBlob.get_or_create(
-                        url=url, get_fn=util.requests_get, max_size=max_size,
-                        accept_types=accept)
+                    blob = result(future)
                     blobs[url] = blob.as_object()
                     if blob.width and blob.height:
                         aspect_ratios[url] = (blob.width, blob.height)
+                except TimeoutError:
+                    future.cancel()
+                    logger.info(f'timed out, skipping {url}')
                 except (RequestException, ValidationError) as e:
                     logger.info(f'failed, skipping {url} : {e}')
+            fetches.clear()
 
         if fetch_blobs:
             for o in obj.as1, as1.get_object(obj.as1):
@@ -943,6 +984,8 @@ class ATProto(User, Protocol):
                             fetch_blob(url, props, name='thumb',
                                        check_size=False, check_type=False)
 
+            wait_for_blobs()
+
         inner_obj = as1.get_object(obj.as1) or obj.as1
         orig_url = as1.get_url(inner_obj) or inner_obj.get('id')
 
@@ -976,21 +1019,27 @@ class ATProto(User, Protocol):
                             # background discussion:
                             # https://github.com/snarfed/bridgy-fed/issues/1615#issuecomment-2667191265
                             and first_char != ord('@')):
+                        future = submit(web.Web.load, feat['uri'],
+                                        metaformats=True,
+                                        authorship_fetch_mf2=False, raise_=False)
                         try:
-                            link = web.Web.load(feat['uri'], metaformats=True,
-                                                authorship_fetch_mf2=False,
-                                                raise_=False)
+                            link = result(future)
                         except AssertionError as e:
                             # we probably have an Object already stored for this URL
                             # with source_protocol that's not web
                             logger.warning(e)
                             continue
+                        except TimeoutError:
+                            future.cancel()
+                            logger.info(f"timed out fetching {feat['uri']} for link preview")
+                            break
 
                         if link and link.as1:
                             if img := util.get_url(link.as1, 'image'):
                                 props = appview.defs['app.bsky.embed.external#external']['properties']
                                 fetch_blob(img, props, name='thumb',
                                            check_size=False, check_type=False)
+                                wait_for_blobs()
                             ret['embed'] = to_external_embed(link.as1, blobs=blobs)
                             break
 
@@ -1080,6 +1129,7 @@ class ATProto(User, Protocol):
         # activate our repo, deactivate account on old PDS
         # https://atproto.com/guides/account-migration#finalizing-account-status
         arroba.server.storage.activate_repo(repo)
+        memcache.append_to_feed(DID_CHANGES_FEED, ('bridged', repo.did, True))
         repo.apply_writes(None)
         pds_client.com.atproto.server.deactivateAccount()
 
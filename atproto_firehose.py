@@ -3,22 +3,24 @@
 https://atproto.com/specs/event-stream
 https://atproto.com/specs/sync#firehose
 """
-from collections import namedtuple
+import base64
+from collections import deque, namedtuple
 from datetime import datetime, timedelta
 from io import BytesIO
 import itertools
 import logging
+import multiprocessing
 import os
-from queue import Queue
+from queue import Empty, Full, Queue
 from threading import Event, Lock, Thread, Timer
 import threading
 import time
+import zlib
 
 from arroba.datastore_storage import AtpRepo
 from arroba.util import parse_at_uri
 import dag_json
 from google.cloud import ndb
-from google.cloud.ndb.exceptions import ContextError
 from granary.bluesky import AT_URI_PATTERN
 from lexrpc.client import Client
 import libipld
@@ -29,13 +31,16 @@ from oauth_dropins.webutil.util import json_dumps, json_loads
 
 from atproto import ATProto, Cursor
 from common import (
-    create_task,
+    CompactSet,
+    DID_CHANGES_FEED,
     NDB_CONTEXT_KWARGS,
     PROTOCOL_DOMAINS,
     report_error,
     report_exception,
+    TaskBatcher,
     USER_AGENT,
 )
+import memcache
 from protocol import DELETE_TASK_DELAY
 from web import Web
 
@@ -43,6 +48,31 @@ logger = logging.getLogger(__name__)
 
 RECONNECT_DELAY = timedelta(seconds=30)
 STORE_CURSOR_FREQ = timedelta(seconds=10)
+READ_DID_CHANGES_FREQ = timedelta(seconds=1)
+RECONCILE_DIDS_FREQ = timedelta(minutes=10)
+
+# number of worker processes to shard firehose frames across, by repo DID, to
+# decode and filter them. if 0, subscribe does that itself, inline.
+FIREHOSE_SHARDS = int(os.environ.get('FIREHOSE_SHARDS', 0))
+# how many frames a shard worker processes before it reports its progress, if
+# it doesn't find any ops or drain its queue first
+SHARD_PROGRESS_FREQ = 100
+# how often Shards checks that its worker processes are still alive
+SHARD_CHECK_FREQ = timedelta(seconds=5)
+
+# DAG-CBOR encoded headers, ie {'t': ..., 'op': 1}, of the frame types that
+# scan_frame reads without decoding
+ROUTED_FRAME_HEADERS = {
+    t: b'\xa2\x61t' + bytes([0x60 + len(t)]) + t.encode() + b'\x62op\x01'
+    for t in ('#commit', '#account', '#identity')
+}
+
+# record types we care about from unbridged Bluesky users: follows of protocol
+# bots, and posts that reply to, quote, or mention bridged users
+UNBRIDGED_RECORD_TYPES = frozenset((
+    'app.bsky.feed.post',
+    'app.bsky.graph.follow',
+))
 
 # a commit operation. similar to arroba.repo.Write. record is None for deletes.
 Op = namedtuple('Op', ['action', 'repo', 'path', 'seq', 'record', 'time'],
@@ -59,38 +89,91 @@ commits = Queue(maxsize=1000)
 # global so that subscribe can reuse it across calls
 cursor = None
 
+# global: Shards, if FIREHOSE_SHARDS is set. subscribe populates it
+shards = None
+
 # global: _load_dids populates them, subscribe and handle use them
-atproto_dids = set()
+atproto_dids = CompactSet()
 atproto_loaded_at = datetime(1900, 1, 1)
-bridged_dids = set()
+bridged_dids = CompactSet()
 bridged_loaded_at = datetime(1900, 1, 1)
-protocol_bot_dids = set()
+protocol_bot_dids = CompactSet()
 dids_initialized = Event()
+load_dids_lock = Lock()
+# last sequence number we've read from DID_CHANGES_FEED
+did_changes_seq = None
+
+
+def apply_did_changes(kind, added=(), removed=()):
+    """Adds and removes DIDs in one of our filters.
+
+    Args:
+      kind (str): ``atproto`` for :attr:`atproto_dids`, ``bridged`` for
+        :attr:`bridged_dids`, or ``bot`` for :attr:`protocol_bot_dids`
+      added (sequence of str): DIDs to add
+      removed (sequence of str): DIDs to remove
+    """
+    dids = (atproto_dids if kind == 'atproto'
+            else bridged_dids if kind == 'bridged'
+            else protocol_bot_dids)
+    if removed:
+        dids.difference_update(removed)
+    if added:
+        dids.update(added)
 
 
 def load_dids():
-    logger.info('Starting _load_dids timer')
+    global did_changes_seq
+
+    logger.info('Starting _load_dids and _read_did_changes timers')
+    # start reading changes from *before* the initial load so that we don't
+    # miss any in between
+    _, did_changes_seq, _ = memcache.read_feed(DID_CHANGES_FEED)
+
     # run in a separate thread since it needs to make its own NDB
     # context when it runs in the timer thread
     Thread(target=_load_dids, daemon=True).start()
     dids_initialized.wait()
     dids_initialized.clear()
 
+    if not DEBUG:
+        Timer(READ_DID_CHANGES_FREQ.total_seconds(), _read_did_changes).start()
+
+
+def _load_dids(reschedule=True):
+    """Queries the datastore for DIDs to add to or remove from our filters.
+
+    Users and repos push changes to us via :func:`_read_did_changes`, so this is
+    just a slow reconciliation pass in case we miss any of those.
 
-def _load_dids():
+    Args:
+      reschedule (bool): whether to run again after ``RECONCILE_DIDS_FREQ``
+    """
     global atproto_dids, atproto_loaded_at, bridged_dids, bridged_loaded_at
 
-    if not DEBUG:
-        Timer(STORE_CURSOR_FREQ.total_seconds(), _load_dids).start()
+    if reschedule and not DEBUG:
+        Timer(RECONCILE_DIDS_FREQ.total_seconds(), _load_dids).start()
 
-    with ndb_client.context(**NDB_CONTEXT_KWARGS):
+    with load_dids_lock, ndb_client.context(**NDB_CONTEXT_KWARGS):
         try:
             atproto_query = ATProto.query(ATProto.status == None,
                                           ATProto.enabled_protocols != None,
                                           ATProto.updated > atproto_loaded_at)
             loaded_at = ATProto.query().order(-ATProto.updated).get().updated
             new_atproto = [key.id() for key in atproto_query.iter(keys_only=True)]
-            atproto_dids.update(new_atproto)
+
+            # users who were updated but didn't match above have opted out,
+            # been blocked, disabled the bridge, etc. skip this on the initial
+            # load since there's nothing to remove yet.
+            removed_atproto = []
+            if atproto_dids:
+                updated_query = ATProto.query(ATProto.updated > atproto_loaded_at)
+                removed_atproto = set(key.id() for key in
+                                      updated_query.iter(keys_only=True))
+                removed_atproto.difference_update(new_atproto)
+
+            apply_did_changes('atproto', added=new_atproto,
+                              removed=list(removed_atproto))
             # set *after* we populate atproto_dids so that if we crash earlier, we
             # re-query from the earlier timestamp
             atproto_loaded_at = loaded_at
@@ -99,7 +182,7 @@ def _load_dids():
                                           AtpRepo.created > bridged_loaded_at)
             loaded_at = AtpRepo.query().order(-AtpRepo.created).get().created
             new_bridged = [key.id() for key in bridged_query.iter(keys_only=True)]
-            bridged_dids.update(new_bridged)
+            apply_did_changes('bridged', added=new_bridged)
             # set *after* we populate bridged_dids so that if we crash earlier, we
             # re-query from the earlier timestamp
             bridged_loaded_at = loaded_at
@@ -110,11 +193,11 @@ def _load_dids():
                     if bot:
                         if did := bot.get_copy(ATProto):
                             logger.info(f'Loaded protocol bot user {bot.key.id()} {did}')
-                            protocol_bot_dids.add(did)
+                            apply_did_changes('bot', added=[did])
 
             dids_initialized.set()
             total = len(atproto_dids) + len(bridged_dids)
-            logger.info(f'DIDs: {total} ATProto {len(atproto_dids)} (+{len(new_atproto)}), AtpRepo {len(bridged_dids)} (+{len(new_bridged)}); commits {commits.qsize()}')
+            logger.info(f'DIDs: {total} ATProto {len(atproto_dids)} (+{len(new_atproto)} -{len(removed_atproto)}), AtpRepo {len(bridged_dids)} (+{len(new_bridged)}); commits {commits.qsize()}')
 
         except BaseException:
             # eg google.cloud.ndb.exceptions.ContextError when we lose the ndb context
@@ -122,10 +205,50 @@ def _load_dids():
             report_exception()
 
 
+def _read_did_changes():
+    """Applies DID changes from memcache to our filters.
+
+    Written by :meth:`models.User._post_put_hook` and when :class:`ATProto`
+    creates, activates, and deactivates repos. If we missed any, eg because
+    they expired or were evicted, runs :func:`_load_dids` to catch up.
+    """
+    global did_changes_seq
+
+    if not DEBUG:
+        Timer(READ_DID_CHANGES_FREQ.total_seconds(), _read_did_changes).start()
+
+    try:
+        changes, did_changes_seq, complete = memcache.read_feed(
+            DID_CHANGES_FEED, after=did_changes_seq)
+
+        for kind, did, enabled in changes:
+            if enabled:
+                apply_did_changes(kind, added=[did])
+            else:
+                apply_did_changes(kind, removed=[did])
+
+        if changes:
+            logger.info(f'Applied {len(changes)} DID changes')
+
+        if not complete:
+            logger.warning('Missed some DID changes, reloading from datastore')
+            _load_dids(reschedule=False)
+
+    except BaseException:
+        report_exception()
+
+
 def subscriber():
     """Wrapper around :func:`_subscribe` that catches exceptions and reconnects."""
+    global shards
+
     logger.info(f'started thread to subscribe to {os.environ["BGS_HOST"]} firehose')
-    load_dids()
+    if not FIREHOSE_SHARDS:
+        load_dids()
+    elif not shards:
+        # the workers load and follow DIDs themselves, we don't need them here
+        shards = Shards(FIREHOSE_SHARDS)
+        shards.start()
 
     with ndb_client.context(**NDB_CONTEXT_KWARGS):
          while True:
@@ -141,6 +264,9 @@ def subscribe():
     """Subscribes to the relay's firehose.
 
     Relay hostname comes from the ``BGS_HOST`` environment variable.
+
+    If :attr:`shards` is set, hands each frame off to a :class:`Shards` worker
+    process to filter. Otherwise does that inline.
     """
     global cursor
     if not cursor:
@@ -151,17 +277,24 @@ def subscribe():
         if cursor.cursor:
             cursor.cursor += 1
 
+    # in sharded mode, the stored cursor lags behind the frames we've already
+    # handed to workers, so reconnect after the last one of those instead
+    start = cursor.cursor
+    if shards and shards.last_dispatched:
+        start = shards.last_dispatched + 1
+
     last_stored_cursor = cur_timestamp = None
 
     client = Client(f'https://{os.environ["BGS_HOST"]}',
                     headers={'User-Agent': USER_AGENT})
 
-    for frame in client.com.atproto.sync.subscribeRepos(decode=False,
-                                                        cursor=cursor.cursor):
-        # parse header
-        header = libipld.decode_dag_cbor(frame)
+    for frame in client.com.atproto.sync.subscribeRepos(decode=False, cursor=start):
+        if shards:
+            # the worker decodes the frame, we only need enough to route it
+            header, payload = scan_frame(frame)
+        else:
+            header, payload = libipld.decode_dag_cbor_multi(frame)
         if header.get('op') == -1:
-            _, payload = libipld.decode_dag_cbor_multi(frame)
             logger.warning(f'Got error from relay! {payload}')
             continue
 
@@ -172,8 +305,6 @@ def subscribe():
                 logger.info(f'Got {t} from relay')
             continue
 
-        # parse payload
-        _, payload = libipld.decode_dag_cbor_multi(frame)
         repo = payload.get('repo') or payload.get('did')
         if not repo:
             logger.warning(f'Payload missing repo! {payload}')
@@ -186,9 +317,16 @@ def subscribe():
 
         cur_timestamp = payload['time']
 
-        # if we fail processing this commit and raise an exception up to subscriber,
-        # skip it and start with the next commit when we're restarted
-        cursor.cursor = seq + 1
+        if shards:
+            shards.dispatch(repo, seq, frame)
+            # only advance to the last seq that every shard has finished, so
+            # that we don't skip anything they're still working on if we crash
+            cursor.cursor = shards.finished_seq() + 1
+        else:
+            # if we fail processing this commit and raise an exception up to
+            # subscriber, skip it and start with the next commit when we're
+            # restarted
+            cursor.cursor = seq + 1
 
         elapsed = util.now().replace(tzinfo=None) - cursor.updated
         if elapsed > STORE_CURSOR_FREQ:
@@ -206,115 +344,571 @@ def subscribe():
             # when running locally, comment out put above and uncomment this
             # cursor.updated = util.now().replace(tzinfo=None)
 
-        if t in ('#account', '#identity'):
-            if repo in atproto_dids or repo in bridged_dids:
-                t = t.removeprefix('#')
-                logger.debug(f'Got {t} {repo}')
-                commits.put(Op(action=t, repo=repo, seq=seq, time=cur_timestamp))
+        if not shards:
+            for op in process(t, payload):
+                commits.put(op)
+
+
+def process(t, payload):
+    """Filters a decoded firehose event down to the ops we should handle.
+
+    Args:
+      t (str): event type, eg ``#commit``
+      payload (dict): decoded event payload
+
+    Returns:
+      generator of :class:`Op`
+    """
+    repo = payload.get('repo') or payload.get('did')
+    seq = payload.get('seq')
+    cur_timestamp = payload.get('time')
+
+    if t in ('#account', '#identity'):
+        if repo in atproto_dids or repo in bridged_dids:
+            t = t.removeprefix('#')
+            logger.debug(f'Got {t} {repo}')
+            yield Op(action=t, repo=repo, seq=seq, time=cur_timestamp)
+        return
+
+    if repo not in atproto_dids and repo in bridged_dids:
+        # users bridged into ATProto from other protocols. their records
+        # originate with us, so we've already handled them
+        return
+
+    # first pass: pick out ops that might be ours based only on the repo and
+    # op paths, so that we can skip decoding blocks for everything else, which
+    # is the vast majority of the firehose
+    native = repo in atproto_dids
+    collections = ATProto.SUPPORTED_RECORD_TYPES if native else UNBRIDGED_RECORD_TYPES
+    candidates = []  # (Op, str CID) tuples
+    for p_op in payload.get('ops', []):
+        op = Op(repo=payload['repo'], action=p_op.get('action'),
+                path=p_op.get('path'), seq=payload['seq'], time=payload['time'])
+        if not op.action or not op.path:
+            logger.info(
+                f'bad payload! seq {op.seq} action {op.action} path {op.path}!')
             continue
 
-        blocks = {}  # maps base32 str CID to dict block
-        if block_bytes := payload.get('blocks'):
-            _, blocks = libipld.decode_car(block_bytes)
-
-        # detect records from bridged ATProto users that we should handle
-        for p_op in payload.get('ops', []):
-            op = Op(repo=payload['repo'], action=p_op.get('action'),
-                    path=p_op.get('path'), seq=payload['seq'], time=payload['time'])
-            if not op.action or not op.path:
-                logger.info(
-                    f'bad payload! seq {op.seq} action {op.action} path {op.path}!')
-                continue
-
-            if op.repo in atproto_dids and op.action == 'delete':
-                # TODO: also detect deletes of records that *reference* our bridged
-                # users, eg a delete of a follow or like or repost of them.
-                # not easy because we need to getRecord the record to check
-                commits.put(op)
-                continue
-
-            cid = p_op.get('cid')
-            block = blocks.get(cid)
-            # our own commits are sometimes missing the record
-            # https://github.com/snarfed/bridgy-fed/issues/1016
-            if not cid or not block:
-                continue
-            elif not isinstance(block, dict):
-                # https://github.com/snarfed/bridgy-fed/issues/1938
-                logger.info(f"Skipping odd record we couldn't understand (#1938): {op} {p_op} {repr(block)}")
-                continue
-
-            op = op._replace(record=block)
-            type = op.record.get('$type')
-            if not type:
-                logger.warning('commit record missing $type! {op.action} {op.repo} {op.path} {cid}')
-                logger.warning(dag_json.encode(op.record).decode())
-                continue
-            elif type not in ATProto.SUPPORTED_RECORD_TYPES:
-                continue
-
-            def is_ours(did_or_ref, native):
-                """Returns True if the arg is a bridged user.
-
-                Args:
-                  did_or_ref (str or dict): if dict, a ``com.atproto.repo.strongRef``
-                    or similar
-                  native (bool): if True, bridged ATProto users also count. If
-                    False, only users from other protocols who are bridged into
-                    ATProto count
-                """
-                did = None
-                if isinstance(did_or_ref, dict):
-                    if match := AT_URI_PATTERN.match(did_or_ref['uri']):
-                        did = match.group('repo')
+        if native and op.action == 'delete':
+            # TODO: also detect deletes of records that *reference* our bridged
+            # users, eg a delete of a follow or like or repost of them.
+            # not easy because we need to getRecord the record to check
+            candidates.append((op, None))
+            continue
+
+        cid = p_op.get('cid')
+        collection = op.path.split('/', 1)[0]
+        # our own commits are sometimes missing the record
+        # https://github.com/snarfed/bridgy-fed/issues/1016
+        if cid and collection in collections:
+            candidates.append((op, cid))
+
+    if not candidates:
+        return
+
+    # second pass: decode just the surviving ops' blocks and check their records
+    cids = [cid for _, cid in candidates if cid]
+    blocks = read_blocks(payload.get('blocks'), cids) if cids else {}
+
+    for op, cid in candidates:
+        if op.action == 'delete':
+            yield op
+            continue
+
+        block = blocks.get(cid)
+        if not block:
+            continue
+        elif not isinstance(block, dict):
+            # https://github.com/snarfed/bridgy-fed/issues/1938
+            logger.info(f"Skipping odd record we couldn't understand (#1938): {op} {cid} {repr(block)}")
+            continue
+
+        op = op._replace(record=block)
+        type = op.record.get('$type')
+        if not type:
+            logger.warning('commit record missing $type! {op.action} {op.repo} {op.path} {cid}')
+            logger.warning(dag_json.encode(op.record).decode())
+            continue
+        elif type not in ATProto.SUPPORTED_RECORD_TYPES:
+            continue
+
+        def is_ours(did_or_ref, native):
+            """Returns True if the arg is a bridged user.
+
+            Args:
+              did_or_ref (str or dict): if dict, a ``com.atproto.repo.strongRef``
+                or similar
+              native (bool): if True, bridged ATProto users also count. If
+                False, only users from other protocols who are bridged into
+                ATProto count
+            """
+            did = None
+            if isinstance(did_or_ref, dict):
+                if match := AT_URI_PATTERN.match(did_or_ref['uri']):
+                    did = match.group('repo')
+            else:
+                did = did_or_ref
+
+            return did and (did in bridged_dids or native and did in atproto_dids)
+
+        if op.repo in atproto_dids:
+            # from a bridged Bluesky user
+            if type == 'app.bsky.feed.repost':
+                if is_ours(op.record['subject'], native=True):
+                    yield op
+
+            elif type == 'app.bsky.feed.like':
+                if is_ours(op.record['subject'], native=False):
+                    yield op
+
+            elif type in ('app.bsky.graph.block', 'app.bsky.graph.follow'):
+                if is_ours(op.record['subject'], native=False):
+                    yield op
+
+            elif type == 'app.bsky.feed.post':
+                reply = op.record.get('reply')
+                if not reply or is_ours(reply['parent'], native=True):
+                    yield op
+
+        elif op.repo not in bridged_dids:
+            # from an unbridged Bluesky user. only follows of protocol bots and
+            # replies/quotes/mentions of bridged users, so that we can DM them a
+            # notification
+            if type == 'app.bsky.graph.follow':
+                if op.record['subject'] in protocol_bot_dids:
+                    yield op
+
+            elif type == 'app.bsky.feed.post':
+                subjects = []
+                if reply := op.record.get('reply'):
+                    subjects.append(reply.get('parent'))
+                if embed := op.record.get('embed'):
+                    if embed.get('$type') == 'app.bsky.embed.record':
+                        subjects.append(embed['record'])
+                for facet in op.record.get('facets', []):
+                    for feat in facet.get('features', []):
+                        if feat.get('$type') == 'app.bsky.richtext.facet#mention':
+                            subjects.append(feat.get('did'))
+
+                for subject in subjects:
+                    if is_ours(subject, native=False):
+                        yield op
+                        break
+
+
+def process_frame(frame):
+    """Decodes and filters a raw firehose frame.
+
+    Args:
+      frame (bytes): header and payload, DAG-CBOR encoded
+
+    Returns:
+      list of :class:`Op`
+    """
+    header, payload = libipld.decode_dag_cbor_multi(frame)
+    return list(process(header.get('t'), payload))
+
+
+def scan_frame(frame):
+    """Pulls the header and just the fields we need to route a raw frame.
+
+    Doesn't decode the payload, just reads its ``repo`` or ``did``, ``seq``,
+    and ``time`` fields, so that :func:`subscribe` can hand frames to
+    :class:`Shards` workers without decoding them itself. Falls back to
+    decoding the whole frame for other frame types, eg errors, or if the
+    payload doesn't look like we expect.
+
+    DAG-CBOR sorts map keys by length first, so these fields all come before
+    ``blocks`` and are usually at known positions. The exception is
+    ``#commit``'s ``ops``, which comes before them and has user controlled
+    paths, so we skip it by anchoring on ``rev``, which comes right before
+    ``seq``. A path can't fake that since ``seq``'s value is a uint.
+
+    Args:
+      frame (bytes): header and payload, DAG-CBOR encoded
+
+    Returns:
+      (dict header, dict payload) tuple. If we didn't decode the whole frame,
+      payload only has ``seq``, ``time``, and ``repo`` or ``did``.
+    """
+    try:
+        for t, header in ROUTED_FRAME_HEADERS.items():
+            if frame.startswith(header):
+                # skip the payload map's head
+                _, _, pos = _read_cbor_head(frame, len(header))
+                payload = {}
+                if t == '#commit':
+                    while 'seq' not in payload:
+                        pos = frame.index(b'\x63rev', pos) + 4
+                        major, rev_len, pos = _read_cbor_head(frame, pos)
+                        if major == 3:
+                            pos += rev_len
+                        if frame.startswith(b'\x63seq', pos):
+                            major, seq, end = _read_cbor_head(frame, pos + 4)
+                            if major == 0:
+                                payload['seq'], pos = seq, end
+                    # skip prev, if it's there
+                    pos = frame.index(b'\x64repo', pos)
+                    keys = ('repo', 'time')
                 else:
-                    did = did_or_ref
-
-                return did and (did in bridged_dids or native and did in atproto_dids)
-
-            if op.repo in atproto_dids:
-                # from a bridged Bluesky user
-                if type == 'app.bsky.feed.repost':
-                    if is_ours(op.record['subject'], native=True):
-                        commits.put(op)
-
-                elif type == 'app.bsky.feed.like':
-                    if is_ours(op.record['subject'], native=False):
-                        commits.put(op)
-
-                elif type in ('app.bsky.graph.block', 'app.bsky.graph.follow'):
-                    if is_ours(op.record['subject'], native=False):
-                        commits.put(op)
-
-                elif type == 'app.bsky.feed.post':
-                    reply = op.record.get('reply')
-                    if not reply or is_ours(reply['parent'], native=True):
-                        commits.put(op)
-
-            elif op.repo not in bridged_dids:
-                # from an unbridged Bluesky user. only follows of protocol bots and
-                # replies/quotes/mentions of bridged users, so that we can DM them a
-                # notification
-                if type == 'app.bsky.graph.follow':
-                    if op.record['subject'] in protocol_bot_dids:
-                        commits.put(op)
-
-                elif type == 'app.bsky.feed.post':
-                    subjects = []
-                    if reply := op.record.get('reply'):
-                        subjects.append(reply.get('parent'))
-                    if embed := op.record.get('embed'):
-                        if embed.get('$type') == 'app.bsky.embed.record':
-                            subjects.append(embed['record'])
-                    for facet in op.record.get('facets', []):
-                        for feat in facet.get('features', []):
-                            if feat.get('$type') == 'app.bsky.richtext.facet#mention':
-                                subjects.append(feat.get('did'))
-
-                    for subject in subjects:
-                        if is_ours(subject, native=False):
-                            commits.put(op)
-                            break
+                    keys = ('did', 'seq', 'time')
+
+                for key in keys:
+                    payload[key], pos = _read_field(frame, key, pos)
+
+                return {'op': 1, 't': t}, payload
+
+    except (IndexError, ValueError) as e:
+        logger.info(f"Couldn't scan frame, decoding it instead: {e}")
+
+    return libipld.decode_dag_cbor_multi(frame)
+
+
+def _read_field(buf, key, pos):
+    """Reads a DAG-CBOR map entry with a uint or text value.
+
+    Args:
+      buf (bytes)
+      key (str): must be shorter than 24 bytes
+      pos (int): index of the entry's key
+
+    Returns:
+      (int or str value, int position after it) tuple
+
+    Raises:
+      ValueError: if the entry isn't at ``pos`` or its value isn't a uint or
+        text
+    """
+    if not buf.startswith(bytes([0x60 + len(key)]) + key.encode(), pos):
+        raise ValueError(f'expected {key} at {pos}')
+
+    major, val, pos = _read_cbor_head(buf, pos + 1 + len(key))
+    if major == 0:
+        return val, pos
+    elif major == 3:
+        return buf[pos:pos + val].decode(), pos + val
+
+    raise ValueError(f'unexpected CBOR major type {major} for {key}')
+
+
+def _read_cbor_head(buf, pos):
+    """Reads a CBOR data item's head, ie its major type and argument.
+
+    https://www.rfc-editor.org/rfc/rfc8949.html#name-specification-of-the-cbor-e
+
+    Args:
+      buf (bytes)
+      pos (int): index to start reading at
+
+    Returns:
+      (int major type, int argument, int position after the head) tuple
+    """
+    byte = buf[pos]
+    major, info = byte >> 5, byte & 0x1f
+    pos += 1
+    if info < 24:
+        return major, info, pos
+    elif info > 27:
+        raise ValueError(f'unsupported CBOR additional info {info}')
+
+    size = 1 << (info - 24)
+    return major, int.from_bytes(buf[pos:pos + size], 'big'), pos + size
+
+
+def read_blocks(car, cids):
+    """Decodes only the given blocks from a CAR file.
+
+    Scans the CAR's section headers to find the blocks we want and decodes just
+    those, instead of decoding every block like :func:`libipld.decode_car`.
+    Supports CIDv1 only, which is all ATProto uses.
+
+    https://ipld.io/specs/transport/car/carv1/#format-description
+
+    Args:
+      car (bytes): CAR file
+      cids (sequence of str): base32 CIDs to decode
+
+    Returns:
+      dict: maps base32 str CID to decoded block. CIDs that aren't in the CAR
+      are omitted.
+    """
+    if not car:
+        return {}
+
+    # multibase base32 string => raw CID bytes
+    wanted = {}
+    for cid in cids:
+        encoded = cid.removeprefix('b').upper()
+        encoded += '=' * (-len(encoded) % 8)
+        wanted[base64.b32decode(encoded)] = cid
+
+    blocks = {}
+    header_len, pos = _read_varint(car, 0)
+    pos += header_len
+    while pos < len(car) and len(blocks) < len(wanted):
+        section_len, pos = _read_varint(car, pos)
+        end = pos + section_len
+
+        # CIDv1 is version, codec, and multihash code varints, then the digest,
+        # prefixed by its length
+        cid_start = pos
+        for _ in range(3):
+            _, pos = _read_varint(car, pos)
+        digest_len, pos = _read_varint(car, pos)
+        pos += digest_len
+
+        if cid := wanted.get(car[cid_start:pos]):
+            blocks[cid] = libipld.decode_dag_cbor(car[pos:end])
+
+        pos = end
+
+    return blocks
+
+
+def _read_varint(buf, pos):
+    """Reads an unsigned LEB128 varint.
+
+    Args:
+      buf (bytes)
+      pos (int): index to start reading at
+
+    Returns:
+      (int value, int position after the varint) tuple
+    """
+    val = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        val |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return val, pos
+        shift += 7
+
+
+class Shards:
+    """Worker processes that decode and filter firehose frames, sharded by repo.
+
+    :func:`subscribe` hands each worker the raw frames for its repos, in seq
+    order, via :meth:`dispatch`. A given repo always maps to the same worker, so
+    its frames stay in order. Workers send back the :class:`Op`\\s they find
+    along with the last seq they finished, and :meth:`collect` puts those Ops
+    into :attr:`commits` for :func:`handle`.
+
+    Workers finish at different speeds, so :meth:`finished_seq` returns the
+    highest seq that *every* worker has finished. That's what we store in the
+    :class:`Cursor`, so that if we crash and restart, we may reprocess some
+    frames, but we never skip any.
+
+    Each worker loads DIDs from the datastore and follows ``DID_CHANGES_FEED``
+    itself, via :func:`load_dids`, so the parent doesn't need them.
+    :meth:`collect` checks that the workers are alive every
+    ``SHARD_CHECK_FREQ``. If one has died, it restarts it and resends the
+    frames it hadn't finished.
+
+    Attributes:
+      num (int): number of worker processes
+      dispatched (list of int): last seq sent to each worker
+      finished (list of int): last seq each worker has finished
+      last_dispatched (int): last seq sent to any worker
+      pending (list of collections.deque): (seq, frame) tuples sent to each
+        worker that it hasn't finished yet
+      inputs (list of multiprocessing.Queue): one per worker, for frames
+      processes (list of multiprocessing.Process): workers
+      results (multiprocessing.Queue): shared by all workers, for results
+    """
+    def __init__(self, num, start=None):
+        """Constructor.
+
+        Args:
+          num (int): number of worker processes
+          start (int): seq to start from, ie everything before it is finished.
+            If None, we start from the first frame we dispatch.
+        """
+        assert num > 0
+        self.num = num
+        self.lock = Lock()
+        self.dispatched = [start] * num
+        self.finished = [start] * num
+        self.last_dispatched = start
+        self.pending = [deque() for _ in range(num)]
+        self.inputs = [None] * num
+        self.processes = [None] * num
+        self.results = None
+        # spawn, not fork, since gRPC and NDB aren't fork safe
+        self.ctx = multiprocessing.get_context('spawn')
+
+    def start(self):
+        """Starts the worker processes and the thread that collects their results.
+        """
+        self.results = self.ctx.Queue(maxsize=commits.maxsize)
+        for i in range(self.num):
+            self.start_worker(i)
+
+        Thread(target=self.collect, name='atproto_firehose.collector',
+               daemon=True).start()
+
+    def start_worker(self, shard):
+        """Starts or restarts a worker process and resends its pending frames.
+
+        Args:
+          shard (int)
+        """
+        with self.lock:
+            num_pending = len(self.pending[shard])
+
+        # room for the pending frames, plus maybe a few more that get
+        # dispatched while we start the process
+        input = self.ctx.Queue(maxsize=commits.maxsize + num_pending * 2)
+        process = self.ctx.Process(
+            target=shard_worker, args=(shard, input, self.results),
+            name=f'atproto_firehose.shard-{shard}', daemon=True)
+        process.start()
+
+        with self.lock:
+            for item in self.pending[shard]:
+                input.put_nowait(item)
+            self.inputs[shard] = input
+            self.processes[shard] = process
+
+    def check_workers(self):
+        """Restarts any worker processes that have died."""
+        for shard, process in enumerate(self.processes):
+            if process and not process.is_alive():
+                report_error(f'Firehose shard worker {shard} died with exit code {process.exitcode}, restarting')
+                self.start_worker(shard)
+
+    def shard(self, repo):
+        """Returns the worker index for a given repo.
+
+        Args:
+          repo (str): DID
+
+        Returns:
+          int:
+        """
+        return zlib.crc32(repo.encode()) % self.num
+
+    def dispatch(self, repo, seq, frame):
+        """Sends a frame to its repo's worker. May block if that worker is behind.
+
+        Args:
+          repo (str): DID
+          seq (int)
+          frame (bytes)
+        """
+        shard = self.shard(repo)
+        with self.lock:
+            if self.last_dispatched is None:
+                self.dispatched = [seq - 1] * self.num
+                self.finished = [seq - 1] * self.num
+            self.dispatched[shard] = self.last_dispatched = seq
+            self.pending[shard].append((seq, frame))
+            input = self.inputs[shard]
+
+        self._put(shard, input, (seq, frame))
+
+    def _put(self, shard, input, item):
+        """Puts an item on a worker's queue, unless the worker gets restarted.
+
+        If the worker has died, its queue may never drain, so this gives up if
+        :meth:`start_worker` replaces it. That resends pending frames, so
+        nothing is lost.
+
+        Args:
+          shard (int)
+          input (multiprocessing.Queue): the worker's queue
+          item (tuple): (int seq, bytes frame)
+        """
+        while True:
+            try:
+                input.put(item, timeout=SHARD_CHECK_FREQ.total_seconds())
+                return
+            except Full:
+                if self.inputs[shard] is not input:
+                    return
+
+    def finish(self, shard, seq):
+        """Records that a worker has finished everything up through ``seq``.
+
+        Args:
+          shard (int)
+          seq (int)
+        """
+        with self.lock:
+            self.finished[shard] = seq
+            pending = self.pending[shard]
+            while pending and pending[0][0] <= seq:
+                pending.popleft()
+
+    def finished_seq(self):
+        """Returns the highest seq at or below which every frame is finished.
+
+        Returns:
+          int:
+        """
+        with self.lock:
+            # workers with nothing outstanding don't hold us back. the rest have
+            # finished all of their frames up through their own finished seq.
+            # frames below the lowest of those are finished everywhere.
+            pending = [finished for finished, dispatched
+                       in zip(self.finished, self.dispatched)
+                       if finished < dispatched]
+            return min(pending, default=self.last_dispatched)
+
+    def collect(self):
+        """Moves worker results into :attr:`commits`. Runs forever.
+
+        Also checks that the workers are alive every ``SHARD_CHECK_FREQ``.
+        """
+        logger.info('started thread to collect firehose shard results')
+        check_freq = SHARD_CHECK_FREQ.total_seconds()
+        next_check = time.monotonic() + check_freq
+
+        while True:
+            try:
+                shard, seq, ops = self.results.get(timeout=check_freq)
+                for op in ops:
+                    commits.put(op)
+                self.finish(shard, seq)
+            except Empty:
+                pass
+
+            if time.monotonic() >= next_check:
+                self.check_workers()
+                next_check = time.monotonic() + check_freq
+
+
+def shard_worker(shard, frames, results):
+    """Entry point for :class:`Shards` worker processes. Runs forever.
+
+    Loads DIDs and follows their changes itself, same as :func:`subscriber`
+    does when it's not sharded. Reports progress back to the parent whenever it
+    finds ops, drains its input queue, or has gone ``SHARD_PROGRESS_FREQ``
+    frames without reporting.
+
+    Args:
+      shard (int)
+      frames (multiprocessing.Queue): receives (int seq, bytes frame) tuples
+      results (multiprocessing.Queue): sends (int shard, int seq, list of
+        :class:`Op`) tuples
+    """
+    logger.info(f'started firehose shard worker {shard}')
+    load_dids()
+
+    unreported = 0
+    while True:
+        seq, frame = frames.get()
+        try:
+            ops = process_frame(frame)
+        except BaseException:
+            # skip this frame, same as subscribe does when it processes inline
+            report_exception()
+            ops = []
+
+        unreported += 1
+        if ops or unreported >= SHARD_PROGRESS_FREQ or frames.empty():
+            results.put((shard, seq, ops))
+            unreported = 0
 
 
 def handler():
@@ -374,40 +968,49 @@ def handle(limit=None):
 
         logger.debug(f'Got {op.action} {op.repo} {op.path}')
         delay = DELETE_TASK_DELAY if op.action == 'delete' else None
+
+        def report(future):
+            # the batcher creates tasks on its own threads, so failures show up
+            # here, not in add(). report and continue with the next commit.
+            if exc := future.exception():
+                logger.error(f'Failed to enqueue receive task for {obj_id}',
+                             exc_info=exc)
+                report_error(f'Failed to enqueue receive task for {obj_id}: {exc}')
+
         try:
-            create_task(queue='receive', id=obj_id, source_protocol=ATProto.LABEL,
+            batcher.add(queue='receive', id=obj_id, source_protocol=ATProto.LABEL,
                         authed_as=op.repo, received_at=op.time, delay=delay,
-                        **record_kwarg)
+                        **record_kwarg).add_done_callback(report)
             # when running locally, comment out above and uncomment this
             # logger.info(f'enqueuing receive task for {at_uri}')
-        except ContextError:
-            raise  # handled in handle()
         except BaseException:
+            # building the task failed, eg its params didn't serialize
             report_error(obj_id, exception=True)
 
     seen = 0
-    while op := commits.get():
-        match op.action:
-            case 'account':
-                # reload DID doc
-                ATProto.load(op.repo, did_doc=True, remote=True)
-
-            case 'identity':
-                # reload DID doc, update user's computed handle property, send actor
-                # update to followers
-                ATProto.load(op.repo, did_doc=True, remote=True)
-                if user := ATProto.get_by_id(op.repo):
-                    user.put()
-                    if user.obj and user.obj.bsky:
-                        _handle(Op(repo=op.repo, action='update', record=user.obj.bsky,
-                                   path='app.bsky.actor.profile/self',
-                                   seq=op.seq, time=op.time))
-
-            case _:
-                _handle(op)
-
-        seen += 1
-        if limit is not None and seen >= limit:
-            return
+    with TaskBatcher(keep_results=False) as batcher:
+        while op := commits.get():
+            match op.action:
+                case 'account':
+                    # reload DID doc
+                    ATProto.load(op.repo, did_doc=True, remote=True)
+
+                case 'identity':
+                    # reload DID doc, update user's computed handle property, send actor
+                    # update to followers
+                    ATProto.load(op.repo, did_doc=True, remote=True)
+                    if user := ATProto.get_by_id(op.repo):
+                        user.put()
+                        if user.obj and user.obj.bsky:
+                            _handle(Op(repo=op.repo, action='update', record=user.obj.bsky,
+                                       path='app.bsky.actor.profile/self',
+                                       seq=op.seq, time=op.time))
+
+                case _:
+                    _handle(op)
+
+            seen += 1
+            if limit is not None and seen >= limit:
+                return
 
     assert False, "handle thread shouldn't reach here!"
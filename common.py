@@ -1,7 +1,13 @@
 """Misc common utilities."""
+from array import array
 import base64
+from bisect import bisect_left
+import concurrent.futures
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import timedelta
 import functools
+import heapq
+import itertools
 import logging
 import os
 from pathlib import Path
@@ -103,6 +109,11 @@ CACHE_CONTROL_VARY_ACCEPT = {**CACHE_CONTROL, 'Vary': 'Accept'}
 
 NDB_MEMCACHE_TIMEOUT = timedelta(hours=2)
 
+# memcache feed of (str kind, str DID, bool enabled) tuples that tells the ATProto
+# firehose which DIDs to start and stop handling. kind is 'atproto' for
+# ATProto users, 'bridged' for AtpRepos. See memcache.append_to_feed.
+DID_CHANGES_FEED = 'atproto-did-changes'
+
 USER_AGENT = 'Bridgy Fed (https://fed.brid.gy/)'
 util.set_user_agent(USER_AGENT)
 
@@ -319,47 +330,80 @@ def create_task(queue, app_id=GCP_PROJECT_ID, delay=None, **params):
       task.
     """
     assert queue
-    path = f'/queue/{queue}'
 
+    if RUN_TASKS_INLINE or appengine_info.LOCAL_SERVER:
+        params = _task_params(params)
+        authorization, _ = _task_request_headers()
+        logger.info(f'Running task inline: {queue} {params}')
+        from router import app
+        return app.test_client().post(f'/queue/{queue}', data=params, headers={
+              flask_util.CLOUD_TASKS_TASK_HEADER: 'x',
+              'Authorization': authorization,
+        })
+
+        # # alternative: run inline in this request context
+        # request.form = params
+        # endpoint, args = app.url_map.bind(request.server[0])\
+        #                             .match(path, method='POST')
+        # return app.view_functions[endpoint](**args)
+
+    return _send_task(*_build_task(queue, app_id=app_id, delay=delay, **params))
+
+
+def _task_params(params):
+    """JSON-encodes dict values and drops None values from task params.
+
+    Args:
+      params (dict)
+
+    Returns:
+      dict:
+    """
     # removed from "Added X task ..." log message below to cut logging costs
     # https://github.com/snarfed/bridgy-fed/issues/1149#issuecomment-2265861956
     # loggable = {k: '{...}' if isinstance(v, dict) else v for k, v in params.items()}
-    params = {
+    return {
         k: json_dumps(v, sort_keys=True) if isinstance(v, dict) else v
         for k, v in params.items()
         if v is not None
     }
 
+
+def _task_request_headers():
+    """Returns the current request's headers to propagate to tasks we create.
+
+    Returns:
+      (str, str) tuple: ``Authorization`` and ``traceparent`` header values, or
+      empty strings if we're not in a request context
+    """
     try:
         authorization = request.headers.get('Authorization') or ''
         traceparent = request.headers.get('traceparent') or ''
     except RuntimeError:  # not currently in a request context
         authorization = traceparent = ''
 
-    if RUN_TASKS_INLINE or appengine_info.LOCAL_SERVER:
-        logger.info(f'Running task inline: {queue} {params}')
-        from router import app
-        return app.test_client().post(path, data=params, headers={
-              flask_util.CLOUD_TASKS_TASK_HEADER: 'x',
-              'Authorization': authorization,
-        })
+    return authorization, traceparent
 
-        # # alternative: run inline in this request context
-        # request.form = params
-        # endpoint, args = app.url_map.bind(request.server[0])\
-        #                             .match(path, method='POST')
-        # return app.view_functions[endpoint](**args)
 
-    body = urllib.parse.urlencode(sorted(params.items())).encode()
+def _build_task(queue, app_id=GCP_PROJECT_ID, delay=None, **params):
+    """Builds a Cloud Tasks task. Must be called in the request context, if any.
+
+    Args: see :func:`create_task`
+
+    Returns:
+      (str, dict) tuple: queue path and task
+    """
+    authorization, traceparent = _task_request_headers()
+
+    body = urllib.parse.urlencode(sorted(_task_params(params).items())).encode()
     task = {
         'app_engine_http_request': {
             'http_method': 'POST',
-            'relative_uri': path,
+            'relative_uri': f'/queue/{queue}',
             'body': body,
             'headers': {
                 'Content-Type': 'application/x-www-form-urlencoded',
-                'Authorization': (request.headers.get('Authorization', '')
-                                  if flask.has_request_context() else ''),
+                'Authorization': authorization,
                 # propagate trace id
                 # https://cloud.google.com/trace/docs/trace-context#http-requests
                 # https://stackoverflow.com/a/71343735/186123
@@ -371,14 +415,176 @@ def create_task(queue, app_id=GCP_PROJECT_ID, delay=None, **params):
         eta_seconds = int(util.to_utc_timestamp(util.now()) + delay.total_seconds())
         task['schedule_time'] = Timestamp(seconds=eta_seconds)
 
-    parent = tasks_client.queue_path(app_id, TASKS_LOCATION, queue)
-    task = tasks_client.create_task(parent=parent, task=task)
-    msg = f'Added {queue} {task.name.split("/")[-1]}'
-    if not traceparent:
+    return tasks_client.queue_path(app_id, TASKS_LOCATION, queue), task
+
+
+def _send_task(parent, task):
+    """Creates a task built by :func:`_build_task`. Thread safe.
+
+    Returns:
+      (str, int) tuple: response
+    """
+    created = tasks_client.create_task(parent=parent, task=task)
+    msg = f'Added {parent.split("/")[-1]} {created.name.split("/")[-1]}'
+    if not task['app_engine_http_request']['headers']['traceparent']:
         logger.info(msg)
     return msg, 202
 
 
+class TaskBatcher:
+    """Buffers Cloud Tasks and creates them concurrently, in batches.
+
+    Flushes when ``batch_size`` tasks are buffered, when the oldest buffered
+    task is ``max_wait`` old, or on :meth:`flush`. Each flush creates its tasks
+    concurrently on a shared thread pool. The tasks client's gRPC channel
+    multiplexes concurrent calls, so this turns N serial round trips into
+    roughly N / ``MAX_WORKERS``.
+
+    :meth:`add` returns a :class:`concurrent.futures.Future` for each task
+    that resolves to the same value :func:`create_task` returns, or raises the
+    same exception.
+
+    If running tasks inline, eg in unit tests, :meth:`add` runs each task
+    immediately, just like :func:`create_task`.
+
+    Thread safe. Usable as a context manager, which flushes and waits for all
+    pending tasks on exit::
+
+      with TaskBatcher() as batcher:
+          for target in targets:
+              batcher.add('send', url=target.uri)
+    """
+    MAX_WORKERS = 50
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, batch_size=100, max_wait=timedelta(seconds=1),
+                 keep_results=True):
+        """Constructor.
+
+        Args:
+          batch_size (int): flush when this many tasks are buffered
+          max_wait (datetime.timedelta): flush when the oldest buffered task is
+            this old
+          keep_results (bool): whether to keep every task's result for
+            :meth:`wait` to return. Long-lived batchers should set this to
+            False and use the Futures from :meth:`add` instead.
+        """
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.keep_results = keep_results
+        self.lock = threading.Lock()
+        self.buffer = []      # (str queue path, dict task, Future) tuples
+        self.pending = set()  # Futures that haven't finished yet
+        self.futures = []     # every task's Future, if keep_results
+        self.timer = None
+
+    @classmethod
+    def executor(cls):
+        with cls._executor_lock:
+            if not cls._executor:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.MAX_WORKERS,
+                                                   thread_name_prefix='TaskBatcher')
+            return cls._executor
+
+    def add(self, queue, app_id=GCP_PROJECT_ID, delay=None, **params):
+        """Buffers a task. Args are the same as :func:`create_task`.
+
+        Returns:
+          concurrent.futures.Future:
+        """
+        assert queue
+        future = Future()
+        if self.keep_results:
+            self.futures.append(future)
+
+        if RUN_TASKS_INLINE or appengine_info.LOCAL_SERVER:
+            try:
+                future.set_result(create_task(queue, app_id=app_id, delay=delay,
+                                              **params))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+
+        # build the task now, in the caller's request context, if any
+        parent, task = _build_task(queue, app_id=app_id, delay=delay, **params)
+        with self.lock:
+            self.buffer.append((parent, task, future))
+            self.pending.add(future)
+            full = len(self.buffer) >= self.batch_size
+            if not full and not self.timer:
+                self.timer = threading.Timer(self.max_wait.total_seconds(),
+                                             self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        # outside the lock since this may run the callback immediately
+        future.add_done_callback(self._done)
+
+        if full:
+            self.flush()
+
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def flush(self):
+        """Starts creating all buffered tasks. Doesn't wait for them to finish.
+        """
+        with self.lock:
+            buffer = self.buffer
+            self.buffer = []
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+        if not buffer:
+            return
+
+        logger.debug(f'Flushing {len(buffer)} tasks')
+        executor = self.executor()
+        for parent, task, future in buffer:
+            executor.submit(self._send, parent, task, future)
+
+    @staticmethod
+    def _send(parent, task, future):
+        try:
+            future.set_result(_send_task(parent, task))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def wait(self):
+        """Flushes, then waits for all pending tasks to be created.
+
+        Returns:
+          list: result of each task since the last :meth:`wait`, in the order
+          they were added, if ``keep_results`` is True, otherwise empty. If a
+          task failed, its element is the exception that it raised instead.
+        """
+        self.flush()
+        with self.lock:
+            pending = list(self.pending)
+        concurrent.futures.wait(pending)
+
+        results = []
+        for future in self.futures:
+            try:
+                results.append(future.result())
+            except BaseException as e:
+                results.append(e)
+
+        self.futures = []
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.wait()
+
+
 def report_exception(**kwargs):
     return report_error(msg=None, exception=True, **kwargs)
 
@@ -438,7 +644,7 @@ def cache_policy(key):
         # https://github.com/googleapis/python-ndb/issues/987
         key = key._key
 
-    return key and key.kind in ('AtpBlock', 'AtpSequence', 'Object')
+    return key and key.kind in ('AtpBlock', 'AtpSequence', 'CopyIndex', 'Object')
 
 
 def global_cache_policy(key):
@@ -532,3 +738,168 @@ def render_template(template, **kwargs):
         set=set,
         util=util,
         **kwargs)
+
+
+class CompactSet:
+    """Memory-efficient set of strings, eg DIDs, that only supports membership.
+
+    Stores a sorted :class:`array.array` of 64-bit hashes instead of the strings
+    themselves, so it uses 8 bytes per element instead of ~100 for a
+    :class:`set` of :class:`str`. Lookups are a binary search, so they're
+    slower than a set's, a few microseconds instead of a few hundred
+    nanoseconds. See ``scripts/benchmark_compact_set.py``. Adds and removes
+    go into small overlay sets that get merged into the array once they pass
+    ``COMPACT_THRESHOLD`` or 1/``COMPACT_RATIO`` of its size, whichever is
+    bigger. Big batches in :meth:`update` and :meth:`difference_update` are
+    merged directly.
+
+    Hash collisions mean membership checks can have false positives, but with
+    64-bit hashes they're vanishingly rare, about n / 2^64 per lookup, ie
+    around 1 in 2 trillion for 10M elements. Callers should only use this as a
+    filter, with an exact check downstream, eg loading the user.
+
+    Lookups are lock free and safe to run concurrently with writes.
+    """
+    COMPACT_THRESHOLD = 10000
+    COMPACT_RATIO = 16
+
+    def __init__(self, elems=()):
+        """Constructor.
+
+        Args:
+          elems (iterable of str): initial elements
+        """
+        self._lock = threading.Lock()
+        hashes = sorted(self._hash(e) for e in elems)
+        self._sorted = array('q', (h for h, _ in itertools.groupby(hashes)))
+        self._added = set()    # hashes not in _sorted
+        self._removed = set()  # hashes in _sorted that have been removed
+
+    @staticmethod
+    def _hash(elem):
+        # Python's built in string hash is 64 bits and cached on the string
+        # object. it's randomized per process, which is fine since this is only
+        # ever in memory.
+        return hash(elem)
+
+    def _in_sorted(self, hash):
+        arr = self._sorted
+        i = bisect_left(arr, hash)
+        return i < len(arr) and arr[i] == hash
+
+    def __contains__(self, elem):
+        if not isinstance(elem, str):
+            return False
+        hash = self._hash(elem)
+        return hash in self._added or (hash not in self._removed
+                                       and self._in_sorted(hash))
+
+    def __len__(self):
+        return len(self._sorted) + len(self._added) - len(self._removed)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def add(self, elem):
+        """Adds an element.
+
+        Args:
+          elem (str)
+        """
+        hash = self._hash(elem)
+        with self._lock:
+            self._add_hash(hash)
+            self._maybe_compact()
+
+    def update(self, elems):
+        """Adds multiple elements.
+
+        Big batches are sorted and merged into the array all at once, so bulk
+        loads take about as long as the constructor.
+
+        Args:
+          elems (iterable of str)
+        """
+        hashes = sorted(self._hash(e) for e in elems)
+        with self._lock:
+            if len(hashes) < self.COMPACT_THRESHOLD:
+                for hash in hashes:
+                    self._add_hash(hash)
+                self._maybe_compact()
+            else:
+                self._compact(added=hashes)
+
+    def discard(self, elem):
+        """Removes an element if it's present.
+
+        Args:
+          elem (str)
+        """
+        hash = self._hash(elem)
+        with self._lock:
+            self._discard_hash(hash)
+            self._maybe_compact()
+
+    def difference_update(self, elems):
+        """Removes multiple elements.
+
+        Like :meth:`update`, big batches are merged all at once.
+
+        Args:
+          elems (iterable of str)
+        """
+        hashes = {self._hash(e) for e in elems}
+        with self._lock:
+            if len(hashes) < self.COMPACT_THRESHOLD:
+                for hash in hashes:
+                    self._discard_hash(hash)
+                self._maybe_compact()
+            else:
+                self._compact(removed=hashes)
+
+    def _add_hash(self, hash):
+        """Must be called with ``_lock`` held."""
+        if hash in self._removed:
+            self._removed.discard(hash)
+        elif not self._in_sorted(hash):
+            self._added.add(hash)
+
+    def _discard_hash(self, hash):
+        """Must be called with ``_lock`` held."""
+        if hash in self._added:
+            self._added.discard(hash)
+        elif self._in_sorted(hash):
+            self._removed.add(hash)
+
+    def _maybe_compact(self):
+        """Merges the overlay sets into the sorted array if they're big enough.
+
+        Must be called with ``_lock`` held.
+        """
+        # scale with the array's size so that a stream of small updates costs
+        # amortized O(log n) per element, not O(n)
+        threshold = max(self.COMPACT_THRESHOLD,
+                        len(self._sorted) // self.COMPACT_RATIO)
+        if len(self._added) + len(self._removed) >= threshold:
+            self._compact()
+
+    def _compact(self, added=(), removed=frozenset()):
+        """Merges the overlay sets and an optional batch into the sorted array.
+
+        Must be called with ``_lock`` held.
+
+        Args:
+          added (sorted sequence of int): hashes to add
+          removed (set of int): hashes to remove
+        """
+        removed = self._removed | removed
+        kept = (filter(lambda h: h not in removed, self._sorted) if removed
+                else self._sorted)
+        # only sort the overlay, then merge it lazily into a new array so that
+        # we never hold the whole set as a list of Python ints
+        merged = heapq.merge(kept, sorted(self._added - removed), added)
+        # readers may briefly see a hash in both the new array and _added, or
+        # absent from the new array and still in _removed. both are consistent.
+        self._sorted = array('q', (h for h, _ in itertools.groupby(merged)))
+        self._added = set()
+        self._removed = set()
@@ -22,6 +22,7 @@ import pytz
 import activitypub, atproto, nostr, web
 import atproto_firehose
 import common
+import memcache
 import models
 import nostr_hub
 import pages
@@ -139,8 +140,10 @@ def hub_admin():
         gethostbyaddr=gethostbyaddr,
         len=len,
         lexrpc=lexrpc,
+        hosts=memcache.host_health(),
         nostr_hub=nostr_hub,
         pytz=pytz,
+        rsa_key_pool_depth=models.RsaKey.pool_depth(),
         util=util,
     )
 
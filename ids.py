@@ -3,6 +3,7 @@
 https://fed.brid.gy/docs#translate
 """
 import inspect
+import itertools
 import logging
 import re
 from threading import Lock
@@ -11,6 +12,8 @@ from urllib.parse import urljoin, urlparse
 from arroba.util import parse_at_uri
 from cachetools import cached, LRUCache
 from flask import request
+from google.cloud import ndb
+from google.cloud.ndb.key import _MAX_KEYPART_BYTES
 from google.cloud.ndb.query import FilterNode, Query
 from granary.bluesky import BSKY_APP_URL_RE, web_url_to_at_uri
 from oauth_dropins.webutil import util
@@ -100,7 +103,7 @@ def web_ap_base_domain(user_domain):
     return f'https://web{SUPERDOMAIN}/'
 
 
-def translate_user_id(*, id, from_, to):
+def translate_user_id(*, id, from_, to, users=None):
     """Translate a user id from one protocol to another.
 
     *NOTE*: unlike :func:`translate_object_id`, if ``to`` is a ``HAS_COPIES`` protocol
@@ -112,6 +115,9 @@ def translate_user_id(*, id, from_, to):
       id (str)
       from_ (protocol.Protocol)
       to (protocol.Protocol)
+      users (dict): optional, maps str id to preloaded :class:`models.User` or
+        None, eg from :func:`translate_multi`. If ``id`` is in it, we use it
+        instead of loading the user.
 
     Returns:
       str: the corresponding id in ``to``
@@ -155,7 +161,10 @@ def translate_user_id(*, id, from_, to):
         return id
 
     # follow use_instead
-    user = from_.get_by_id(id, allow_opt_out=True)
+    if users is not None and id in users:
+        user = users[id]
+    else:
+        user = from_.get_by_id(id, allow_opt_out=True)
     if user:
         id = user.key.id()
         if to.LABEL in COPIES_PROTOCOLS:
@@ -353,7 +362,7 @@ def translate_handle(*, handle, from_, to, enhanced):
     return output
 
 
-def translate_object_id(*, id, from_, to):
+def translate_object_id(*, id, from_, to, objs=None):
     """Translates a user handle from one protocol to another.
 
     *NOTE*: unlike :func:`translate_user_id`, if ``to`` is a ``HAS_COPIES`` protocol
@@ -365,6 +374,9 @@ def translate_object_id(*, id, from_, to):
       id (str)
       from_ (protocol.Protocol)
       to (protocol.Protocol)
+      objs (dict): optional, maps str id to preloaded :class:`models.Object` or
+        None, eg from :func:`translate_multi`. If ``id`` is in it, we use it
+        instead of loading the object.
 
     Returns:
       str: the corresponding id in ``to``
@@ -392,7 +404,11 @@ def translate_object_id(*, id, from_, to):
         return id
 
     if to.LABEL in COPIES_PROTOCOLS:
-        if obj := from_.load(id, remote=False):
+        if objs is not None and id in objs:
+            obj = objs[id]
+        else:
+            obj = from_.load(id, remote=False)
+        if obj:
             if copy := obj.get_copy(to):
                 return copy
 
@@ -418,6 +434,66 @@ def translate_object_id(*, id, from_, to):
     assert False, (id, from_.LABEL, to.LABEL)
 
 
+def translate_multi(*, user_ids=None, object_ids=None, to):
+    """Translates many user and object ids to one protocol at once.
+
+    Loads all of the users, objects, and :class:`models.CopyIndex` entries
+    that :func:`translate_user_id` and :func:`translate_object_id` need with a
+    single :func:`google.cloud.ndb.get_multi`, plus one more for users'
+    ``use_instead``, then translates each id. Ids that aren't found by their
+    raw keys fall back to the same loads as the single id functions.
+
+    Args:
+      user_ids (dict): maps str user id to :class:`protocol.Protocol` it's from
+      object_ids (dict): maps str object id to :class:`protocol.Protocol`
+        it's from
+      to (protocol.Protocol)
+
+    Returns:
+      (dict, dict) tuple: maps each user id and object id, respectively, to
+      its translated id
+    """
+    user_ids = user_ids or {}
+    object_ids = object_ids or {}
+
+    user_keys = {id: ndb.Key(from_._get_kind(), id)
+                 for id, from_ in user_ids.items()
+                 if from_ != to and from_.LABEL != 'ui'
+                 and len(id) <= _MAX_KEYPART_BYTES}
+    obj_keys = {}
+    if to.LABEL in COPIES_PROTOCOLS:
+        obj_keys = {id: ndb.Key(models.Object, id)
+                    for id, from_ in object_ids.items()
+                    if from_ != to and len(id) <= _MAX_KEYPART_BYTES}
+
+    # also warm the context cache with the CopyIndex entries that
+    # models.get_original_*_key read
+    index_keys = [models.CopyIndex.key_for(id)
+                  for id, from_ in itertools.chain(user_ids.items(),
+                                                   object_ids.items())
+                  if from_ != to and from_.LABEL in COPIES_PROTOCOLS]
+
+    keys = list(user_keys.values()) + list(obj_keys.values())
+    all_keys = keys + [key for key in index_keys if key]
+    loaded = dict(zip(all_keys, ndb.get_multi(all_keys))) if all_keys else {}
+
+    # only pass through entities we found. the translate_* functions load
+    # missing ones themselves, since eg ATProto.load and Web.load normalize
+    # ids first, so they may find entities that these raw ids' keys didn't.
+    users = {id: loaded[key] for id, key in user_keys.items()}
+    if use_instead := {id: user.use_instead for id, user in users.items()
+                       if user and user.use_instead}:
+        users.update(zip(use_instead.keys(),
+                         ndb.get_multi(use_instead.values())))
+    users = {id: user for id, user in users.items() if user}
+    objs = {id: loaded[key] for id, key in obj_keys.items() if loaded[key]}
+
+    return ({id: translate_user_id(id=id, from_=from_, to=to, users=users)
+             for id, from_ in user_ids.items()},
+            {id: translate_object_id(id=id, from_=from_, to=to, objs=objs)
+             for id, from_ in object_ids.items()})
+
+
 def handle_as_domain(handle):
     """Converts a handle to domain-like format.
 
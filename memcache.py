@@ -1,8 +1,13 @@
 """Utilities for caching data in memcache."""
+import concurrent.futures
+from datetime import timedelta
 import functools
 import logging
 import os
+from threading import Lock
+import time
 
+import cachetools
 import config
 from google.cloud.ndb._cache import global_cache_key
 from google.cloud.ndb.global_cache import _InProcessGlobalCache, MemcacheCache
@@ -18,6 +23,30 @@ KEY_MAX_LEN = 250
 
 MEMOIZE_VERSION = 2
 
+# how often memoize's local caches check their version stamps. see memoize
+LOCAL_STAMP_CHECK_INTERVAL = timedelta(seconds=10)
+
+FEED_EXPIRE = timedelta(hours=1)
+
+# host health, for outbound deliveries
+HOST_FAILURES_BEFORE_BACKOFF = 3
+HOST_BACKOFF_MIN = timedelta(minutes=1)
+HOST_BACKOFF_MAX = timedelta(hours=6)
+HOST_PROBE_TIMEOUT = timedelta(minutes=2)
+HOST_HEALTH_EXPIRE = timedelta(days=1)
+HOST_LATENCY_WEIGHT = .2  # for the exponentially weighted moving average
+
+# how long to remember failed remote loads, by failure type. see
+# record_load_failure
+LOAD_FAILURE_EXPIRE = {
+    '404': timedelta(hours=1),
+    '410': timedelta(days=1),
+    'empty': timedelta(hours=1),  # fetched but not usable, eg no mf2 or AS2
+    'too-big': timedelta(days=1),
+    'timeout': timedelta(minutes=5),
+    'error': timedelta(minutes=15),  # other HTTP or connection errors
+}
+
 # https://pymemcache.readthedocs.io/en/latest/apidoc/pymemcache.client.base.html#pymemcache.client.base.Client.__init__
 kwargs = {
     'server': os.environ.get('MEMCACHE_HOST', 'localhost'),
@@ -65,9 +94,34 @@ def memoize_key(fn, *args, _version=MEMOIZE_VERSION, **kwargs):
 
 NONE = ()  # empty tuple
 
-def memoize(expire=None, key=None, write=True, version=MEMOIZE_VERSION):
+_MISSING = object()
+
+
+def memoize(expire=None, key=None, write=True, version=MEMOIZE_VERSION,
+            local_size=None, local_ttl=None):
     """Memoize function decorator that stores the cached value in memcache.
 
+    Optionally also caches values in an in-process LRU cache in front of
+    memcache. Local values are keyed by ``key``'s return value if it returns
+    one, otherwise by the function's args. Concurrent calls in the same
+    process for the same key share a single lookup, so a cold hot key only
+    hits memcache and the function once.
+
+    The decorated function has these attributes:
+
+    * ``cache``: the local cache, or None
+    * ``cache_clear()``: clears the local cache
+    * ``many(args_list, executor=None)``: looks up many values at once, with
+      one memcache ``get_many`` and one ``set_many``
+    * ``peek(*args, **kwargs)``: returns the cached value for these args from
+      the local cache or memcache, or None if it's not cached. Never calls the
+      function.
+    * ``invalidate(*args, **kwargs)``: deletes the value for these args from
+      memcache and the local cache, and bumps this function's version stamp
+      in memcache. Other processes check the stamp every
+      :const:`LOCAL_STAMP_CHECK_INTERVAL` and clear their local caches when it
+      changes.
+
     Args:
       expire (datetime.timedelta): optional, expiration
       key (callable): function that takes the function's ``(*args, **kwargs)``
@@ -75,24 +129,67 @@ def memoize(expire=None, key=None, write=True, version=MEMOIZE_VERSION):
         used.
       write (bool or callable): whether to write to memcache. If this is a
         callable, it will be called with the function's ``(*args, **kwargs)``
-        and should return True or False.
+        and should return True or False. Doesn't affect the local cache.
       version (int): overrides our default version number in the memcache key.
         Bumping this version can have the same effect as clearing the cache for
         just the affected function.
+      local_size (int): optional, max number of values to cache locally. If
+        unset, doesn't cache locally.
+      local_ttl (datetime.timedelta): optional, expiration for the local cache
     """
     expire = int(expire.total_seconds()) if expire else 0
 
     def decorator(fn):
-        @functools.wraps(fn)
-        def wrapped(*args, **kwargs):
-            cache_key = None
+        local = None
+        if local_size:
+            local = (cachetools.TTLCache(local_size, local_ttl.total_seconds())
+                     if local_ttl else cachetools.LRUCache(local_size))
+        lock = Lock()
+        inflight = {}  # maps local key to Future
+        stamp_key = memoize_key(fn, 'stamp', _version=version)
+        stamp = None
+        stamp_checked = 0
+
+        def keys(args, kwargs):
+            """Returns (memcache key or None, local key) tuple."""
             if key:
                 key_val = key(*args, **kwargs)
                 if key_val:
-                    cache_key = memoize_key(fn, key_val, _version=version)
-            else:
-                cache_key = memoize_key(fn, *args, _version=version, **kwargs)
+                    return memoize_key(fn, key_val, _version=version), key_val
+
+            cache_key = (None if key
+                         else memoize_key(fn, *args, _version=version, **kwargs))
+            return cache_key, cachetools.keys.hashkey(*args, **kwargs)
+
+        def check_stamp():
+            """Clears the local cache if the version stamp changed.
+
+            Fetches the stamp outside the lock, so that other callers don't
+            wait on memcache, and only takes it to claim the check and to
+            compare and swap.
+            """
+            nonlocal stamp, stamp_checked
 
+            interval = LOCAL_STAMP_CHECK_INTERVAL.total_seconds()
+            now = time.monotonic()
+            if not memcache or now - stamp_checked < interval:
+                return
+
+            with lock:
+                # another caller may have claimed this check already
+                if now - stamp_checked < interval:
+                    return
+                stamp_checked = now
+
+            latest = memcache.get(stamp_key)
+
+            with lock:
+                if latest != stamp:
+                    logger.debug(f'{stamp_key} changed, clearing local cache')
+                    local.clear()
+                    stamp = latest
+
+        def call(cache_key, args, kwargs):
             if pickle_memcache and cache_key:
                 val = pickle_memcache.get(cache_key)
                 if val is not None:
@@ -113,6 +210,145 @@ def memoize(expire=None, key=None, write=True, version=MEMOIZE_VERSION):
 
             return val
 
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            cache_key, local_key = keys(args, kwargs)
+            if local is None:
+                return call(cache_key, args, kwargs)
+
+            check_stamp()
+            with lock:
+                if (val := local.get(local_key, _MISSING)) is not _MISSING:
+                    return val
+
+                future = inflight.get(local_key)
+                leader = future is None
+                if leader:
+                    future = inflight[local_key] = concurrent.futures.Future()
+                started = stamp
+
+            if not leader:
+                return future.result()
+
+            try:
+                val = call(cache_key, args, kwargs)
+            except BaseException as e:
+                with lock:
+                    del inflight[local_key]
+                future.set_exception(e)
+                raise
+
+            with lock:
+                if stamp == started:
+                    local[local_key] = val
+                del inflight[local_key]
+
+            future.set_result(val)
+            return val
+
+        def many(args_list, executor=None):
+            """Looks up many values at once.
+
+            Checks the local cache, then memcache with a single ``get_many``,
+            then calls the function for the remaining misses and writes them
+            back with a single ``set_many``.
+
+            Args:
+              args_list (sequence of tuple): positional args for each call
+              executor (concurrent.futures.Executor): optional, calls the
+                function for misses in parallel on this executor. The
+                function needs to be safe to run there, eg it needs its own
+                ndb context if it uses ndb.
+
+            Returns:
+              list: values, in the same order as ``args_list``
+            """
+            args_list = [tuple(args) for args in args_list]
+            keys_list = [keys(args, {}) for args in args_list]
+            cache_keys = dict((local_key, cache_key)
+                              for cache_key, local_key in keys_list)
+            vals = {}  # maps local key to value
+
+            if local is not None:
+                check_stamp()
+                with lock:
+                    for local_key in cache_keys:
+                        if (val := local.get(local_key, _MISSING)) is not _MISSING:
+                            vals[local_key] = val
+            local_hits = set(vals)
+
+            to_get = {cache_key: local_key for local_key, cache_key
+                      in cache_keys.items() if cache_key and local_key not in vals}
+            if pickle_memcache and to_get:
+                for cache_key, val in pickle_memcache.get_many(list(to_get)).items():
+                    if val is not None:
+                        vals[to_get[cache_key]] = None if val == NONE else val
+
+            misses = {}  # maps local key to args
+            for args, (_, local_key) in zip(args_list, keys_list):
+                if local_key not in vals:
+                    misses.setdefault(local_key, args)
+
+            logger.debug(f'{fn.__qualname__}: {len(cache_keys)} keys, '
+                         f'{len(local_hits)} local hits, {len(misses)} misses')
+
+            if misses:
+                map_fn = executor.map if executor else map
+                vals.update(zip(misses.keys(),
+                                map_fn(lambda args: fn(*args), misses.values())))
+
+                to_set = {}
+                for local_key, args in misses.items():
+                    cache_key = cache_keys[local_key]
+                    if cache_key and (write if isinstance(write, bool)
+                                      else write(*args)):
+                        val = vals[local_key]
+                        to_set[cache_key] = NONE if val is None else val
+                if pickle_memcache and to_set:
+                    pickle_memcache.set_many(to_set, expire=expire)
+
+            if local is not None and len(vals) > len(local_hits):
+                with lock:
+                    local.update((local_key, val) for local_key, val in vals.items()
+                                 if local_key not in local_hits)
+
+            return [vals[local_key] for _, local_key in keys_list]
+
+        def cache_clear():
+            if local is not None:
+                with lock:
+                    local.clear()
+
+        def peek(*args, **kwargs):
+            cache_key, local_key = keys(args, kwargs)
+            if local is not None:
+                with lock:
+                    if (val := local.get(local_key, _MISSING)) is not _MISSING:
+                        return val
+
+            if pickle_memcache and cache_key:
+                val = pickle_memcache.get(cache_key)
+                if val is not None and val != NONE:
+                    return val
+
+        def invalidate(*args, **kwargs):
+            cache_key, local_key = keys(args, kwargs)
+            if pickle_memcache and cache_key:
+                pickle_memcache.delete(cache_key)
+
+            if memcache and memcache.incr(stamp_key, 1) is None:
+                memcache.add(stamp_key, 0)
+                memcache.incr(stamp_key, 1)
+
+            if local is not None:
+                with lock:
+                    local.pop(local_key, None)
+
+        wrapped.cache = local
+        wrapped.cache_clear = cache_clear
+        wrapped.invalidate = invalidate
+        wrapped.peek = peek
+        wrapped.many = many
         return wrapped
 
     return decorator
@@ -121,18 +357,25 @@ def memoize(expire=None, key=None, write=True, version=MEMOIZE_VERSION):
 def evict(entity_key):
     """Evict a datastore entity from memcache.
 
-    For :class:`models.User` and :class:`models.Object` entities, also clears their
-    copies from the :func:`models.get_original_user_key` and
-    :func:`models.get_original_object_key` memoize caches.
+    For :class:`models.User` and :class:`models.Object` entities, also evicts
+    their copies' :class:`models.CopyIndex` entries. For :class:`models.Object`
+    entities, also clears them from this process's local cache,
+    :attr:`models.object_local_cache`.
 
     Args:
       entity_key (google.cloud.ndb.Key)
     """
+    from models import CopyIndex, Object
+
+    keys = [entity_key]
     if entity := entity_key.get():
-        for val in getattr(entity, 'copies'):
-            entity.clear_get_original_cache(val.uri)
+        keys.extend(filter(None, (CopyIndex.key_for(val.uri)
+                                  for val in getattr(entity, 'copies'))))
 
-    global_cache.delete([global_cache_key(entity_key._key)])
+    if entity_key.kind() == 'Object':
+        Object.clear_local_cache(entity_key.id())
+
+    global_cache.delete([global_cache_key(key._key) for key in keys])
 
 
 def remote_evict(entity_key):
@@ -151,6 +394,221 @@ def remote_evict(entity_key):
                               data={'key': entity_key.urlsafe()})
 
 
+def append_to_feed(feed, value, expire=FEED_EXPIRE):
+    """Appends a value to a change feed in memcache.
+
+    Feeds are lightweight, ordered, and lossy. Each entry gets a sequence number
+    from an ``incr``ed counter. Entries expire after ``expire`` and memcache may
+    evict them early, so readers should fall back to reconciling against the
+    datastore when :func:`read_feed` says they missed some.
+
+    Args:
+      feed (str): feed name
+      value: anything picklable
+      expire (datetime.timedelta): how long to keep this entry
+
+    Returns:
+      int: this entry's sequence number
+    """
+    seq_key = key(f'feed-{feed}')
+    seq = memcache.incr(seq_key, 1)
+    if seq is None:
+        memcache.add(seq_key, 0)
+        seq = memcache.incr(seq_key, 1)
+
+    pickle_memcache.set(key(f'feed-{feed}-{seq}'), value,
+                        expire=int(expire.total_seconds()))
+    return int(seq)
+
+
+def read_feed(feed, after=None, limit=1000):
+    """Reads new entries from a change feed written by :func:`append_to_feed`.
+
+    Args:
+      feed (str): feed name
+      after (int): last sequence number the caller has read. If None, doesn't
+        return any entries, just the current sequence number, so that callers
+        can start reading from now.
+      limit (int): maximum number of entries to read. If there are more, the
+        oldest are skipped and reported as missed.
+
+    Returns:
+      (list, int, bool) tuple: values, in order; the last sequence number, to
+      pass back in as ``after`` next time; and False if any entries since
+      ``after`` were missed, eg expired or evicted or the feed was reset,
+      otherwise True.
+    """
+    seq = int(memcache.get(key(f'feed-{feed}')) or 0)
+    if after is None or seq == after:
+        return [], seq, True
+    elif seq < after:
+        # counter was reset, eg memcache restarted
+        return [], seq, False
+
+    start = max(after + 1, seq - limit + 1)
+    keys = [key(f'feed-{feed}-{i}') for i in range(start, seq + 1)]
+    got = pickle_memcache.get_many(keys)
+    values = [got[k] for k in keys if k in got]
+    return values, seq, start == after + 1 and len(values) == len(keys)
+
+
+def record_host_request(host, ok, latency=None):
+    """Records the result of an outbound request to a host.
+
+    Each host has a pickled dict in memcache with ``failures`` (consecutive),
+    ``latency`` (moving average, in seconds), ``last_ok``, ``last_failure``, and
+    ``retry_after``. After :const:`HOST_FAILURES_BEFORE_BACKOFF` consecutive
+    failures, we back off from the host exponentially, from
+    :const:`HOST_BACKOFF_MIN` up to :const:`HOST_BACKOFF_MAX`. Read-modify-write,
+    not atomic, so concurrent results may get lost, which is fine.
+
+    Args:
+      host (str): domain
+      ok (bool): False if the host failed, eg connection error, timeout, or 5xx
+      latency (float): optional, request duration in seconds
+    """
+    health_key = key(f'host-health-{host}')
+    health = pickle_memcache.get(health_key) or {'failures': 0}
+    now = util.now()
+
+    if latency is not None:
+        prev = health.get('latency')
+        health['latency'] = (latency if prev is None else
+                             prev + (latency - prev) * HOST_LATENCY_WEIGHT)
+
+    if ok:
+        if health['failures']:
+            logger.info(f'{host} is back up after {health["failures"]} failures')
+            memcache.delete(key(f'host-probe-{host}'))
+        health.update({'failures': 0, 'last_ok': now, 'retry_after': None})
+    else:
+        health['failures'] += 1
+        health['last_failure'] = now
+        backoffs = health['failures'] - HOST_FAILURES_BEFORE_BACKOFF
+        if backoffs >= 0:
+            backoff = min(HOST_BACKOFF_MIN * 2 ** backoffs, HOST_BACKOFF_MAX)
+            health['retry_after'] = now + backoff
+            logger.info(f'{host} failed {health["failures"]} times, backing off until {health["retry_after"]}')
+            memcache.delete(key(f'host-probe-{host}'))
+            if backoffs == 0:
+                # index for host_health
+                hosts_key = key('host-health-hosts')
+                memcache.add(hosts_key, '',
+                             expire=int(HOST_HEALTH_EXPIRE.total_seconds()))
+                memcache.append(hosts_key, f'{host} ')
+
+    pickle_memcache.set(health_key, health,
+                        expire=int(HOST_HEALTH_EXPIRE.total_seconds()))
+
+
+def hosts_retry_after(hosts):
+    """Returns which hosts we're backing off from, and until when.
+
+    Once a host's backoff has passed, the first caller gets to send a probe
+    request, and other callers keep backing off for up to
+    :const:`HOST_PROBE_TIMEOUT`, until the probe's result is recorded.
+
+    Args:
+      hosts (iterable of str): domains
+
+    Returns:
+      dict: maps str host to :class:`datetime.datetime` to try again after.
+      Only includes hosts that we're backing off from.
+    """
+    keys = {key(f'host-health-{host}'): host for host in set(hosts)}
+    now = util.now()
+
+    down = {}
+    for health_key, health in pickle_memcache.get_many(keys).items():
+        host = keys[health_key]
+        if retry_after := health.get('retry_after'):
+            if retry_after > now:
+                down[host] = retry_after
+            elif not memcache.add(key(f'host-probe-{host}'), 1, noreply=False,
+                                  expire=int(HOST_PROBE_TIMEOUT.total_seconds())):
+                # someone else is already probing
+                down[host] = now + HOST_PROBE_TIMEOUT
+            else:
+                logger.info(f'Probing {host}')
+
+    return down
+
+
+def host_health():
+    """Returns the health of hosts that we've backed off from recently.
+
+    Returns:
+      dict: maps str host to dict health, sorted by host. See
+      :func:`record_host_request` for details.
+    """
+    hosts = (memcache.get(key('host-health-hosts')) or b'').decode().split()
+    keys = {key(f'host-health-{host}'): host for host in set(hosts)}
+    got = pickle_memcache.get_many(keys)
+    return {keys[k]: got[k] for k in sorted(got, key=lambda k: keys[k])}
+
+
+def _load_failure_key(id, protocol):
+    return key(f'load-failure-{protocol} {id}')
+
+
+def record_load_failure(id, protocol, failure):
+    """Remembers that fetching an id over the network failed.
+
+    :meth:`protocol.Protocol.load` and :meth:`protocol.Protocol.for_id` use this
+    to avoid refetching dead URLs, deleted posts, etc. over and over.
+
+    Args:
+      id (str)
+      protocol (str): label of the protocol that tried to fetch it
+      failure (str): failure type, a key in :const:`LOAD_FAILURE_EXPIRE`
+    """
+    expire = LOAD_FAILURE_EXPIRE[failure]
+    pickle_memcache.set(_load_failure_key(id, protocol), failure,
+                        expire=int(expire.total_seconds()), noreply=True)
+
+
+def load_failure(id, protocol):
+    """Returns the type of a recent failure to fetch an id, or None.
+
+    Args:
+      id (str)
+      protocol (str): label of the protocol that tried to fetch it
+
+    Returns:
+      str: a key in :const:`LOAD_FAILURE_EXPIRE`, or None if we haven't
+      recently failed to fetch this id
+    """
+    return pickle_memcache.get(_load_failure_key(id, protocol))
+
+
+def load_failures(id, protocols):
+    """Returns recent failures to fetch an id with multiple protocols.
+
+    Args:
+      id (str)
+      protocols (sequence of str): protocol labels
+
+    Returns:
+      dict: maps protocol label to a key in :const:`LOAD_FAILURE_EXPIRE`, only
+      for the protocols that recently failed to fetch this id
+    """
+    keys = {_load_failure_key(id, protocol): protocol for protocol in protocols}
+    if not keys:
+        return {}
+    return {keys[key]: failure
+            for key, failure in pickle_memcache.get_many(list(keys)).items()}
+
+
+def clear_load_failure(id, protocol):
+    """Forgets a failure recorded by :func:`record_load_failure`, if any.
+
+    Args:
+      id (str)
+      protocol (str): label of the protocol that tried to fetch it
+    """
+    pickle_memcache.delete(_load_failure_key(id, protocol), noreply=True)
+
+
 ###########################################
 
 # https://github.com/googleapis/python-ndb/issues/743#issuecomment-2067590945
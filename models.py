@@ -1,10 +1,11 @@
 """Datastore model classes."""
 import copy
 from datetime import timedelta, timezone
-from functools import lru_cache
+from hashlib import sha1
 import itertools
 import json
 import logging
+import os
 import random
 import re
 from threading import Lock
@@ -14,8 +15,11 @@ from arroba.util import parse_at_uri
 import cachetools
 from Crypto.PublicKey import RSA
 from flask import request
+from google.api_core.exceptions import Aborted
+from google.cloud.datastore_v1.types import entity as entity_pb2
 from google.cloud import ndb
 from google.cloud.ndb.key import _MAX_KEYPART_BYTES
+from google.cloud.ndb.model import _entity_from_protobuf, _entity_to_protobuf
 from granary import as1, as2, atom, bluesky, microformats2
 from granary.bluesky import AT_URI_PATTERN, BSKY_APP_URL_RE
 import granary.nostr
@@ -23,7 +27,7 @@ from granary.source import html_to_text
 import humanize
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.appengine_info import DEBUG
-from oauth_dropins.webutil.flask_util import error
+from oauth_dropins.webutil.flask_util import cloud_tasks_only, error
 from oauth_dropins.webutil.models import JsonProperty, StringIdModel
 from oauth_dropins.webutil.util import ellipsize, json_dumps, json_loads
 from requests import RequestException
@@ -73,6 +77,10 @@ PROTOCOLS_BY_KIND = {}
 
 # 2048 bits makes tests slow, so use 1024 for them
 KEY_BITS = 1024 if DEBUG else 2048
+# pregenerated keys to keep in the pool, see RsaKey
+RSA_KEY_POOL_SIZE = int(os.environ.get('RSA_KEY_POOL_SIZE', 200))
+# max keys to generate per refill_rsa_key_pool_task run
+RSA_KEY_POOL_REFILL_BATCH = 50
 PAGE_SIZE = 20
 
 # auto delete most old objects via the Object.expire property
@@ -84,8 +92,63 @@ DONT_EXPIRE_OBJECT_TYPES = (as1.ACTOR_TYPES | as1.POST_TYPES
                             | set(['block', 'flag', 'follow', 'like', 'share']))
 OBJECT_EXPIRE_AGE = timedelta(days=90)
 
-GET_ORIGINALS_CACHE_EXPIRATION = timedelta(days=1)
+# for users whose FollowerCounters aren't initialized yet, see
+# FollowerCounter.get_count
 FOLLOWERS_CACHE_EXPIRATION = timedelta(hours=2)
+FOLLOWERS_FALLBACK_COUNT_LIMIT = 1001
+
+# how long to keep FanoutClaims, ie how long fanout tasks for an activity can
+# keep retrying
+FANOUT_CLAIM_EXPIRE = timedelta(days=1)
+
+# Object.as1 is converted from these attributes. Assigning any of them clears
+# its cached value.
+AS1_INPUTS = frozenset(('as2', 'bsky', 'key', 'mf2', 'nostr', 'our_as1',
+                        'source_protocol'))
+
+# rough sizes for Object.estimate_size. KEY_OVERHEAD_SIZE is per key or
+# structured property value, ENTITY_OVERHEAD_SIZE covers everything else:
+# the entity key, timestamps, booleans, property names, etc.
+KEY_OVERHEAD_SIZE = 64
+ENTITY_OVERHEAD_SIZE = 512
+
+# in-process cache of recently loaded Objects, for Object.get_by_id_cached.
+# maps str id to serialized Entity protobuf. local puts and deletes evict from
+# it, as does memcache.evict, but puts in other processes don't, so keep this
+# short.
+OBJECT_LOCAL_CACHE_EXPIRATION = timedelta(seconds=30)
+object_local_cache = cachetools.TTLCache(
+    5000, OBJECT_LOCAL_CACHE_EXPIRATION.total_seconds())
+object_local_cache_lock = Lock()
+
+# in-process cache of the NostrPubkey state that we last wrote or read for each
+# user, so that User._post_put_hook only touches NostrPubkey when it changes.
+# maps User key to (pubkey, native, active) tuple. changes in other processes
+# don't update it, so keep this short.
+NOSTR_PUBKEY_SYNCED_EXPIRATION = timedelta(minutes=5)
+nostr_pubkey_synced = cachetools.TTLCache(
+    100000, NOSTR_PUBKEY_SYNCED_EXPIRATION.total_seconds())
+nostr_pubkey_synced_lock = Lock()
+
+# in-process cache of the DID_CHANGES_FEED entry that we last appended for each
+# ATProto user, so that User._post_put_hook only appends when it changes. maps
+# User key to bool enabled. changes in other processes don't update it, so keep
+# this short. the firehose's periodic reload catches anything it misses.
+DID_CHANGES_SYNCED_EXPIRATION = timedelta(minutes=5)
+did_changes_synced = cachetools.TTLCache(
+    100000, DID_CHANGES_SYNCED_EXPIRATION.total_seconds())
+did_changes_synced_lock = Lock()
+# in-process cache of get_original_user_key and get_original_object_key.
+# AddRemoveMixin evicts from it locally, but adds and removes in other processes
+# don't, so keep this short.
+GET_ORIGINALS_CACHE_EXPIRATION = timedelta(minutes=5)
+
+# whether every existing copy has a CopyIndex entry. until then, ie before and
+# during scripts/backfill_copy_index.py, and while old instances that don't
+# write CopyIndex are still running, get_original_user_key and
+# get_original_object_key fall back to querying copies.uri when the index
+# misses. set to True once the backfill has finished after that deploy.
+COPY_INDEX_BACKFILLED = False
 
 # See https://www.cloudimage.io/
 IMAGE_PROXY_URL_BASE = 'https://aujtzahimq.cloudimg.io/v7/'
@@ -207,13 +270,119 @@ def reset_protocol_properties():
                                  if proto and proto.HAS_COPIES)
 
 
-@lru_cache(maxsize=100000)
-@memcache.memoize(expire=GET_ORIGINALS_CACHE_EXPIRATION)
+class CopyIndex(ndb.Model):
+    """Reverse index from copy ids to the users and objects they're copies of.
+
+    Key id is the copy's :attr:`Target.uri`, eg an ATProto DID or ``at://`` URI.
+    Lets :func:`get_original_user_key` and :func:`get_original_object_key` look
+    up originals with key reads, which batch and cache, instead of queries on
+    ``copies.uri``.
+
+    Only written by :meth:`AddRemoveMixin.add` and
+    :meth:`AddRemoveMixin.remove`, so always use those to change ``copies``,
+    not put hooks, since they'd cost an extra read on every put. Backfill
+    with ``scripts/backfill_copy_index.py``, then set
+    :const:`COPY_INDEX_BACKFILLED`.
+    """
+    user = ndb.KeyProperty()
+    object = ndb.KeyProperty()
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    ''
+    updated = ndb.DateTimeProperty(auto_now=True)
+    ''
+
+    @staticmethod
+    def key_for(uri):
+        """Returns the index key for a copy id, or None if it's too long.
+
+        Args:
+          uri (str)
+
+        Returns:
+          google.cloud.ndb.Key or None
+        """
+        if uri and len(uri.encode()) <= _MAX_KEYPART_BYTES:
+            return ndb.Key(CopyIndex, uri)
+
+    @staticmethod
+    def _field(orig):
+        return 'object' if orig.kind() == 'Object' else 'user'
+
+    @classmethod
+    @ndb.transactional()
+    def add(cls, uri, orig):
+        """Points a copy id at its original.
+
+        Args:
+          uri (str)
+          orig (google.cloud.ndb.Key): :class:`User` or :class:`Object` key
+        """
+        if not (key := cls.key_for(uri)):
+            return
+
+        entry = key.get() or cls(key=key)
+        if getattr(entry, cls._field(orig)) != orig:
+            setattr(entry, cls._field(orig), orig)
+            entry.put()
+
+    @classmethod
+    @ndb.transactional()
+    def remove(cls, uri, orig):
+        """Removes a copy id's pointer to its original, if it's still there.
+
+        Args:
+          uri (str)
+          orig (google.cloud.ndb.Key): :class:`User` or :class:`Object` key
+        """
+        if not (key := cls.key_for(uri)) or not (entry := key.get()):
+            return
+
+        if getattr(entry, cls._field(orig)) == orig:
+            setattr(entry, cls._field(orig), None)
+            if entry.user or entry.object:
+                entry.put()
+            else:
+                key.delete()
+
+    @classmethod
+    def update_for(cls, *entities):
+        """Creates or updates index entries for entities' copies if necessary.
+
+        Used by ``scripts/backfill_copy_index.py``.
+
+        Args:
+          entities (sequence of User or Object)
+        """
+        origs = {}
+        for entity in entities:
+            for copy in entity.copies:
+                if key := cls.key_for(copy.uri):
+                    origs[key] = entity.key
+
+        if not origs:
+            return
+
+        changed = []
+        for (key, orig), entry in zip(origs.items(), ndb.get_multi(origs.keys())):
+            entry = entry or cls(key=key)
+            if getattr(entry, cls._field(orig)) != orig:
+                setattr(entry, cls._field(orig), orig)
+                changed.append(entry)
+
+        if changed:
+            ndb.put_multi(changed)
+
+
+@cachetools.cached(cachetools.TTLCache(
+    100000, GET_ORIGINALS_CACHE_EXPIRATION.total_seconds()), lock=Lock())
 def get_original_object_key(copy_id):
     """Finds the :class:`Object` with a given copy id, if any.
 
-    Note that :meth:`Object.add` also updates this function's
-    :func:`memcache.memoize` cache.
+    Reads :class:`CopyIndex`. Falls back to querying ``copies.uri`` if the copy
+    id is too long to be a key id, or if the index doesn't have it and
+    :const:`COPY_INDEX_BACKFILLED` is False, in which case it also writes the
+    missing index entry.
 
     Args:
       copy_id (str)
@@ -223,16 +392,28 @@ def get_original_object_key(copy_id):
     """
     assert copy_id
 
-    return Object.query(Object.copies.uri == copy_id).get(keys_only=True)
+    if key := CopyIndex.key_for(copy_id):
+        entry = key.get()
+        if entry and entry.object:
+            return entry.object
+        elif COPY_INDEX_BACKFILLED:
+            return None
+
+    orig = Object.query(Object.copies.uri == copy_id).get(keys_only=True)
+    if orig and key:
+        CopyIndex.add(copy_id, orig)
+    return orig
 
 
-@lru_cache(maxsize=100000)
-@memcache.memoize(expire=GET_ORIGINALS_CACHE_EXPIRATION)
+@cachetools.cached(cachetools.TTLCache(
+    100000, GET_ORIGINALS_CACHE_EXPIRATION.total_seconds()), lock=Lock())
 def get_original_user_key(copy_id):
     """Finds the user with a given copy id, if any.
 
-    Note that :meth:`User.add` also updates this function's
-    :func:`memcache.memoize` cache.
+    Reads :class:`CopyIndex`. Falls back to querying ``copies.uri`` if the copy
+    id is too long to be a key id, or if the index doesn't have it and
+    :const:`COPY_INDEX_BACKFILLED` is False, in which case it also writes the
+    missing index entry.
 
     Args:
       copy_id (str)
@@ -242,19 +423,34 @@ def get_original_user_key(copy_id):
     """
     assert copy_id
 
+    if key := CopyIndex.key_for(copy_id):
+        entry = key.get()
+        if entry and entry.user:
+            return entry.user
+        elif COPY_INDEX_BACKFILLED:
+            return None
+
     for proto in PROTOCOLS.values():
         if proto and proto.LABEL != 'ui' and not proto.owns_id(copy_id):
             if orig := proto.query(proto.copies.uri == copy_id).get(keys_only=True):
+                if key:
+                    CopyIndex.add(copy_id, orig)
                 return orig
 
 
 class AddRemoveMixin:
     """Mixin class that defines the :meth:`add` and :meth:`remove` methods.
 
-    If a subclass of this mixin defines the ``GET_ORIGINAL_FN`` class-level
-    attribute, its memoize cache will be cleared when :meth:`remove` is called with
-    the ``copies`` property.
+    Adding to and removing from the ``copies`` property also updates
+    :class:`CopyIndex` and evicts the copy from this process's
+    :func:`get_original_user_key` or :func:`get_original_object_key` cache.
+
+    The index write is in its own transaction, immediately, not atomic with
+    storing this entity, which usually happens later. If that put fails, or
+    never happens, the index points at an original that doesn't have the copy
+    until the next :meth:`add` or :meth:`remove` of it fixes it.
     """
+    GET_ORIGINAL_FN = None
 
     def add(self, prop, val):
         """Adds a value to a multiply-valued property. Uses ``self.lock``.
@@ -269,10 +465,9 @@ class AddRemoveMixin:
         with self.lock:
             added = util.add(getattr(self, prop), val)
 
-        if prop == 'copies' and added:
-            if fn := getattr(self, 'GET_ORIGINAL_FN'):
-                memcache.pickle_memcache.set(memcache.memoize_key(fn, val.uri),
-                                             self.key)
+        if prop == 'copies' and added and self.key:
+            CopyIndex.add(val.uri, self.key)
+            self._evict_get_original(val.uri)
 
         return added
 
@@ -288,13 +483,15 @@ class AddRemoveMixin:
             if val in existing:
                 existing.remove(val)
 
-        if prop == 'copies':
-            self.clear_get_original_cache(val.uri)
+        if prop == 'copies' and self.key:
+            CopyIndex.remove(val.uri, self.key)
+            self._evict_get_original(val.uri)
 
     @classmethod
-    def clear_get_original_cache(cls, uri):
-        if fn := getattr(cls, 'GET_ORIGINAL_FN'):
-            memcache.pickle_memcache.delete(memcache.memoize_key(fn, uri))
+    def _evict_get_original(cls, uri):
+        if fn := cls.GET_ORIGINAL_FN:
+            with fn.cache_lock:
+                fn.cache.pop(fn.cache_key(uri), None)
 
 
 class User(StringIdModel, AddRemoveMixin, metaclass=ProtocolUserMeta):
@@ -388,6 +585,33 @@ class User(StringIdModel, AddRemoveMixin, metaclass=ProtocolUserMeta):
     def _post_put_hook(self, future):
         logger.debug(f'Wrote {self.key}')
 
+        if self.LABEL == 'atproto':
+            # tell the firehose to start or stop handling this user's commits.
+            # keep in sync with atproto_firehose._load_dids's query!
+            # best effort. if this fails, the firehose's periodic reload,
+            # every RECONCILE_DIDS_FREQ, picks up the change instead.
+            enabled = self.status is None and bool(self.enabled_protocols)
+            with did_changes_synced_lock:
+                changed = did_changes_synced.get(self.key) != enabled
+
+            if changed:
+                try:
+                    memcache.append_to_feed(common.DID_CHANGES_FEED,
+                                            ('atproto', self.key.id(), enabled))
+                    with did_changes_synced_lock:
+                        did_changes_synced[self.key] = enabled
+                except BaseException as e:
+                    logger.warning(f"Couldn't append {self.key.id()} to DID changes feed: {e}",
+                                   exc_info=True)
+
+        # tell nostr_hub to start or stop subscribing to this user's pubkey.
+        # best effort, since this user is already stored.
+        try:
+            NostrPubkey.update_for(self)
+        except BaseException as e:
+            logger.warning(f"Couldn't update {self.key.id()}'s NostrPubkey: {e}",
+                           exc_info=True)
+
     @classmethod
     def get_by_id(cls, id, allow_opt_out=False, **kwargs):
         """Override to follow ``use_instead`` property and ``status``.
@@ -496,17 +720,20 @@ class User(StringIdModel, AddRemoveMixin, metaclass=ProtocolUserMeta):
             if (not user.public_exponent or not user.private_exponent or not user.mod):
                 assert (not user.public_exponent and not user.private_exponent
                         and not user.mod), id
-                key = RSA.generate(KEY_BITS,
-                                   randfunc=random.randbytes if DEBUG else None)
-                user.mod = long_to_base64(key.n)
-                user.public_exponent = long_to_base64(key.e)
-                user.private_exponent = long_to_base64(key.d)
+                key = RsaKey.claim() or RsaKey.generate()
+                user.mod = key.mod
+                user.public_exponent = key.public_exponent
+                user.private_exponent = key.private_exponent
 
         try:
             user.put()
         except AssertionError as e:
             error(f'Bad {cls.__name__} id {id} : {e}')
 
+        if not user.existing:
+            FollowerCounter.create(user.key)
+            FollowerTarget.create(user.key)
+
         logger.debug(('Updated ' if user.existing else 'Created new ') + str(user))
         return user
 
@@ -905,6 +1132,9 @@ Welcome to Bridgy Fed! Your account will soon be bridged to {to_proto.PHRASE} at
         # write the user so that we re-populate any computed properties
         self.put()
 
+        # their delivery target may have changed
+        Follower.update_targets(self)
+
     def user_page_path(self, rest=None, prefer_id=False):
         """Returns the user's Bridgy Fed user page path.
 
@@ -1001,31 +1231,23 @@ Welcome to Bridgy Fed! Your account will soon be bridged to {to_proto.PHRASE} at
         if self.obj and self.obj.as1:
             return util.get_url(self.obj.as1, 'image')
 
-    # can't use functools.lru_cache here because we want the cache key to be
-    # just the user id, not the whole entity
-    @cachetools.cached(
-        cachetools.TTLCache(50000, FOLLOWERS_CACHE_EXPIRATION.total_seconds()),
-        key=lambda user: user.key.id(), lock=Lock())
-    @memcache.memoize(key=lambda self: self.key.id(),
-                      expire=FOLLOWERS_CACHE_EXPIRATION)
     def count_followers(self):
         """Counts this user's followers and followings.
 
+        Reads their :class:`FollowerCounter`\\s, which are cheap enough that we
+        don't cache them.
+
         Returns:
-          (int, int) tuple: (number of followers, number following)
+          (int, int) tuple: (number of followers, number following). Either may
+          be None if we don't know it yet, see :meth:`FollowerCounter.get_count`.
         """
         if self.key.id() in PROTOCOL_DOMAINS:
             # we don't store Followers for protocol bot users any more, so
             # follower counts are inaccurate, so don't return them
             return (0, 0)
 
-        num_followers = Follower.query(Follower.to == self.key,
-                                       Follower.status == 'active')\
-                                .count_async()
-        num_following = Follower.query(Follower.from_ == self.key,
-                                       Follower.status == 'active')\
-                                .count_async()
-        return num_followers.get_result(), num_following.get_result()
+        return (FollowerCounter.get_count(self.key, 'followers'),
+                FollowerCounter.get_count(self.key, 'following'))
 
 
 class Object(StringIdModel, AddRemoveMixin):
@@ -1131,6 +1353,32 @@ class Object(StringIdModel, AddRemoveMixin):
 
     @property
     def as1(self):
+        """This object's ActivityStreams 1 representation, or None.
+
+        Converted from :attr:`our_as1`, :attr:`as2`, :attr:`bsky`, :attr:`mf2`,
+        or :attr:`nostr`, whichever is populated first, and cached on this
+        instance until one of them, :attr:`source_protocol`, or the key is
+        assigned. Callers should treat the returned dict as read only and
+        ``copy.deepcopy`` it before modifying it. If you modify one of those
+        properties in place, call :meth:`clear_as1_cache` afterward.
+        """
+        try:
+            return self.__dict__['_as1']
+        except KeyError:
+            obj = self.__dict__['_as1'] = self._convert_as1()
+            return obj
+
+    def clear_as1_cache(self):
+        """Clears the cached :attr:`as1` value so that it's converted again."""
+        self.__dict__.pop('_as1', None)
+
+    def __setattr__(self, name, value):
+        if name in AS1_INPUTS:
+            self.clear_as1_cache()
+        super().__setattr__(name, value)
+
+    def _convert_as1(self):
+        """Converts this object to AS1. Uncached; use :attr:`as1` instead."""
         def use_urls_as_ids(obj):
             """If id field is missing or not a URL, use the url field."""
             id = obj.get('id')
@@ -1246,6 +1494,57 @@ class Object(StringIdModel, AddRemoveMixin):
     def _post_put_hook(self, future):
         # TODO: assert that as1 id is same as key id? in pre put hook?
         logger.debug(f'Wrote {self.key}')
+        self.clear_local_cache(self.key.id())
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        cls.clear_local_cache(key.id())
+
+    @classmethod
+    def get_by_id_cached(cls, id):
+        """Like :meth:`get_by_id`, but checks :attr:`object_local_cache` first.
+
+        Cache hits are deserialized into a new instance that isn't added to the
+        ndb context cache. :attr:`object_local_cache` is only evicted in the
+        process that writes an Object, so hits may be up to
+        :const:`OBJECT_LOCAL_CACHE_EXPIRATION` stale. Callers must treat the returned
+        object as read only and never put it.
+
+        Args:
+          id (str)
+
+        Returns:
+          Object: or None if it doesn't exist
+        """
+        context = ndb.get_context()
+        key = ndb.Key(cls, id)
+
+        if key not in context.cache:
+            with object_local_cache_lock:
+                serialized = object_local_cache.get(id)
+
+            if serialized:
+                pb = entity_pb2.Entity()
+                pb._pb.MergeFromString(serialized)
+                return _entity_from_protobuf(pb)
+
+        obj = cls.get_by_id(id)
+        if obj and obj.key.id() == id:
+            serialized = _entity_to_protobuf(obj)._pb.SerializeToString()
+            with object_local_cache_lock:
+                object_local_cache[id] = serialized
+
+        return obj
+
+    @classmethod
+    def clear_local_cache(cls, id):
+        """Evicts an Object from :attr:`object_local_cache`.
+
+        Args:
+          id (str)
+        """
+        with object_local_cache_lock:
+            object_local_cache.pop(id, None)
 
     @classmethod
     def get_by_id(cls, id, authed_as=None, **kwargs):
@@ -1328,7 +1627,11 @@ class Object(StringIdModel, AddRemoveMixin):
         obj = cls.get_by_id(key_id, authed_as=authed_as)
 
         if not obj:
+            copies = props.pop('copies', None) or []
             obj = Object(id=key_id, **props)
+            # add copies individually so that they're indexed
+            for copy in copies:
+                obj.add('copies', copy)
             obj.new = True
             obj.changed = False
             obj.put()
@@ -1402,6 +1705,34 @@ class Object(StringIdModel, AddRemoveMixin):
 
         return form
 
+    def estimate_size(self):
+        """Estimates how big this object will be in the datastore, in bytes.
+
+        Much cheaper than serializing it to protobuf, especially for big
+        objects like AS2 actors and Bluesky threads. Uses JSON with ASCII
+        escapes and non-compact separators, so it usually errs high for the
+        JSON properties, which dominate. Callers that need an exact answer
+        near :const:`oauth_dropins.webutil.models.MAX_ENTITY_SIZE` should
+        still serialize.
+
+        Returns:
+          int:
+        """
+        size = ENTITY_OVERHEAD_SIZE + len(self.key.id() if self.key else '')
+
+        for prop in 'as2', 'bsky', 'mf2', 'nostr', 'our_as1', 'raw':
+            if val := getattr(self, prop):
+                size += len(prop) + len(json.dumps(val))
+
+        for key in itertools.chain(self.users, self.notify, self.feed):
+            size += KEY_OVERHEAD_SIZE + len(str(key.id()))
+
+        for target in self.copies:
+            size += (KEY_OVERHEAD_SIZE + len(target.uri or '')
+                     + len(target.protocol or ''))
+
+        return size
+
     def activity_changed(self, other_as1):
         """Returns True if this activity is meaningfully changed from ``other_as1``.
 
@@ -1658,6 +1989,22 @@ class Object(StringIdModel, AddRemoveMixin):
             self.our_as1 = util.trim_nulls(outer_obj)
 
 
+class _StoredValueProperty(ndb.StringProperty):
+    """Remembers an existing :class:`Follower`'s stored value when it changes.
+
+    Stores it in the entity's ``_stored_[name]`` attribute, eg
+    ``_stored_status``, the first time the property is set, so that
+    :meth:`Follower._pre_put_hook` can tell whether the put changes its
+    :class:`FollowerCounter`\\s and :class:`FollowerTarget` without loading it
+    again.
+    """
+    def _set_value(self, entity, value):
+        attr = f'_stored_{self._code_name}'
+        if entity.key is not None and attr not in entity.__dict__:
+            setattr(entity, attr, self._get_value(entity))
+        super()._set_value(entity, value)
+
+
 class Follower(ndb.Model):
     """A follower of a Bridgy Fed user."""
     STATUSES = ('active', 'inactive')
@@ -1669,8 +2016,15 @@ class Follower(ndb.Model):
 
     follow = ndb.KeyProperty(Object)
     """The last follow activity."""
-    status = ndb.StringProperty(choices=STATUSES, default='active')
+    status = _StoredValueProperty(choices=STATUSES, default='active')
     """Whether this follow is active or note."""
+    target = _StoredValueProperty(indexed=False)
+    """The follower's shared delivery target, eg ActivityPub shared inbox.
+
+    Denormalized from the follower's profile, and from here into the
+    followee's :class:`FollowerTarget`\\s. Populated by :meth:`get_or_create`
+    and :meth:`update_targets`, and lazily by :meth:`backfill_targets`.
+    """
 
     created = ndb.DateTimeProperty(auto_now_add=True)
     updated = ndb.DateTimeProperty(auto_now=True)
@@ -1684,9 +2038,85 @@ class Follower(ndb.Model):
         # we're a bridge! stick with bridging.
         assert self.from_.kind() != self.to.kind(), f'from {self.from_} to {self.to}'
 
+        # see whether this put changes the FollowerCounters and FollowerTarget.
+        # new Followers don't have keys yet. _StoredValueProperty remembers the
+        # stored status and target of existing ones when they're changed.
+        if self.key is None:
+            was_status = was_target = None
+        else:
+            was_status = getattr(self, '_stored_status', self.status)
+            was_target = getattr(self, '_stored_target', self.target)
+
+        self._count_delta = (int(self.status == 'active')
+                             - int(was_status == 'active'))
+        self._target_change = (self._target_entry(was_status, was_target),
+                               self._target_entry(self.status, self.target))
+
     def _post_put_hook(self, future):
         logger.debug(f'Wrote {self.key}')
 
+        self._stored_status = self.status
+        self._stored_target = self.target
+        if delta := getattr(self, '_count_delta', 0):
+            self._count_delta = 0
+            FollowerCounter.increment(self.to, 'followers', delta)
+            FollowerCounter.increment(self.from_, 'following', delta)
+
+        old, new = getattr(self, '_target_change', (None, None))
+        self._target_change = (None, None)
+        if old != new:
+            if old:
+                FollowerTarget.update(self.to, *old, -1, follower=self.from_)
+            if new:
+                FollowerTarget.update(self.to, *new, 1, follower=self.from_)
+
+    @classmethod
+    def _pre_delete_hook(cls, key):
+        # deleting an active Follower decrements the FollowerCounters and
+        # FollowerTarget. deactivate it first, in a transaction, so that the
+        # status check and the decrements in the put hooks are atomic, and
+        # concurrent deletes only decrement once. if the delete then fails,
+        # it's just left inactive.
+        cls._deactivate(key)
+
+    @staticmethod
+    @ndb.transactional()
+    def _deactivate(key):
+        """Makes a Follower inactive, if it exists and is active.
+
+        Args:
+          key (google.cloud.ndb.Key)
+        """
+        follower = key.get()
+        if follower and follower.status == 'active':
+            follower.status = 'inactive'
+            follower.put()
+
+    def _target_entry(self, status, target):
+        """Returns this follower's :class:`FollowerTarget` entry, if any.
+
+        Protocol bot users and ``HAS_COPIES`` protocols with a
+        ``DEFAULT_TARGET`` don't get entries, since :meth:`Protocol.targets`
+        doesn't deliver to them as followers.
+
+        Args:
+          status (str): :attr:`status` to use
+          target (str): :attr:`target` to use
+
+        Returns:
+          (str, str) tuple or None: (protocol label, target)
+        """
+        if status != 'active' or not target:
+            return None
+
+        from protocol import Protocol
+        proto = PROTOCOLS_BY_KIND[self.from_.kind()]
+        if (Protocol.for_bridgy_subdomain(self.from_.id())
+                or (proto.HAS_COPIES and proto.DEFAULT_TARGET)):
+            return None
+
+        return proto.LABEL, target
+
     @classmethod
     def get_or_create(cls, *, from_, to, **kwargs):
         """Returns a Follower with the given ``from_`` and ``to`` users.
@@ -1711,18 +2141,84 @@ class Follower(ndb.Model):
         follower = Follower.query(Follower.from_ == from_.key,
                                   Follower.to == to.key,
                                   ).get()
+        target = Follower.target_for_user(from_)
         if not follower:
-            follower = Follower(from_=from_.key, to=to.key, **kwargs)
+            follower = Follower(from_=from_.key, to=to.key, target=target,
+                                **kwargs)
             follower.put()
-        elif kwargs:
+        elif kwargs or (target and target != follower.target):
             # update existing entity with new property values, eg to make an
             # inactive Follower active again
             for prop, val in kwargs.items():
                 setattr(follower, prop, val)
+            follower.target = target or follower.target
             follower.put()
 
         return follower
 
+    @staticmethod
+    def target_for_user(user):
+        """Returns a user's normalized shared delivery target, if any.
+
+        Args:
+          user (User)
+
+        Returns:
+          str or None:
+        """
+        target = user.target_for(user.obj, shared=True) if user.obj else None
+        if target:
+            # normalize URL (lower case hostname, etc)
+            # ...but preserve our PDS URL without trailing slash in path
+            # https://atproto.com/specs/did#did-documents
+            target = util.dedupe_urls([target], trailing_slash=False)[0]
+
+        return target
+
+    @classmethod
+    def update_targets(cls, user):
+        r"""Updates the :attr:`target`\s of a user's active :class:`Follower`\s.
+
+        Only writes the ones that have changed.
+
+        Args:
+          user (User): the follower
+        """
+        if not (target := cls.target_for_user(user)):
+            return
+
+        changed = []
+        for follower in cls.query(cls.from_ == user.key, cls.status == 'active'):
+            if follower.target != target:
+                follower.target = target
+                changed.append(follower)
+
+        if changed:
+            logger.info(f'Updating delivery target for {len(changed)} follows by {user.key} to {target}')
+            ndb.put_multi(changed)
+
+    @staticmethod
+    def backfill_targets(followers):
+        r"""Populates :attr:`target` for followers that don't have it yet.
+
+        Loads their users and stores the ones that now have targets.
+
+        Args:
+          followers (sequence of Follower)
+        """
+        if not (missing := [f for f in followers if not f.target]):
+            return
+
+        users = ndb.get_multi(f.from_ for f in missing)
+        User.load_multi(u for u in users if u)
+        for f, user in zip(missing, users):
+            if user:
+                f.target = Follower.target_for_user(user)
+
+        if backfilled := [f for f in missing if f.target]:
+            logger.info(f'Backfilling delivery targets for {len(backfilled)} followers')
+            ndb.put_multi(backfilled)
+
     @staticmethod
     def fetch_page(collection, user):
         r"""Fetches a page of :class:`Follower`\s for a given user.
@@ -1762,6 +2258,494 @@ class Follower(ndb.Model):
         return followers, before, after
 
 
+class FollowerCounter(ndb.Model):
+    """One shard of a user's sharded count of active followers or following.
+
+    Child of the user it counts. Key id is ``[collection] [shard]``, eg
+    ``followers 3``. Incremented and decremented by :class:`Follower`'s put
+    and delete hooks, read by :meth:`User.count_followers`.
+
+    Shard 0 holds the count when the counter was initialized, either zero by
+    :meth:`User.get_or_create` for new users, or from a query by
+    :meth:`reconcile`, via ``scripts/backfill_follower_counters.py``, for
+    existing users. Increments only go to the other shards. Initializing
+    stores every shard, since ndb's global cache doesn't cache lookups of
+    missing entities, so reading a shard that was never written would cost a
+    datastore read every time. Until a counter is initialized, :meth:`get_count`
+    counts with a bounded, memoized query instead.
+    """
+    NUM_SHARDS = 10
+
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def keys(cls, user_key, collection):
+        """Returns all of a counter's shard keys, starting with shard 0.
+
+        Args:
+          user_key (google.cloud.ndb.Key)
+          collection (str): ``followers`` or ``following``
+
+        Returns:
+          list of google.cloud.ndb.Key:
+        """
+        assert collection in ('followers', 'following'), collection
+        return [ndb.Key(cls, f'{collection} {i}', parent=user_key)
+                for i in range(cls.NUM_SHARDS)]
+
+    @classmethod
+    def create(cls, user_key):
+        """Initializes a new user's counters to zero, all shards.
+
+        Args:
+          user_key (google.cloud.ndb.Key)
+        """
+        ndb.put_multi([cls(key=key) for collection in ('followers', 'following')
+                       for key in cls.keys(user_key, collection)])
+
+    @classmethod
+    def increment(cls, user_key, collection, delta):
+        """Adds to a counter in a random shard other than shard 0.
+
+        Args:
+          user_key (google.cloud.ndb.Key)
+          collection (str): ``followers`` or ``following``
+          delta (int): may be negative
+        """
+        key = random.choice(cls.keys(user_key, collection)[1:])
+
+        @ndb.transactional()
+        def incr():
+            shard = key.get() or cls(key=key)
+            shard.count += delta
+            shard.put()
+
+        incr()
+
+    @classmethod
+    def get_count(cls, user_key, collection):
+        """Returns a counter's total.
+
+        If it's not initialized yet, counts with a query instead, up to
+        :const:`FOLLOWERS_FALLBACK_COUNT_LIMIT`, cached for
+        :const:`FOLLOWERS_CACHE_EXPIRATION`.
+
+        Args:
+          user_key (google.cloud.ndb.Key)
+          collection (str): ``followers`` or ``following``
+
+        Returns:
+          int or None: None if the counter isn't initialized and the query hit
+          :const:`FOLLOWERS_FALLBACK_COUNT_LIMIT`, so we don't know the total
+        """
+        shards = ndb.get_multi(cls.keys(user_key, collection))
+        if shards[0]:
+            return sum(shard.count for shard in shards if shard)
+
+        count = cls._fallback_count(user_key, collection)
+        return count if count < FOLLOWERS_FALLBACK_COUNT_LIMIT else None
+
+    @staticmethod
+    @memcache.memoize(expire=FOLLOWERS_CACHE_EXPIRATION)
+    def _fallback_count(user_key, collection):
+        return FollowerCounter._query_count(user_key, collection,
+                                            limit=FOLLOWERS_FALLBACK_COUNT_LIMIT)
+
+    @classmethod
+    def reconcile(cls, user_key, collection):
+        """Sets a counter's shard 0 so that its total matches a count query.
+
+        Initializes the counter if necessary, including any missing shards.
+        Safe to run on live counters. The
+        query isn't in the transaction, so a follow or unfollow that lands
+        between them can leave the total off by one, which rerunning fixes.
+
+        Args:
+          user_key (google.cloud.ndb.Key)
+          collection (str): ``followers`` or ``following``
+
+        Returns:
+          int: the new total
+        """
+        keys = cls.keys(user_key, collection)
+        count = cls._query_count(user_key, collection)
+
+        @ndb.transactional()
+        def set_base():
+            shards = ndb.get_multi(keys[1:])
+            incremented = sum(shard.count for shard in shards if shard)
+            ndb.put_multi([cls(key=keys[0], count=count - incremented)]
+                          + [cls(key=key) for key, shard in zip(keys[1:], shards)
+                             if not shard])
+
+        set_base()
+        return count
+
+    @staticmethod
+    def _query_count(user_key, collection, limit=None):
+        prop = Follower.to if collection == 'followers' else Follower.from_
+        return Follower.query(prop == user_key, Follower.status == 'active')\
+                       .count(limit=limit)
+
+
+class FollowerTarget(ndb.Model):
+    """One delivery target of a user's active followers, deduplicated.
+
+    Child of the followed user. Key id is ``[protocol] [target]``, eg
+    ``activitypub https://inst/inbox``, or ``[protocol] sha1:[hash]`` if the
+    target is too long for a key id. Lets :meth:`Protocol.targets` and
+    :func:`protocol.fanout_task` page through a user's followers' targets, eg
+    ActivityPub shared inboxes, once each, without loading every
+    :class:`Follower` or follower :class:`User`.
+
+    Maintained by :class:`Follower`'s put and delete hooks as follows start and
+    stop and followers' targets change. A user's entries are initialized once
+    their :const:`INITIALIZED_ID` marker exists, either empty by
+    :meth:`User.get_or_create` for new users, or by :meth:`reconcile`, via
+    ``scripts/backfill_follower_targets.py``, for existing users. Until then,
+    :meth:`Protocol.load_follower_targets` loads :class:`Follower`\\s instead.
+    """
+    INITIALIZED_ID = 'initialized'
+
+    protocol = ndb.StringProperty(indexed=False)
+    "label of the followers' protocol"
+    uri = ndb.StringProperty(indexed=False)
+    ''
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    'number of active followers with this target'
+    feed = ndb.KeyProperty(repeated=True, indexed=False)
+    """Followers with this target whose protocol uses :attr:`Object.feed`, ie
+    ``USES_OBJECT_FEED``."""
+
+    @staticmethod
+    def key_for(user_key, protocol, uri):
+        """Returns the key for one of a user's follower targets.
+
+        Args:
+          user_key (google.cloud.ndb.Key): the followed user
+          protocol (str): label
+          uri (str)
+
+        Returns:
+          google.cloud.ndb.Key:
+        """
+        id = f'{protocol} {uri}'
+        if len(id.encode()) > _MAX_KEYPART_BYTES:
+            id = f'{protocol} sha1:{sha1(uri.encode()).hexdigest()}'
+        return ndb.Key(FollowerTarget, id, parent=user_key)
+
+    @classmethod
+    def create(cls, user_key):
+        """Initializes a new user's follower targets, empty.
+
+        Args:
+          user_key (google.cloud.ndb.Key)
+        """
+        cls(id=cls.INITIALIZED_ID, parent=user_key).put()
+
+    @classmethod
+    def initialized(cls, user_key):
+        """Returns True if a user's follower targets are initialized.
+
+        Args:
+          user_key (google.cloud.ndb.Key)
+
+        Returns:
+          bool:
+        """
+        return ndb.Key(cls, cls.INITIALIZED_ID, parent=user_key).get() is not None
+
+    @classmethod
+    @ndb.transactional()
+    def update(cls, user_key, protocol, uri, delta, follower=None):
+        """Adds or removes followers from a target. Deletes it when it's empty.
+
+        Args:
+          user_key (google.cloud.ndb.Key): the followed user
+          protocol (str): label
+          uri (str)
+          delta (int): change in number of followers, usually 1 or -1
+          follower (google.cloud.ndb.Key): optional, the follower being added
+            or removed, for :attr:`feed`
+        """
+        key = cls.key_for(user_key, protocol, uri)
+        entry = key.get() or cls(key=key, protocol=protocol, uri=uri)
+        entry.count += delta
+
+        if follower and PROTOCOLS[protocol].USES_OBJECT_FEED:
+            if delta > 0:
+                util.add(entry.feed, follower)
+            elif follower in entry.feed:
+                entry.feed.remove(follower)
+
+        if entry.count > 0:
+            entry.put()
+        else:
+            key.delete()
+
+    @classmethod
+    def reconcile(cls, user_key):
+        r"""Rebuilds a user's follower targets from their active :class:`Follower`\s.
+
+        Initializes them if necessary. Backfills :attr:`Follower.target` for
+        followers that don't have it yet. Safe to run on live targets. It isn't
+        transactional, so a follow or unfollow that lands while it runs can
+        leave a target's count off by one, which rerunning fixes.
+
+        Args:
+          user_key (google.cloud.ndb.Key)
+
+        Returns:
+          int: number of targets
+        """
+        entries = {}  # maps key to FollowerTarget
+        query = Follower.query(Follower.to == user_key, Follower.status == 'active')
+        cursor = None
+        more = True
+        while more:
+            followers, cursor, more = query.fetch_page(1000, start_cursor=cursor)
+            Follower.backfill_targets(followers)
+            for follower in followers:
+                if entry := follower._target_entry(follower.status, follower.target):
+                    protocol, uri = entry
+                    key = cls.key_for(user_key, protocol, uri)
+                    target = entries.setdefault(
+                        key, cls(key=key, protocol=protocol, uri=uri))
+                    target.count += 1
+                    if PROTOCOLS[protocol].USES_OBJECT_FEED:
+                        target.feed.append(follower.from_)
+
+        stale = [key for key in cls.query(ancestor=user_key).iter(keys_only=True)
+                 if key not in entries and key.id() != cls.INITIALIZED_ID]
+        if stale:
+            ndb.delete_multi(stale)
+
+        ndb.put_multi(list(entries.values())
+                      + [cls(id=cls.INITIALIZED_ID, parent=user_key)])
+        return len(entries)
+
+
+class FanoutClaim(ndb.Model):
+    """Records that we've enqueued delivery of an activity to one target.
+
+    Key id is ``[activity id] [target URI]``, or ``sha1:[hash]`` if that's too
+    long for a key id. :meth:`Protocol.deliver` and :func:`protocol.fanout_task`
+    write these after they create send tasks for users with more than
+    :const:`protocol.FANOUT_PAGE_SIZE` followers, so that later pages and
+    retries of a page skip targets we've already enqueued, eg shared inboxes
+    with followers on multiple pages. Fanout tasks also claim their next page's
+    cursor so that retries don't fork the chain.
+    """
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    ''
+
+    def _expire(self):
+        """Delete after :const:`FANOUT_CLAIM_EXPIRE` using a TTL policy."""
+        return (self.created or util.now()) + FANOUT_CLAIM_EXPIRE
+
+    expire = ndb.ComputedProperty(_expire, indexed=False)
+
+    @staticmethod
+    def key_for(fanout_id, uri):
+        """Returns the claim key for one of an activity's targets.
+
+        Args:
+          fanout_id (str): id of the activity being delivered
+          uri (str): target URI
+
+        Returns:
+          google.cloud.ndb.Key:
+        """
+        id = f'{fanout_id} {uri}'
+        if len(id.encode()) > _MAX_KEYPART_BYTES:
+            id = f'sha1:{sha1(id.encode()).hexdigest()}'
+        return ndb.Key(FanoutClaim, id)
+
+    @classmethod
+    def claimed(cls, fanout_id, uris):
+        """Returns the URIs that have already been claimed for an activity.
+
+        Args:
+          fanout_id (str)
+          uris (sequence of str)
+
+        Returns:
+          set of str:
+        """
+        uris = list(uris)
+        claims = ndb.get_multi([cls.key_for(fanout_id, uri) for uri in uris])
+        return {uri for uri, claim in zip(uris, claims) if claim}
+
+    @classmethod
+    def claim(cls, fanout_id, uris):
+        """Claims URIs for an activity.
+
+        Args:
+          fanout_id (str)
+          uris (sequence of str)
+        """
+        ndb.put_multi([cls(key=cls.key_for(fanout_id, uri)) for uri in uris])
+
+
+class NostrPubkey(ndb.Model):
+    """Index of the Nostr pubkeys that :mod:`nostr_hub` subscribes to.
+
+    Key id is hex pubkey. Maintained by :meth:`User._post_put_hook` as users
+    enable and disable Nostr. Lets :mod:`nostr_hub` load pubkey changes with a
+    single projection query instead of loading whole :class:`User` entities.
+    Inactive pubkeys are kept, not deleted, so that it sees removals.
+    """
+    user = ndb.KeyProperty()
+    native = ndb.BooleanProperty()
+    'True for native Nostr users, False for users bridged into Nostr'
+    active = ndb.BooleanProperty()
+    ''
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    ''
+    updated = ndb.DateTimeProperty(auto_now=True)
+    ''
+
+    @classmethod
+    def update_for(cls, *users):
+        """Creates or updates users' pubkey entries if necessary.
+
+        Skips users whose entries haven't changed since this process last
+        wrote or read them, in :attr:`nostr_pubkey_synced`.
+
+        Keep in sync with :func:`nostr_hub._load_all_users`'s queries!
+
+        Args:
+          users (sequence of User)
+        """
+        entries = []
+        for user in users:
+            if user.LABEL == 'nostr':
+                pubkey = granary.nostr.uri_to_id(user.key.id())
+                native = True
+                active = user.status is None and bool(user.enabled_protocols)
+            elif user.nostr_key_bytes:
+                pubkey = user.hex_pubkey()
+                native = False
+                active = user.status is None and 'nostr' in user.enabled_protocols
+            else:
+                continue
+
+            with nostr_pubkey_synced_lock:
+                if nostr_pubkey_synced.get(user.key) == (pubkey, native, active):
+                    continue
+            entries.append(cls(id=pubkey, user=user.key, native=native,
+                               active=active))
+
+        if not entries:
+            return
+
+        existing = ndb.get_multi(entry.key for entry in entries)
+        changed = [
+            entry for entry, old in zip(entries, existing)
+            if ((old and (old.user, old.native, old.active)
+                 != (entry.user, entry.native, entry.active))
+                or (not old and entry.active))]
+        if changed:
+            ndb.put_multi(changed)
+
+        with nostr_pubkey_synced_lock:
+            for entry in entries:
+                nostr_pubkey_synced[entry.user] = (entry.key.id(), entry.native,
+                                                   entry.active)
+
+
+class RsaKey(ndb.Model):
+    """A pregenerated RSA keypair, waiting in the pool for a new user.
+
+    Generating a key takes hundreds of ms of CPU, so :meth:`User.get_or_create`
+    claims one from this pool if it can, and only generates one inline if the
+    pool is empty. :func:`refill_rsa_key_pool_task` keeps the pool topped up.
+
+    Properties are encoded the same way as :class:`User`'s. Auto-generated
+    integer key id.
+    """
+    mod = ndb.StringProperty(indexed=False)
+    public_exponent = ndb.StringProperty(indexed=False)
+    private_exponent = ndb.StringProperty(indexed=False)
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def generate(cls):
+        """Generates a new keypair. Doesn't store it.
+
+        Returns:
+          RsaKey:
+        """
+        key = RSA.generate(KEY_BITS, randfunc=random.randbytes if DEBUG else None)
+        return cls(mod=long_to_base64(key.n),
+                   public_exponent=long_to_base64(key.e),
+                   private_exponent=long_to_base64(key.d))
+
+    @classmethod
+    def claim(cls):
+        """Removes a keypair from the pool and returns it.
+
+        Each keypair is claimed at most once, transactionally. Tries a few
+        random candidates so that concurrent callers usually don't contend on
+        the same one.
+
+        Returns:
+          RsaKey: or None if the pool is empty
+        """
+        candidates = cls.query().fetch(10, keys_only=True)
+        random.shuffle(candidates)
+
+        @ndb.transactional(retries=0)
+        def claim(key):
+            if rsa_key := key.get():
+                key.delete()
+            return rsa_key
+
+        for key in candidates:
+            try:
+                if rsa_key := claim(key):
+                    return rsa_key
+            except Aborted:
+                logger.debug(f'contention claiming {key}, trying another')
+
+        logger.info('RSA key pool is empty!')
+        return None
+
+    @classmethod
+    def pool_depth(cls):
+        """Returns the number of keypairs in the pool.
+
+        Returns:
+          int:
+        """
+        return cls.query().count(keys_only=True)
+
+    @classmethod
+    def refill(cls):
+        """Generates and stores keypairs until the pool is full.
+
+        Generates at most :const:`RSA_KEY_POOL_REFILL_BATCH` per call.
+
+        Returns:
+          int: number of keypairs generated
+        """
+        depth = cls.pool_depth()
+        num = max(min(RSA_KEY_POOL_SIZE - depth, RSA_KEY_POOL_REFILL_BATCH), 0)
+        logger.info(f'RSA key pool has {depth} keys, generating {num}')
+        if num:
+            ndb.put_multi([cls.generate() for _ in range(num)])
+        return num
+
+
+@cloud_tasks_only(log=False)
+def refill_rsa_key_pool_task():
+    """Cron task handler that refills the :class:`RsaKey` pool."""
+    num = RsaKey.refill()
+    return f'Generated {num} keys', 200
+
+
 def fetch_objects(query, by=None, user=None):
     """Fetches a page of :class:`Object` entities from a datastore query.
 
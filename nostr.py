@@ -357,7 +357,8 @@ class Nostr(User, Protocol):
                 logger.warning(cc)
                 return False
 
-        obj.copies = [copy for copy in obj.copies if copy.protocol != 'nostr']
+        for copy in [copy for copy in obj.copies if copy.protocol == 'nostr']:
+            obj.remove('copies', copy)
         uri = id_to_uri(bech32_prefix_for(event), event['id'])
         obj.add('copies', Target(uri=uri, protocol=to_cls.LABEL))
         obj.put()
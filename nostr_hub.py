@@ -1,10 +1,13 @@
 """Nostr backfeed, via long-lived websocket connection(s) to relay(s)."""
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import logging
 import secrets
 from threading import Event, Lock, Thread, Timer
 import time
 
+import cachetools
+from google.cloud import ndb
 from google.cloud.ndb.exceptions import ContextError
 from granary.nostr import (
     id_to_uri,
@@ -25,8 +28,9 @@ from common import (
     NDB_CONTEXT_KWARGS,
     report_error,
     report_exception,
+    TaskBatcher,
 )
-from models import PROTOCOLS
+from models import NostrPubkey, PROTOCOLS
 import nostr
 from nostr import Nostr
 from protocol import DELETE_TASK_DELAY
@@ -36,16 +40,44 @@ logger = logging.getLogger(__name__)
 RECONNECT_DELAY = timedelta(seconds=30)
 LOAD_USERS_FREQ = timedelta(seconds=10)
 
+# relays limit the number of values per filter, filters per REQ, and open
+# subscriptions per connection. we chunk pubkeys to stay under these.
+MAX_FILTER_PUBKEYS = 500
+MAX_REQ_FILTERS = 10
+MAX_SUBSCRIPTIONS = 20
+# when we reconnect, ask for events since we were last live, minus this
+SINCE_SLACK = timedelta(minutes=5)
+
+# relays send stored events in bursts before EOSE. we buffer them and handle
+# them in batches of this size, verifying signatures in parallel.
+HANDLE_BATCH_SIZE = 100
+VERIFY_WORKERS = 4
+verify_executor = ThreadPoolExecutor(max_workers=VERIFY_WORKERS,
+                                     thread_name_prefix='verify')
+
+# ids of events we've already verified and enqueued, or are verifying and
+# enqueueing now. many relays send us the same events, often at almost the same
+# time, so this lets us skip verifying and enqueueing them again. shared by all
+# subscriber threads. see _should_verify and _unreserve.
+handled_ids = cachetools.LRUCache(100000)
+handled_ids_lock = Lock()
+
 # global: _load_pubkeys populates them, subscribe uses them
 nostr_pubkeys = set()
 bridged_pubkeys = set()
-pubkeys_loaded_at = datetime(1900, 1, 1)
+NEVER_LOADED = datetime(1900, 1, 1)
+pubkeys_loaded_at = NEVER_LOADED
 pubkeys_initialized = Event()
+pubkeys_lock = Lock()
 
 # string relay websocket adddress URIs
 subscribed_relays = []
 subscribed_relays_lock = Lock()
 
+# maps string relay websocket address URI to the last datetime when we were
+# connected and receiving live, ie post-EOSE, events from it
+relay_live_at = {}
+
 
 def init(subscribe=True):
     logger.info('Starting _load_users timer')
@@ -69,34 +101,16 @@ def _load_users():
         try:
             loaded_at = util.now().replace(tzinfo=None)
 
-            new_nostr = Nostr.query(Nostr.status == None,
-                                    Nostr.enabled_protocols != None,
-                                    Nostr.updated > pubkeys_loaded_at,
-                                    ).fetch()
-            Nostr.load_multi(new_nostr)
-            for user in new_nostr:
-                nostr_pubkeys.add(uri_to_id(user.key.id()))
-                if target := Nostr.target_for(user.obj):
-                    add_relay(target)
-
-            new_bridged = []
-            for proto in PROTOCOLS.values():
-                if proto and proto != Nostr:
-                    # query for all users, then filter for nostr enabled
-                    users = proto.query(proto.status == None,
-                                        proto.enabled_protocols == 'nostr',
-                                        proto.updated > bridged_loaded_at,
-                                        ).fetch()
-                    new_bridged.extend(users)
-
-            bridged_pubkeys.update(user.hex_pubkey() for user in new_bridged)
+            if pubkeys_loaded_at == NEVER_LOADED:
+                _load_all_users()
+            else:
+                _load_pubkey_changes()
 
             # set *after* we populate bridged_pubkeys and nostr_pubkeys so that if we
             # crash earlier, we re-query from the earlier timestamp
             pubkeys_loaded_at = loaded_at
             pubkeys_initialized.set()
-            total = len(nostr_pubkeys) + len(bridged_pubkeys)
-            logger.info(f'Nostr pubkeys: {total}, Nostr {len(nostr_pubkeys)} (+{len(new_nostr)}), bridged {len(bridged_pubkeys)} (+{len(new_bridged)})')
+            logger.info(f'Nostr pubkeys: Nostr {len(nostr_pubkeys)}, bridged {len(bridged_pubkeys)}')
 
         except BaseException:
             # eg google.cloud.ndb.exceptions.ContextError when we lose the ndb context
@@ -104,6 +118,76 @@ def _load_users():
             report_exception()
 
 
+def _load_all_users():
+    """Loads all active Nostr users and users bridged into Nostr.
+
+    Only runs at startup. Afterward, :func:`_load_pubkey_changes` uses the
+    :class:`models.NostrPubkey` index instead.
+
+    Keep in sync with :meth:`models.NostrPubkey.update_for`!
+    """
+    users = Nostr.query(Nostr.status == None,
+                        Nostr.enabled_protocols != None,
+                        ).fetch()
+    _add_nostr_users(users)
+
+    bridged = []
+    for proto in PROTOCOLS.values():
+        if proto and proto != Nostr:
+            # query for all users, then filter for nostr enabled
+            bridged.extend(proto.query(proto.status == None,
+                                       proto.enabled_protocols == 'nostr',
+                                       ).fetch())
+
+    with pubkeys_lock:
+        bridged_pubkeys.update(user.hex_pubkey() for user in bridged)
+
+    # backfill index entries for users who enabled Nostr before it existed
+    NostrPubkey.update_for(*users, *bridged)
+
+
+def _load_pubkey_changes():
+    """Loads pubkeys that were added or removed since we last loaded them.
+
+    Uses a single projection query on the :class:`models.NostrPubkey` index.
+    """
+    changes = NostrPubkey.query(NostrPubkey.updated > pubkeys_loaded_at).fetch(
+        projection=[NostrPubkey.user, NostrPubkey.native, NostrPubkey.active])
+
+    new_nostr_users = []
+    with pubkeys_lock:
+        for change in changes:
+            pubkey = change.key.id()
+            pubkeys = nostr_pubkeys if change.native else bridged_pubkeys
+            if not change.active:
+                pubkeys.discard(pubkey)
+            elif pubkey not in pubkeys:
+                pubkeys.add(pubkey)
+                if change.native:
+                    new_nostr_users.append(change.user)
+
+    if changes:
+        logger.info(f'Loaded {len(changes)} Nostr pubkey changes')
+
+    # load new Nostr users so that we can subscribe to their relays
+    if new_nostr_users:
+        _add_nostr_users([user for user in ndb.get_multi(new_nostr_users) if user])
+
+
+def _add_nostr_users(users):
+    """Adds native Nostr users' pubkeys and subscribes to their relays.
+
+    Args:
+      users (sequence of nostr.Nostr)
+    """
+    Nostr.load_multi(users)
+    for user in users:
+        with pubkeys_lock:
+            nostr_pubkeys.add(uri_to_id(user.key.id()))
+        if target := Nostr.target_for(user.obj):
+            add_relay(target)
+
+
 def add_relay(relay):
     """Subscribes to a new relay if we're not already connected to it.
 
@@ -143,6 +227,10 @@ def subscriber(relay):
 def subscribe(relay, limit=None):
     """Subscribes to relay(s), backfeeds responses to our users' activities.
 
+    Keeps the connection open as we load new users and subscribes to their
+    pubkeys with additional REQs. If we've been connected to this relay before,
+    only asks for events since we were last live on it.
+
     Args:
       relay (str): URI, relay websocket adddress, starting with ``ws://`` or ``wss://``
       limit (int): return after receiving this many messages. Only used in tests.
@@ -153,27 +241,63 @@ def subscribe(relay, limit=None):
         if not DEBUG:
             assert limit is None
 
+        subscriptions = []  # string subscription ids open on this connection
+        live = False
+
+        def req(nostr, bridged, since=None):
+            for filters in _filters(nostr, bridged, since=since):
+                subscription = secrets.token_urlsafe(16)
+                subscriptions.append(subscription)
+                msg = json_dumps(['REQ', subscription, *filters])
+                logger.debug(f'{ws.remote_address} <= {msg}')
+                ws.send(msg)
+
         last_loaded_at = pubkeys_loaded_at
-        received = 0
-        subscription = secrets.token_urlsafe(16)
-        req = json_dumps([
-            'REQ', subscription,
-            {'#p': sorted(bridged_pubkeys)},
-            {'authors': sorted(nostr_pubkeys)},
-        ])
-        logger.debug(f'{ws.remote_address} <= {req}')
-        ws.send(req)
+        with pubkeys_lock:
+            subscribed_nostr = set(nostr_pubkeys)
+            subscribed_bridged = set(bridged_pubkeys)
+
+        since = None
+        if live_at := relay_live_at.get(relay):
+            since = int((live_at - SINCE_SLACK).timestamp())
+        req(subscribed_nostr, subscribed_bridged, since=since)
 
+        received = 0
+        backlog = []  # stored events received before EOSE
         while True:
             if pubkeys_loaded_at > last_loaded_at:
-                logger.info(f'reconnecting to {relay} to pick up new user(s)')
-                return
+                last_loaded_at = pubkeys_loaded_at
+                with pubkeys_lock:
+                    new_nostr = nostr_pubkeys - subscribed_nostr
+                    new_bridged = bridged_pubkeys - subscribed_bridged
+                subscribed_nostr |= new_nostr
+                subscribed_bridged |= new_bridged
+
+                if (len(subscriptions) + len(_filters(new_nostr, new_bridged))
+                        > MAX_SUBSCRIPTIONS):
+                    # too many incremental subscriptions. replace them all with
+                    # one set of REQs for all pubkeys. only use since for the
+                    # ones we were already subscribed to, so that we still get
+                    # new pubkeys' older events.
+                    logger.info(f'consolidating {len(subscriptions)} subscriptions to {relay}')
+                    for subscription in subscriptions:
+                        ws.send(json_dumps(['CLOSE', subscription]))
+                    subscriptions.clear()
+                    since = int((util.now() - SINCE_SLACK).timestamp())
+                    req(subscribed_nostr - new_nostr,
+                        subscribed_bridged - new_bridged, since=since)
+                    req(new_nostr, new_bridged)
+                elif new_nostr or new_bridged:
+                    logger.info(f'subscribing to {len(new_nostr) + len(new_bridged)} new pubkey(s) on {relay}')
+                    req(new_nostr, new_bridged)
 
             try:
                 # use timeout to make sure we periodically loop and check whether
-                # we've loaded any new users, above, and need to re-query
+                # we've loaded any new users, above, and need to subscribe to them
                 msg = ws.recv(timeout=util.HTTP_TIMEOUT)
             except TimeoutError:
+                if live:
+                    relay_live_at[relay] = util.now()
                 continue
 
             logger.debug(f'{ws.remote_address} => {msg}')
@@ -182,10 +306,16 @@ def subscribe(relay, limit=None):
             # https://nips.nostr.com/1
             match resp[0]:
                 case 'EVENT':
-                    handle(resp[2])
+                    if live:
+                        handle(resp[2])
+                    else:
+                        backlog.append(resp[2])
+                        if len(backlog) >= HANDLE_BATCH_SIZE:
+                            handle_batch(backlog)
+                            backlog = []
 
                 case 'CLOSED':
-                    # relay closed our query. reconnect!
+                    # relay closed one of our queries. reconnect!
                     return
 
                 case 'OK':
@@ -194,56 +324,190 @@ def subscribe(relay, limit=None):
 
                 case 'EOSE':
                     # switching from stored results to live
-                    pass
+                    live = True
+                    handle_batch(backlog)
+                    backlog = []
 
                 case 'NOTICE':
                     # already logged this
                     pass
 
+            if live:
+                relay_live_at[relay] = util.now()
+
             received += 1
             if limit and received >= limit:
                 return
 
 
+def _filters(nostr, bridged, since=None):
+    """Builds REQ filters for the given pubkeys, chunked for relay limits.
+
+    Args:
+      nostr (set of str): hex pubkeys of Nostr users, for ``authors``
+      bridged (set of str): hex pubkeys of users bridged into Nostr, for ``#p``
+      since (int): optional POSIX timestamp, for ``since``
+
+    Returns:
+      list of list of dict: filters for each REQ, at most
+      :const:`MAX_REQ_FILTERS` each
+    """
+    filters = []
+    for field, pubkeys in ('#p', bridged), ('authors', nostr):
+        pubkeys = sorted(pubkeys)
+        for i in range(0, len(pubkeys), MAX_FILTER_PUBKEYS):
+            filter = {field: pubkeys[i:i + MAX_FILTER_PUBKEYS]}
+            if since:
+                filter['since'] = since
+            filters.append(filter)
+
+    return [filters[i:i + MAX_REQ_FILTERS]
+            for i in range(0, len(filters), MAX_REQ_FILTERS)]
+
+
 def handle(event):
     """Handles a Nostr event. Enqueues a receive task for it if necessary.
 
     Args:
       event (dict): Nostr event
     """
+    if not _should_verify(event):
+        return
+
+    if not verify(event):
+        logger.debug(f'bad id or sig for {event["id"]}')
+        _unreserve(event['id'])
+        return
+
+    _enqueue(event, create_task)
+
+
+def handle_batch(events):
+    """Handles multiple Nostr events, eg a relay's stored events before EOSE.
+
+    Like :func:`handle`, but verifies signatures in parallel and enqueues
+    receive tasks with a :class:`common.TaskBatcher`.
+
+    Args:
+      events (sequence of dict): Nostr events
+    """
+    to_verify = {}
+    for event in events:
+        if _should_verify(event):
+            to_verify.setdefault(event['id'], event)
+
+    if not to_verify:
+        return
+
+    logger.debug(f'Verifying batch of {len(to_verify)} events')
+    verified = verify_executor.map(verify, to_verify.values())
+
+    futures = {}  # maps event id to (receive task id, Future)
+    remaining = list(to_verify)
+    try:
+        with TaskBatcher(keep_results=False) as batcher:
+            def add(**params):
+                futures[params['nostr']['id']] = (params['id'],
+                                                  batcher.add(**params))
+
+            for event, ok in zip(to_verify.values(), verified):
+                remaining.pop(0)
+                if ok:
+                    _enqueue(event, add)
+                else:
+                    logger.debug(f'bad id or sig for {event["id"]}')
+                    _unreserve(event['id'])
+
+    except BaseException:
+        # eg ContextError. we didn't get to these, so let them be retried
+        for id in remaining:
+            _unreserve(id)
+        raise
+
+    finally:
+        # the batcher has waited for all of its tasks, so these are all done
+        for event_id, (obj_id, future) in futures.items():
+            if exc := future.exception():
+                _unreserve(event_id)
+                report_error(f'Failed to enqueue receive task for {obj_id}: {exc}')
+
+
+def _should_verify(event):
+    """Returns True if this event is for one of our users and not handled yet.
+
+    If it returns True, it also reserves the event's id in :attr:`handled_ids`,
+    atomically, so that other threads that get the same event from other
+    relays skip it. If verifying or enqueueing it then fails, the caller should
+    release the reservation with :func:`_unreserve`.
+
+    Args:
+      event (dict): Nostr event
+
+    Returns:
+      bool:
+    """
     if not (isinstance(event, dict) and event.get('kind') is not None
             and event.get('pubkey') and event.get('id') and event.get('sig')):
         logger.info(f'ignoring bad event: {event}')
-        return
+        return False
 
-    id = event['id']
     pubkey = event['pubkey']
-
     mentions = set(tag[1] for tag in event.get('tags', []) if tag[0] == 'p')
 
     if not (pubkey in nostr_pubkeys          # from a Nostr user who's bridged
             or mentions & bridged_pubkeys):  # mentions a user bridged into Nostr
-        return
+        return False
 
-    if not verify(event):
-        logger.debug(f'bad id or sig for {id}')
-        return
+    with handled_ids_lock:
+        if event['id'] in handled_ids:
+            return False
+        handled_ids[event['id']] = True
+        return True
+
+
+def _unreserve(id):
+    """Releases an event id reserved by :func:`_should_verify`.
+
+    Args:
+      id (str): Nostr event id
+    """
+    with handled_ids_lock:
+        handled_ids.pop(id, None)
+
+
+def _enqueue(event, create_fn):
+    """Enqueues a receive task for a verified event.
+
+    Releases the event's reservation in :attr:`handled_ids` if this fails.
+    If ``create_fn`` fails asynchronously, eg :meth:`common.TaskBatcher.add`,
+    the caller should release it.
+
+    Args:
+      event (dict): Nostr event
+      create_fn (callable): :func:`common.create_task` or
+        :meth:`common.TaskBatcher.add`
+    """
+    id = event['id']
+    pubkey = event['pubkey']
 
     try:
         obj_id = uri_for(event)
         npub_uri = id_to_uri('npub', pubkey)
     except (TypeError, ValueError):
         logger.info(f'bad id {id} or pubkey {pubkey}')
+        _unreserve(id)
         return
     logger.debug(f'Got Nostr event {obj_id} from {pubkey}')
 
     delay = DELETE_TASK_DELAY if event.get('kind') == KIND_DELETE else None
     try:
-        create_task(queue='receive', id=obj_id, source_protocol=Nostr.LABEL,
-                    authed_as=npub_uri, nostr=event, delay=delay)
+        create_fn(queue='receive', id=obj_id, source_protocol=Nostr.LABEL,
+                  authed_as=npub_uri, nostr=event, delay=delay)
         # when running locally, comment out above and uncomment this
         # logger.info(f'enqueuing receive task for {obj_id}')
     except ContextError:
+        _unreserve(id)
         raise  # handled in subscriber()
     except BaseException:
+        _unreserve(id)
         report_error(obj_id, exception=True)
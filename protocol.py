@@ -1,25 +1,29 @@
 """Base protocol class and common code."""
+from concurrent.futures import ThreadPoolExecutor
 import copy
 from datetime import datetime, timedelta, timezone
 import logging
 import os
 import re
 from threading import Lock
+import time
 from urllib.parse import urljoin, urlparse
 
 from cachetools import cached, LRUCache
 from flask import request
 from google.cloud import ndb
 from google.cloud.ndb import OR
+from google.cloud.ndb.key import _MAX_KEYPART_BYTES
 from google.cloud.ndb.model import _entity_to_protobuf
 from granary import as1, as2, source
 from granary.source import html_to_text
+from oauth_dropins.webutil.appengine_config import ndb_client
 from oauth_dropins.webutil.appengine_info import DEBUG
 from oauth_dropins.webutil.flask_util import cloud_tasks_only
 from oauth_dropins.webutil import models
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.util import json_dumps, json_loads
-from requests import RequestException
+from requests import RequestException, Timeout
 import werkzeug.exceptions
 from werkzeug.exceptions import BadGateway, HTTPException
 
@@ -29,12 +33,14 @@ from common import (
     DOMAIN_RE,
     DOMAINS,
     ErrorButDoNotRetryTask,
+    NDB_CONTEXT_KWARGS,
     PRIMARY_DOMAIN,
     PROTOCOL_DOMAINS,
     report_error,
     subdomain_wrap,
 )
 import dms
+from flask_app import app
 import ids
 from ids import (
     BOT_ACTOR_AP_IDS,
@@ -45,8 +51,12 @@ from ids import (
 import memcache
 from models import (
     DM,
+    FanoutClaim,
     Follower,
+    FollowerTarget,
     Object,
+    object_local_cache,
+    object_local_cache_lock,
     PROTOCOLS,
     PROTOCOLS_BY_KIND,
     Target,
@@ -56,7 +66,21 @@ import notifications
 
 OBJECT_REFRESH_AGE = timedelta(days=30)
 DELETE_TASK_DELAY = timedelta(minutes=2)
+SEND_MAX_DEFERRALS = 5
 CREATE_MAX_AGE = timedelta(weeks=2)
+# Protocol.load serializes fetched objects to check their exact size if
+# Object.estimate_size is over this fraction of MAX_ENTITY_SIZE
+SIZE_ESTIMATE_THRESHOLD = .8
+
+# followers per page in Protocol.targets and fanout_task. accounts with more
+# followers than this get delivered to in a chain of fanout tasks.
+FANOUT_PAGE_SIZE = 1000
+
+# for Protocol.load_multi, eg in targets
+LOAD_WORKERS = int(os.environ.get('LOAD_WORKERS', 8))
+TARGETS_DEADLINE = timedelta(seconds=30)
+load_executor = ThreadPoolExecutor(max_workers=LOAD_WORKERS,
+                                   thread_name_prefix='load')
 
 # require a follow for users on these domains before we deliver anything from
 # them other than their profile
@@ -80,6 +104,45 @@ def error(*args, status=299, **kwargs):
     return common.error(*args, status=status, **kwargs)
 
 
+def _load_failure_type(e, code):
+    """Classifies a failed fetch for :func:`memcache.record_load_failure`.
+
+    Args:
+      e (Exception): :class:`requests.RequestException` or
+        :class:`werkzeug.exceptions.HTTPException`
+      code (str): HTTP status code from :func:`util.interpret_http_exception`
+
+    Returns:
+      str: a key in :const:`memcache.LOAD_FAILURE_EXPIRE`
+    """
+    if code in ('404', '410'):
+        return code
+    elif code == '504' or isinstance(e, Timeout):
+        return 'timeout'
+    return 'error'
+
+
+def _load_failure_exception(id, failure):
+    """Returns the exception to raise for a failure from :func:`_load_failure_type`.
+
+    Args:
+      id (str)
+      failure (str): a key in :const:`memcache.LOAD_FAILURE_EXPIRE`
+
+    Returns:
+      werkzeug.exceptions.HTTPException or None: None for failures that
+      :meth:`Protocol.load` returns None for instead of raising, eg ``empty``
+    """
+    exc_cls = {
+        '404': werkzeug.exceptions.NotFound,
+        '410': werkzeug.exceptions.Gone,
+        'timeout': werkzeug.exceptions.GatewayTimeout,
+        'error': BadGateway,
+    }.get(failure)
+    if exc_cls:
+        return exc_cls(f'Recently failed to fetch {id}: {failure}')
+
+
 def activity_id_memcache_key(id):
     return memcache.key(f'receive-{id}')
 
@@ -120,6 +183,8 @@ class Protocol:
     """bool: whether this protocol supports HTML in profile descriptions. If False, profile descriptions should be plain text."""
     SEND_REPLIES_TO_ORIG_POSTS_MENTIONS = False
     """bool: whether replies to this protocol should include the original post's mentions as delivery targets"""
+    SEND_BATCH_SIZE = None
+    """int: optional, if set, :meth:`deliver` groups this protocol's targets for the same activity into ``send`` tasks of up to this many targets each, which are sent with :meth:`send_batch`"""
 
     def __init__(self):
         assert False
@@ -291,9 +356,8 @@ class Protocol:
         elif remote and util.is_web(id):
             return domain
 
-    @cached(LRUCache(20000), lock=Lock())
     @memcache.memoize(key=_for_id_memcache_key, write=lambda id, remote=True: remote,
-                      version=3)
+                      version=3, local_size=20000)
     @staticmethod
     def for_id(id, remote=True):
         """Returns the protocol for a given id.
@@ -364,10 +428,16 @@ class Protocol:
             logger.debug(f'  {obj.key.id()} owned by source_protocol {obj.source_protocol}')
             return PROTOCOLS[obj.source_protocol]
 
-        # step 4: fetch over the network, if necessary
+        # step 4: fetch over the network, if necessary, skipping protocols that
+        # recently failed to fetch it
         if not remote:
             return None
 
+        failures = memcache.load_failures(id, [p.LABEL for p in candidates])
+        if failures:
+            logger.info(f'Not fetching {id} with {" ".join(failures)}, recent failures: {failures}')
+            candidates = [p for p in candidates if p.LABEL not in failures]
+
         for protocol in candidates:
             logger.debug(f'Trying {protocol.LABEL}')
             try:
@@ -567,6 +637,54 @@ class Protocol:
         """
         raise NotImplementedError()
 
+    @classmethod
+    def send_batch(to_cls, obj, targets, from_user=None, orig_obj_id=None):
+        """Sends an outgoing activity to multiple targets.
+
+        Used for protocols with :attr:`SEND_BATCH_SIZE`. Subclasses may override
+        this to share work across targets, eg converting the activity once. The
+        default implementation calls :meth:`send` for each target.
+
+        Args:
+          obj (models.Object): with activity to send
+          targets (sequence of str): destination URLs to send to
+          from_user (models.User): user (actor) this activity is from
+          orig_obj_id (str): :class:`models.Object` key id of the "original object"
+            that this object refers to, eg replies to or reposts or likes
+
+        Returns:
+          dict: maps str target to the bool returned by :meth:`send` for it, or
+          the exception it raised. Doesn't raise, so that callers can retry
+          just the failed targets.
+        """
+        results = {}
+        for target in targets:
+            try:
+                results[target] = to_cls.send(obj, target, from_user=from_user,
+                                              orig_obj_id=orig_obj_id)
+            except Exception as e:
+                logger.info(f'Failed sending to {target}: {e}')
+                results[target] = e
+
+        return results
+
+    @classmethod
+    def send_host(cls, target):
+        """Returns the host that :meth:`send` makes its request to for a target.
+
+        :func:`send_task` uses this to defer sending to hosts that are down. The
+        default implementation returns the target URL's host. Subclasses may
+        override this, eg if they send to a different URL that they discover
+        from the target.
+
+        Args:
+          target (str): destination URL
+
+        Returns:
+          str: domain, or None
+        """
+        return util.domain_from_link(target, minimize=False)
+
     @classmethod
     def fetch(cls, obj, **kwargs):
         """Fetches a protocol-specific object and populates it in an :class:`Object`.
@@ -880,25 +998,24 @@ class Protocol:
         outer_obj = copy.deepcopy(obj)
         inner_objs = outer_obj['object'] = as1.get_objects(outer_obj)
 
+        # first, collect all the ids to translate, so that we can look up their
+        # protocols and translate them all at once
+        user_ids = {}  # maps id to Protocol, for translate_user_id
+        object_ids = {}  # maps id to Protocol, for translate_object_id
+        found = []  # (id, fn) tuples
+        fields = []  # (elem, field, fn, uri) tuples
+        att_urls = []  # (attachment, url) tuples for attachments with only urls
+        atts = []  # (attachment, url) tuples for the ones we'll translate
+
         def translate(elem, field, fn, uri=False):
             elem[field] = as1.get_objects(elem, field)
             for obj in elem[field]:
                 if id := obj.get('id'):
                     if field in ('to', 'cc', 'bcc', 'bto') and as1.is_audience(id):
                         continue
-                    from_cls = Protocol.for_id(id)
-                    # TODO: what if from_cls is None? relax translate_object_id,
-                    # make it a noop if we don't know enough about from/to?
-                    if from_cls and from_cls != to_cls:
-                        obj['id'] = fn(id=id, from_=from_cls, to=to_cls)
-                    if obj['id'] and uri:
-                        obj['id'] = to_cls(id=obj['id']).id_uri()
+                    found.append((id, fn))
 
-            elem[field] = [o['id'] if o.keys() == {'id'} else o
-                           for o in elem[field]]
-
-            if len(elem[field]) == 1 and field not in ('items', 'orderedItems'):
-                elem[field] = elem[field][0]
+            fields.append((elem, field, fn, uri))
 
         type = as1.object_type(outer_obj)
         translate(outer_obj, 'id',
@@ -925,13 +1042,54 @@ class Protocol:
                 translate(att, 'id', translate_object_id)
                 url = att.get('url')
                 if url and not att.get('id'):
-                    if from_cls := Protocol.for_id(url):
-                        att['id'] = translate_object_id(from_=from_cls, to=to_cls,
-                                                        id=url)
+                    att_urls.append((att, url))
             if feat := as1.get_object(o, 'featured'):
                 translate(feat, 'orderedItems', translate_object_id)
                 translate(feat, 'items', translate_object_id)
 
+        # look up their protocols, all at once
+        distinct = list(dict.fromkeys([id for id, _ in found]
+                                      + [url for _, url in att_urls]))
+        protos = dict(zip(distinct, Protocol.for_id.many((id,) for id in distinct)))
+
+        for id, fn in found:
+            # TODO: what if from_cls is None? relax translate_object_id,
+            # make it a noop if we don't know enough about from/to?
+            if (from_cls := protos[id]) and from_cls != to_cls:
+                ids_for_fn = user_ids if fn == translate_user_id else object_ids
+                ids_for_fn[id] = from_cls
+
+        for att, url in att_urls:
+            if from_cls := protos[url]:
+                atts.append((att, url))
+                if from_cls != to_cls:
+                    object_ids[url] = from_cls
+
+        # translate them all at once
+        translated_users, translated_objects = ids.translate_multi(
+            user_ids=user_ids, object_ids=object_ids, to=to_cls)
+        translated = {
+            translate_user_id: translated_users,
+            translate_object_id: translated_objects,
+        }
+
+        # then rewrite the object
+        for elem, field, fn, uri in fields:
+            for obj in elem[field]:
+                if (id := obj.get('id')) and id in translated[fn]:
+                    obj['id'] = translated[fn][id]
+                if obj.get('id') and uri:
+                    obj['id'] = to_cls(id=obj['id']).id_uri()
+
+            elem[field] = [o['id'] if o.keys() == {'id'} else o
+                           for o in elem[field]]
+
+            if len(elem[field]) == 1 and field not in ('items', 'orderedItems'):
+                elem[field] = elem[field][0]
+
+        for att, url in atts:
+            att['id'] = translated_objects.get(url, url)
+
         outer_obj = util.trim_nulls(outer_obj)
 
         if objs := util.get_list(outer_obj ,'object'):
@@ -1397,7 +1555,7 @@ class Protocol:
             if obj_as1_id := obj_as1.get('id'):
                 if obj_id != obj_as1_id:
                     logger.info(f'Overriding AS1 object id {obj_as1_id} with Object id {obj_id}')
-                    obj_as1['id'] = obj_id
+                    obj_as1 = {**obj_as1, 'id': obj_id}
 
         # this is a raw post; wrap it in a create or update activity
         if obj.changed or is_actor:
@@ -1471,7 +1629,15 @@ class Protocol:
         if to_proto:
             targets = {t: obj for t, obj in targets.items()
                        if t.protocol == to_proto.LABEL}
-        if not targets:
+
+        # if there are too many followers for targets to handle, continue
+        # delivering to them in fanout tasks
+        fanout_protocols = []
+        if fanout := getattr(obj, 'fanout', None):
+            fanout_protocols = [proto.LABEL for proto in fanout['protocols']
+                                if not to_proto or proto == to_proto]
+
+        if not targets and not fanout_protocols:
             return r'No targets, nothing to do ¯\_(ツ)_/¯', 204
 
         # store object that targets() updated
@@ -1483,18 +1649,82 @@ class Protocol:
         obj_params = ({'obj_id': obj.key.id()} if obj.type in STORE_AS1_TYPES
                       else obj.to_request())
 
+        logger.info(f'Delivering to: {sorted(t.uri for t in targets)}')
+        user = from_user.key.urlsafe()
+        Protocol.enqueue_sends(
+            {t: orig_obj.key.id() if orig_obj else None
+             for t, orig_obj in targets.items()},
+            user=user, **obj_params)
+
+        if fanout_protocols:
+            # so that we don't deliver to these again in the fanout tasks
+            FanoutClaim.claim(obj.key.id(), [t.uri for t in targets])
+            logger.info(f"Continuing delivery to {fanout['followee']}'s followers in fanout tasks")
+            common.create_task(queue='fanout', followee=fanout['followee'].urlsafe(),
+                               cursor=fanout['cursor'].urlsafe(),
+                               index='true' if fanout['index'] else 'false',
+                               protocols=' '.join(fanout_protocols),
+                               fanout_id=obj.key.id(),
+                               feed_obj_id=fanout['feed_obj_id'],
+                               orig_obj_id=fanout['orig_obj_id'],
+                               user=user, **obj_params)
+
+        return 'OK', 202
+
+    @staticmethod
+    def enqueue_sends(targets, raise_=True, **params):
+        """Enqueues send tasks for delivery targets.
+
+        Batches targets into one task for protocols with ``SEND_BATCH_SIZE``,
+        eg ActivityPub shared inboxes.
+
+        Args:
+          targets (dict): maps :class:`models.Target` to str id of the original
+            :class:`models.Object`, if any, otherwise None. See
+            :func:`send_task`'s ``orig_obj_id`` parameter.
+          raise_ (bool): whether to raise the first task creation error, if
+            any, or return the failed targets instead
+          params: passed through to each send task, eg ``user``, ``obj_id``
+
+        Returns:
+          set of str: URIs of the targets whose send tasks we couldn't create
+        """
         # sort targets so order is deterministic for tests, debugging, etc
         sorted_targets = sorted(targets.items(), key=lambda t: t[0].uri)
 
         # enqueue send task for each targets
-        logger.info(f'Delivering to: {[t for t, _ in sorted_targets]}')
-        user = from_user.key.urlsafe()
-        for i, (target, orig_obj) in enumerate(sorted_targets):
-            orig_obj_id = orig_obj.key.id() if orig_obj else None
-            common.create_task(queue='send', url=target.uri, protocol=target.protocol,
-                               orig_obj_id=orig_obj_id, user=user, **obj_params)
-
-        return 'OK', 202
+        batcher = common.TaskBatcher()
+        added = []  # list of target URIs for each task, in the order we add them
+        batches = {}  # maps (protocol label, orig_obj_id) to list of target URIs
+        for target, orig_obj_id in sorted_targets:
+            if PROTOCOLS[target.protocol].SEND_BATCH_SIZE:
+                batches.setdefault((target.protocol, orig_obj_id), []).append(
+                    target.uri)
+            else:
+                batcher.add(queue='send', url=target.uri, protocol=target.protocol,
+                            orig_obj_id=orig_obj_id, **params)
+                added.append([target.uri])
+
+        # fan out: one send task per batch of targets, eg AP shared inboxes
+        for (protocol, orig_obj_id), uris in batches.items():
+            size = PROTOCOLS[protocol].SEND_BATCH_SIZE
+            for i in range(0, len(uris), size):
+                chunk = uris[i:i + size]
+                url_params = ({'url': chunk[0]} if len(chunk) == 1
+                              else {'urls': ' '.join(chunk)})
+                batcher.add(queue='send', protocol=protocol, orig_obj_id=orig_obj_id,
+                            **url_params, **params)
+                added.append(chunk)
+
+        failed = set()
+        for uris, result in zip(added, batcher.wait()):
+            if isinstance(result, BaseException):
+                if raise_:
+                    raise result
+                logger.warning(f"Couldn't create send task for {uris}: {result}")
+                failed.update(uris)
+
+        return failed
 
     @classmethod
     def targets(from_cls, obj, from_user, crud_obj=None, internal=False):
@@ -1515,6 +1745,8 @@ class Protocol:
           :class:`models.Object`, if any, otherwise None
         """
         logger.debug('Finding recipients and their targets')
+        if not internal:
+            obj.fanout = None
 
         # we should only have crud_obj iff this is a create or update
         assert (crud_obj is not None) == (obj.type in ('post', 'update')), obj.type
@@ -1545,16 +1777,23 @@ class Protocol:
         # for AP, add in-reply-tos' mentions
         # https://github.com/snarfed/bridgy-fed/issues/1608
         # https://github.com/snarfed/bridgy-fed/issues/1218
+        deadline = time.monotonic() + TARGETS_DEADLINE.total_seconds()
         orig_post_mentions = {}  # maps mentioned id to original post Object
-        for id in in_reply_tos:
-            if ((proto := Protocol.for_id(id))
-                    and proto.SEND_REPLIES_TO_ORIG_POSTS_MENTIONS):
-                if (in_reply_to_obj := proto.load(id)) and in_reply_to_obj.as1:
-                    if mentions := as1.mentions(in_reply_to_obj.as1):
-                        logger.info(f"Adding in-reply-to {id} 's mentions to targets: {mentions}")
-                        target_uris.extend(mentions)
-                        for mention in mentions:
-                            orig_post_mentions[mention] = in_reply_to_obj
+        in_reply_to_protos = {}
+        for id, proto in zip(in_reply_tos,
+                             Protocol.for_id.many((id,) for id in in_reply_tos)):
+            if proto and proto.SEND_REPLIES_TO_ORIG_POSTS_MENTIONS:
+                in_reply_to_protos[id] = proto
+
+        # maps id to Object or None
+        loaded = Protocol.load_multi(in_reply_to_protos, deadline=deadline)
+        for id, in_reply_to_obj in loaded.items():
+            if in_reply_to_obj and in_reply_to_obj.as1:
+                if mentions := as1.mentions(in_reply_to_obj.as1):
+                    logger.info(f"Adding in-reply-to {id} 's mentions to targets: {mentions}")
+                    target_uris.extend(mentions)
+                    for mention in mentions:
+                        orig_post_mentions[mention] = in_reply_to_obj
 
         target_uris = sorted(set(target_uris))
         logger.info(f'Raw targets: {target_uris}')
@@ -1573,7 +1812,7 @@ class Protocol:
                     if Protocol.for_id(id) == proto:
                         logger.info(f'Allowing {label} for original post {id}')
                         break
-                    elif orig := from_user.load(id, remote=False):
+                    elif orig := from_user.load(id, remote=False, cached=True):
                         if orig.get_copy(proto):
                             logger.info(f'Allowing {label}, original post {id} was bridged there')
                             break
@@ -1583,29 +1822,47 @@ class Protocol:
 
             util.add(to_protocols, proto)
 
-        # process direct targets
-        for target_id in target_uris:
-            target_proto = Protocol.for_id(target_id)
+        # load direct targets, all at once
+        target_protos = {}  # maps id to Protocol
+        for target_id, target_proto in zip(
+                target_uris, Protocol.for_id.many((id,) for id in target_uris)):
             if not target_proto:
                 logger.info(f"Can't determine protocol for {target_id}")
                 continue
             elif target_proto.is_blocklisted(target_id):
                 logger.debug(f'{target_id} is blocklisted')
                 continue
+            target_protos[target_id] = target_proto
+
+        loaded.update(Protocol.load_multi(
+            {id: proto for id, proto in target_protos.items() if id not in loaded},
+            deadline=deadline))
+
+        # and their authors, if we might notify them below
+        author_keys = {}  # maps id to User key
+        for target_id, target_proto in target_protos.items():
+            if (orig_obj := loaded.get(target_id)) and orig_obj.as1:
+                author_keys[target_id] = (target_proto(id=target_id).key
+                                          if target_id in mentioned_urls
+                                          else target_proto.actor_key(orig_obj))
 
-            orig_obj = target_proto.load(target_id, raise_=False)
+        notify_ids = in_reply_tos + quoted_posts + mentioned_urls
+        ndb.get_multi([key for id, key in author_keys.items()
+                       if key and id in notify_ids
+                       and not from_user.is_enabled(target_protos[id])])
+
+        # process direct targets
+        for target_id, target_proto in target_protos.items():
+            orig_obj = loaded.get(target_id)
             if not orig_obj or not orig_obj.as1:
                 logger.info(f"Couldn't load {target_id}")
                 continue
 
-            target_author_key = (target_proto(id=target_id).key
-                                 if target_id in mentioned_urls
-                                 else target_proto.actor_key(orig_obj))
+            target_author_key = author_keys[target_id]
             if not from_user.is_enabled(target_proto):
                 # if author isn't bridged and target user is, DM a prompt and
                 # add a notif for the target user
-                if (target_id in (in_reply_tos + quoted_posts + mentioned_urls)
-                        and target_author_key):
+                if target_id in notify_ids and target_author_key:
                     if target_author := target_author_key.get():
                         if target_author.is_enabled(from_cls):
                             notifications.add_notification(target_author, write_obj)
@@ -1679,57 +1936,47 @@ Hi! You <a href="{inner_obj_as1.get('url') or inner_obj_id}">recently {verb}</a>
             logger.info("Can't tell who this is from! Skipping followers.")
             return targets
 
-        followers = []
         if (obj.type in ('post', 'update', 'delete', 'move', 'share', 'undo')
                 and (not is_reply or is_self_reply)):
             logger.info(f'Delivering to followers of {user_key}')
-            followers = []
-            for f in Follower.query(Follower.to == user_key,
-                                    Follower.status == 'active'):
-                proto = PROTOCOLS_BY_KIND[f.from_.kind()]
-                # skip protocol bot users
-                if (not Protocol.for_bridgy_subdomain(f.from_.id())
-                        # skip protocols this user hasn't enabled, or where the base
-                        # object of this activity hasn't been bridged
-                        and proto in to_protocols
-                        # we deliver to HAS_COPIES protocols separately, below. we
-                        # assume they have follower-independent targets.
-                        and not (proto.HAS_COPIES and proto.DEFAULT_TARGET)):
-                    followers.append(f)
-
-            user_keys = [f.from_ for f in followers]
-            users = [u for u in ndb.get_multi(user_keys) if u]
-            User.load_multi(users)
-
-            if (not followers and
+            follower_targets, feed, cursor, index = \
+                Protocol.load_follower_targets(user_key, to_protocols)
+
+            if (not follower_targets and not feed and not cursor and
                 (util.domain_or_parent_in(from_user.key.id(), LIMITED_DOMAINS)
                  or util.domain_or_parent_in(obj.key.id(), LIMITED_DOMAINS))):
                 logger.info(f'skipping, {from_user.key.id()} is on a limited domain and has no followers')
                 return {}
 
             # add to followers' feeds, if any
+            feed_obj_id = None
             if not internal and obj.type in ('post', 'update', 'share'):
                 if write_obj.type not in as1.ACTOR_TYPES:
-                    write_obj.feed = [u.key for u in users if u.USES_OBJECT_FEED]
+                    feed_obj_id = write_obj.key.id() if write_obj.key else None
+                    write_obj.feed = feed
                     if write_obj.feed:
                         write_obj.dirty = True
 
-            # collect targets for followers
-            for user in users:
-                # TODO: should we pass remote=False through here to Protocol.load?
-                target = user.target_for(user.obj, shared=True) if user.obj else None
-                if not target:
-                    # TODO: surface errors like this somehow?
-                    logger.error(f'Follower {user.key} has no delivery target')
-                    continue
-
-                # normalize URL (lower case hostname, etc)
-                # ...but preserve our PDS URL without trailing slash in path
-                # https://atproto.com/specs/did#did-documents
-                target = util.dedupe_urls([target], trailing_slash=False)[0]
+            logger.info(f'{len(follower_targets)} follower delivery targets')
+
+            if cursor and not internal:
+                # too many followers to handle here. deliver continues with the
+                # rest in fanout tasks.
+                logger.info(f'{user_key} has over {FANOUT_PAGE_SIZE} followers, fanning out')
+                obj.fanout = {
+                    'followee': user_key,
+                    'cursor': cursor,
+                    'index': index,
+                    'protocols': to_protocols,
+                    'feed_obj_id': feed_obj_id,
+                    'orig_obj_id': inner_obj_id if obj.type == 'share' else None,
+                }
 
-                targets[Target(protocol=user.LABEL, uri=target)] = \
-                    Object.get_by_id(inner_obj_id) if obj.type == 'share' else None
+            if follower_targets:
+                shared_obj = (Object.get_by_id(inner_obj_id) if obj.type == 'share'
+                              else None)
+                for target in follower_targets:
+                    targets[target] = shared_obj
 
         # deliver to enabled HAS_COPIES protocols proactively
         if obj.type in ('post', 'update', 'delete', 'share'):
@@ -1739,11 +1986,26 @@ Hi! You <a href="{inner_obj_as1.get('url') or inner_obj_id}">recently {verb}</a>
                     targets.setdefault(
                         Target(protocol=proto.LABEL, uri=proto.DEFAULT_TARGET), None)
 
-        # de-dupe targets, discard same-domain
+        return Protocol.filter_targets(obj, targets)
+
+    @staticmethod
+    def filter_targets(obj, targets):
+        """De-dupes delivery targets and discards same-domain and blocklisted ones.
+
+        Used by :meth:`targets` and :func:`fanout_task`.
+
+        Args:
+          obj (models.Object): activity being delivered
+          targets (dict): maps :class:`models.Target` to original
+            :class:`models.Object`, if any, otherwise None
+
+        Returns:
+          dict: the remaining subset of ``targets``
+        """
         # maps string target URL to (Target, Object) tuple
-        candidates = {t.uri: (t, obj) for t, obj in targets.items()}
+        candidates = {t.uri: (t, orig_obj) for t, orig_obj in targets.items()}
         # maps Target to Object or None
-        targets = {}
+        filtered = {}
         source_domains = [
             util.domain_from_link(url) for url in
             (obj.as1.get('id'), obj.as1.get('url'), as1.get_owner(obj.as1))
@@ -1757,13 +2019,193 @@ Hi! You <a href="{inner_obj_as1.get('url') or inner_obj_id}">recently {verb}</a>
             if util.is_web(url) and util.domain_from_link(url) in source_domains:
                 logger.info(f'Skipping same-domain target {url}')
                 continue
-            target, obj = candidates[url]
-            targets[target] = obj
+            target, orig_obj = candidates[url]
+            if PROTOCOLS[target.protocol].is_blocklisted(url, allow_internal=True):
+                logger.info(f'Skipping blocklisted target {url}')
+                continue
+            filtered[target] = orig_obj
+
+        return filtered
+
+    @staticmethod
+    def load_followers(user_key, to_protocols, cursor=None):
+        r"""Loads a page of a user's active followers to deliver to.
+
+        Skips protocol bot users, protocols that aren't in ``to_protocols``, and
+        ``HAS_COPIES`` protocols with a ``DEFAULT_TARGET``, since we deliver to
+        those separately. Backfills :attr:`models.Follower.target` for
+        followers that don't have it yet.
+
+        Costs one entity read per active follower, even when many of them share
+        a target, eg an ActivityPub shared inbox, so
+        :meth:`load_follower_targets` only uses this for users whose
+        :class:`models.FollowerTarget`\s aren't initialized yet.
+
+        Args:
+          user_key (google.cloud.ndb.Key): the user being followed
+          to_protocols (sequence of Protocol): protocols to deliver to
+          cursor (google.cloud.ndb.Cursor): optional, where to start
+
+        Returns:
+          (list of models.Follower, google.cloud.ndb.Cursor) tuple: up to
+          :const:`FANOUT_PAGE_SIZE` :class:`models.Follower`\s, and a cursor
+          for the next page, or None if this is the last page
+        """
+        query = Follower.query(Follower.to == user_key, Follower.status == 'active')
+        results, cursor, more = query.fetch_page(FANOUT_PAGE_SIZE,
+                                                 start_cursor=cursor)
+
+        followers = []
+        for f in results:
+            proto = PROTOCOLS_BY_KIND[f.from_.kind()]
+            # skip protocol bot users
+            if (not Protocol.for_bridgy_subdomain(f.from_.id())
+                    # skip protocols this user hasn't enabled, or where the base
+                    # object of this activity hasn't been bridged
+                    and proto in to_protocols
+                    # we deliver to HAS_COPIES protocols separately, below. we
+                    # assume they have follower-independent targets.
+                    and not (proto.HAS_COPIES and proto.DEFAULT_TARGET)):
+                followers.append(f)
+
+        Follower.backfill_targets(followers)
+        return followers, (cursor if more else None)
+
+    @staticmethod
+    def load_follower_targets(user_key, to_protocols, cursor=None, index=None):
+        r"""Loads a page of a user's followers' delivery targets, deduped.
+
+        Reads the user's :class:`models.FollowerTarget`\s, one entity per
+        target, eg per ActivityPub shared inbox. If they're not initialized
+        yet, falls back to :meth:`load_followers`.
+
+        Args:
+          user_key (google.cloud.ndb.Key): the user being followed
+          to_protocols (sequence of Protocol): protocols to deliver to
+          cursor (google.cloud.ndb.Cursor): optional, where to start
+          index (bool): whether to read :class:`models.FollowerTarget`\s or
+            fall back to :meth:`load_followers`. Defaults to whether the user's
+            are initialized. Later pages should pass the value that the first
+            page returned, since the two kinds of cursors aren't
+            interchangeable.
+
+        Returns:
+          (set of models.Target, list of google.cloud.ndb.Key,
+          google.cloud.ndb.Cursor, bool) tuple: delivery targets, followers to
+          add to :attr:`models.Object.feed`, cursor for the next page or None
+          if this is the last page, and whether this read
+          :class:`models.FollowerTarget`\s
+        """
+        if index is None:
+            index = FollowerTarget.initialized(user_key)
+
+        if not index:
+            followers, cursor = Protocol.load_followers(user_key, to_protocols,
+                                                        cursor=cursor)
+            feed = [f.from_ for f in followers
+                    if PROTOCOLS_BY_KIND[f.from_.kind()].USES_OBJECT_FEED]
+            return Protocol.follower_targets(followers), feed, cursor, False
+
+        labels = set(proto.LABEL for proto in to_protocols)
+        query = FollowerTarget.query(ancestor=user_key)
+        results, cursor, more = query.fetch_page(FANOUT_PAGE_SIZE,
+                                                 start_cursor=cursor)
+        targets = set()
+        feed = []
+        for entry in results:
+            # the INITIALIZED_ID marker doesn't have a protocol
+            if entry.protocol in labels:
+                targets.add(Target(protocol=entry.protocol, uri=entry.uri))
+                feed.extend(entry.feed)
+
+        return targets, feed, (cursor if more else None), True
+
+    @staticmethod
+    def follower_targets(followers):
+        r"""Returns the delivery targets for a list of followers, deduped.
+
+        Args:
+          followers (sequence of models.Follower)
+
+        Returns:
+          set of models.Target:
+        """
+        targets = set()
+        for f in followers:
+            if not f.target:
+                # TODO: surface errors like this somehow?
+                logger.error(f'Follower {f.from_} has no delivery target')
+                continue
+
+            proto = PROTOCOLS_BY_KIND[f.from_.kind()]
+            targets.add(Target(protocol=proto.LABEL, uri=f.target))
 
         return targets
 
+    @staticmethod
+    def load_multi(protos, deadline=None):
+        """Loads multiple objects, possibly from different protocols, in parallel.
+
+        Reads them all from the datastore in one batch, then fetches the ones
+        that are missing or stale over the network in parallel, in
+        :attr:`load_executor`. Otherwise like :meth:`load` with
+        ``raise_=False``.
+
+        Stored objects may come from :attr:`models.object_local_cache`, so
+        callers must treat the returned objects as read only and not put them.
+
+        Args:
+          protos (dict): maps str id to the :class:`Protocol` subclass to load
+            it with
+          deadline (float): optional :func:`time.monotonic` value to stop
+            waiting for network fetches at. Objects whose fetches haven't
+            finished by then are returned as None. Defaults to
+            :const:`TARGETS_DEADLINE` from now.
+
+        Returns:
+          dict: maps str id to :class:`models.Object`, or None if it couldn't
+          be loaded, in the same order as ``protos``
+        """
+        if not protos:
+            return {}
+
+        if deadline is None:
+            deadline = time.monotonic() + TARGETS_DEADLINE.total_seconds()
+
+        # warm the ndb context cache for the ones we don't have cached locally
+        context = ndb.get_context()
+        with object_local_cache_lock:
+            keys = [ndb.Key(Object, id) for id in protos
+                    if (len(id) <= _MAX_KEYPART_BYTES
+                        and id not in object_local_cache)]
+        ndb.get_multi([key for key in keys if key not in context.cache])
+
+        loaded = {}
+        fetches = {}  # maps id to Future
+        stale = util.as_utc(util.now() - OBJECT_REFRESH_AGE)
+        for id, proto in protos.items():
+            obj = proto.load(id, remote=False, cached=True)
+            if obj and obj.updated and obj.updated >= stale:
+                loaded[id] = obj
+                continue
+
+            def load(id=id, proto=proto):
+                with ndb_client.context(**NDB_CONTEXT_KWARGS), app.app_context():
+                    return proto.load(id, raise_=False)
+
+            fetches[id] = load_executor.submit(load)
+
+        for id, future in fetches.items():
+            try:
+                loaded[id] = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except TimeoutError:
+                logger.info(f'Gave up waiting on {id}')
+
+        return {id: loaded.get(id) for id in protos}
+
     @classmethod
-    def load(cls, id, remote=None, local=True, raise_=True, **kwargs):
+    def load(cls, id, remote=None, local=True, raise_=True, cached=False,
+             **kwargs):
         """Loads and returns an Object from datastore or HTTP fetch.
 
         Sets the :attr:`new` and :attr:`changed` attributes if we know either
@@ -1781,9 +2223,24 @@ Hi! You <a href="{inner_obj_as1.get('url') or inner_obj_id}">recently {verb}</a>
             datastore after a successful remote fetch.
           raise_ (bool): if False, catches any :class:`request.RequestException`
             or :class:`HTTPException` raised by :meth:`fetch()` and returns
-            ``None`` instead
+            ``None`` instead.
+          cached (bool): whether to check :attr:`models.object_local_cache`
+            before the datastore. Cached objects may be slightly stale, so
+            only read only callers should set this, and they must not put the
+            returned object. If we refresh it over the network, we reload it
+            from the datastore first.
           kwargs: passed through to :meth:`fetch()`
 
+        Failed fetches are remembered per id and protocol for a while, see
+        :func:`memcache.record_load_failure`. Callers opt into skipping ids that
+        recently failed by leaving ``remote`` as None, the default, which most
+        do, including :meth:`load_multi` for :meth:`targets` and
+        :meth:`for_id`'s candidates. Those get the same result as the failed
+        fetch without refetching: None, or an :class:`HTTPException` if
+        ``raise_`` is True. Callers that need fresh data, eg profile reloads
+        and ``remote=True`` refreshes, pass ``remote=True``, which always
+        fetches. Any successful fetch clears the failure.
+
         Returns:
           models.Object: loaded object, or None if it isn't fetchable, eg a
           non-URL string for Web, or ``remote`` is False and it isn't in the
@@ -1792,6 +2249,8 @@ Hi! You <a href="{inner_obj_as1.get('url') or inner_obj_id}">recently {verb}</a>
         Raises:
           requests.HTTPError: anything that :meth:`fetch` raises, if ``raise_``
             is True
+          werkzeug.exceptions.HTTPException: if ``remote`` is None, ``raise_``
+            is True, and a recent fetch of this id failed
         """
         assert id
         assert local or remote is not False
@@ -1799,7 +2258,8 @@ Hi! You <a href="{inner_obj_as1.get('url') or inner_obj_id}">recently {verb}</a>
 
         obj = orig_as1 = None
         if local:
-            obj = Object.get_by_id(id)
+            obj = (Object.get_by_id_cached(id) if cached
+                   else Object.get_by_id(id))
             if not obj:
                 # logger.debug(f' {id} not in datastore')
                 pass
@@ -1816,6 +2276,19 @@ Hi! You <a href="{inner_obj_as1.get('url') or inner_obj_id}">recently {verb}</a>
             else:
                 return obj
 
+        if remote is None:
+            if failure := memcache.load_failure(id, cls.LABEL):
+                logger.info(f'Not fetching {id}, recent failure: {failure}')
+                if raise_ and (exc := _load_failure_exception(id, failure)):
+                    raise exc
+                return None
+
+        if cached and obj:
+            # we're about to modify and store it, so don't use a cached copy
+            obj = Object.get_by_id(id)
+            if obj and (obj.as1 or obj.raw or obj.deleted):
+                obj.new = False
+
         if obj:
             orig_as1 = obj.as1
             obj.our_as1 = None
@@ -1830,20 +2303,31 @@ Hi! You <a href="{inner_obj_as1.get('url') or inner_obj_id}">recently {verb}</a>
         try:
             fetched = cls.fetch(obj, **kwargs)
         except (RequestException, HTTPException) as e:
+            code, _ = util.interpret_http_exception(e)
+            memcache.record_load_failure(id, cls.LABEL, _load_failure_type(e, code))
             if raise_:
                 raise
-            util.interpret_http_exception(e)
             return None
 
         if not fetched:
+            memcache.record_load_failure(id, cls.LABEL, 'empty')
             return None
 
-        # https://stackoverflow.com/a/3042250/186123
-        size = len(_entity_to_protobuf(obj)._pb.SerializeToString())
+        # only serialize to check exactly if the estimate is close to the limit
+        size = obj.estimate_size()
+        if size > models.MAX_ENTITY_SIZE * SIZE_ESTIMATE_THRESHOLD:
+            # https://stackoverflow.com/a/3042250/186123
+            size = len(_entity_to_protobuf(obj)._pb.SerializeToString())
         if size > models.MAX_ENTITY_SIZE:
             logger.warning(f'Object is too big! {size} bytes is over {models.MAX_ENTITY_SIZE}')
+            memcache.record_load_failure(id, cls.LABEL, 'too-big')
             return None
 
+        # remote=None only fetches if there's no recorded failure, so there's
+        # nothing to clear
+        if remote:
+            memcache.clear_load_failure(id, cls.LABEL)
+
         obj.resolve_ids()
         obj.normalize_ids()
 
@@ -1951,13 +2435,18 @@ def receive_task():
 
 @cloud_tasks_only(log=None)
 def send_task():
-    """Task handler for sending an activity to a single specific destination.
+    """Task handler for sending an activity to one or more destinations.
 
-    Calls :meth:`Protocol.send` with the form parameters.
+    Calls :meth:`Protocol.send` with the form parameters, or
+    :meth:`Protocol.send_batch` if there are multiple destinations. If only
+    some of a batch's destinations fail, enqueues a new task to retry them.
 
     Parameters:
       protocol (str): :class:`Protocol` to send to
       url (str): destination URL to send to
+      urls (str): space-separated destination URLs to send to, instead of ``url``
+      deferrals (int): how many times this task has been deferred because its
+        destinations' hosts were down
       obj_id (str): key id of :class:`models.Object` to send
       orig_obj_id (str): optional, :class:`models.Object` key id of the
         "original object" that this object refers to, eg replies to or reposts
@@ -1971,13 +2460,38 @@ def send_task():
 
     # prepare
     form = request.form.to_dict()
-    url = form.get('url')
+    urls = form.get('urls', '').split()
+    if url := form.get('url'):
+        urls.append(url)
     protocol = form.get('protocol')
-    if not url or not protocol:
-        logger.warning(f'Missing protocol or url; got {protocol} {url}')
+    if not urls or not protocol:
+        logger.warning(f'Missing protocol or url; got {protocol} {urls}')
         return '', 204
 
-    target = Target(uri=url, protocol=protocol)
+    def requeue(urls, delay=None, **overrides):
+        """Enqueues a new send task for a subset of this task's destinations."""
+        params = {k: v for k, v in form.items() if k not in ('url', 'urls')}
+        params.update(overrides)
+        if len(urls) == 1:
+            params['url'] = urls[0]
+        else:
+            params['urls'] = ' '.join(urls)
+        common.create_task('send', delay=delay, **params)
+
+    # defer sending to hosts that are down. after enough deferrals, try anyway.
+    deferrals = int(form.get('deferrals') or 0)
+    if deferrals < SEND_MAX_DEFERRALS:
+        hosts = {url: PROTOCOLS[protocol].send_host(url) for url in urls}
+        if down := memcache.hosts_retry_after(filter(None, hosts.values())):
+            deferred = [url for url in urls if hosts[url] in down]
+            urls = [url for url in urls if hosts[url] not in down]
+            retry_after = min(down.values())
+            logger.info(f'Deferring {deferred} until {retry_after}, their hosts are down')
+            requeue(deferred, delay=retry_after - util.now(),
+                    deferrals=deferrals + 1)
+            if not urls:
+                return '', 202
+
     obj = Object.from_request()
     assert obj and obj.key and obj.key.id()
 
@@ -1996,18 +2510,119 @@ def send_task():
     if request.headers.get('X-AppEngine-TaskRetryCount') == '0' and obj.created:
         delay_s = int((util.now().replace(tzinfo=None) - obj.created).total_seconds())
         delay = f'({delay_s} s behind)'
-    logger.info(f'Sending {obj.source_protocol} {obj.type} {obj.key.id()} to {protocol} {url} {delay}')
+    logger.info(f'Sending {obj.source_protocol} {obj.type} {obj.key.id()} to {protocol} {" ".join(urls)} {delay}')
     logger.debug(f'  AS1: {json_dumps(obj.as1, indent=2)}')
     sent = None
-    try:
-        sent = PROTOCOLS[protocol].send(obj, url, from_user=user,
-                                        orig_obj_id=form.get('orig_obj_id'))
-    except BaseException as e:
-        code, body = util.interpret_http_exception(e)
-        if not code and not body:
-            raise
+    orig_obj_id = form.get('orig_obj_id')
+    if len(urls) > 1:
+        results = PROTOCOLS[protocol].send_batch(obj, urls, from_user=user,
+                                                 orig_obj_id=orig_obj_id)
+        succeeded = sum(r is True for r in results.values())
+        logger.info(f'Sent to {succeeded} of {len(urls)}')
+        # True is success, False is a permanent failure, an exception may be
+        # temporary. if any destinations succeeded or failed permanently, retry
+        # the rest in a new task so that they don't get lost. otherwise, return
+        # an error so that Cloud Tasks retries this task as is.
+        failed = [url for url, r in results.items() if r is not True and r is not False]
+        if len(failed) == len(urls):
+            # nothing was sent, so raising doesn't re-deliver anywhere. match
+            # the single destination case below.
+            for e in results.values():
+                code, body = util.interpret_http_exception(e)
+                if not code and not body:
+                    raise e
+        elif failed:
+            logger.info(f'Retrying {failed} in a new task')
+            requeue(failed)
+        if succeeded:
+            sent = True
+        elif len(failed) < len(urls):
+            sent = False
+    else:
+        try:
+            sent = PROTOCOLS[protocol].send(obj, urls[0], from_user=user,
+                                            orig_obj_id=orig_obj_id)
+        except BaseException as e:
+            code, body = util.interpret_http_exception(e)
+            if not code and not body:
+                raise
 
     if sent is False:
         logger.info(f'Failed sending!')
 
     return '', 200 if sent else 204 if sent is False else 304
+
+
+@cloud_tasks_only(log=None)
+def fanout_task():
+    """Task handler for delivering an activity to one page of a user's followers.
+
+    :meth:`Protocol.deliver` starts a chain of these for users with more than
+    :const:`FANOUT_PAGE_SIZE` follower targets. Each one enqueues send tasks
+    for its page of targets, then a new fanout task for the next page, if any.
+
+    Parameters:
+      followee (url-safe google.cloud.ndb.key.Key): :class:`models.User` whose
+        followers to deliver to
+      cursor (str): url-safe :class:`google.cloud.ndb.Cursor` for this page
+      index (str): ``true`` or ``false``, whether to read
+        :class:`models.FollowerTarget`\s, see
+        :meth:`Protocol.load_follower_targets`
+      protocols (str): space-separated labels of protocols to deliver to
+      fanout_id (str): id of the activity being delivered, for
+        :class:`models.FanoutClaim`
+      feed_obj_id (str): optional, key id of :class:`models.Object` to add
+        these followers to the ``feed`` of
+      *: passed through to :func:`send_task`, eg ``user``, ``orig_obj_id``,
+        ``obj_id``
+    """
+    common.log_request()
+
+    form = request.form.to_dict()
+    params = dict(form)
+    followee = ndb.Key(urlsafe=form.pop('followee'))
+    cursor = ndb.Cursor(urlsafe=form.pop('cursor'))
+    index = form.pop('index', 'false') == 'true'
+    to_protocols = [PROTOCOLS[label] for label in form.pop('protocols').split()]
+    fanout_id = form.pop('fanout_id')
+    feed_obj_id = form.pop('feed_obj_id', None)
+
+    targets, feed, next_cursor, _ = Protocol.load_follower_targets(
+        followee, to_protocols, cursor=cursor, index=index)
+
+    # add to followers' feeds, if any
+    if feed_obj_id and feed:
+        if feed_obj := Object.get_by_id(feed_obj_id):
+            if any([feed_obj.add('feed', key) for key in feed]):
+                feed_obj.put()
+
+    if targets:
+        if not (obj := Object.from_request()) or not obj.as1:
+            error(f"Couldn't load object {form.get('obj_id')}", status=204)
+        targets = Protocol.filter_targets(
+            obj, {t: None for t in targets})
+
+    # skip targets that earlier pages, or earlier attempts at this page, already
+    # enqueued
+    claimed = FanoutClaim.claimed(fanout_id, [t.uri for t in targets])
+    logger.info(f'Delivering {fanout_id} to {len(targets)} follower targets of {followee}, {len(claimed)} already enqueued')
+    failed = Protocol.enqueue_sends(
+        {t: form.get('orig_obj_id') for t in targets if t.uri not in claimed},
+        raise_=False, **{k: v for k, v in form.items() if k != 'orig_obj_id'})
+    FanoutClaim.claim(fanout_id, [t.uri for t in targets
+                                  if t.uri not in claimed | failed])
+
+    # checkpoint: continue with the next page, once
+    if next_cursor:
+        next_cursor = next_cursor.urlsafe()
+        next_claim = f'cursor:{next_cursor}'
+        if not FanoutClaim.claimed(fanout_id, [next_claim]):
+            params['cursor'] = next_cursor
+            common.create_task(queue='fanout', **params)
+            FanoutClaim.claim(fanout_id, [next_claim])
+
+    if failed:
+        # Cloud Tasks retries this page, which skips the targets we enqueued
+        error(f"Couldn't enqueue send tasks for {sorted(failed)}", status=500)
+
+    return 'OK', 202
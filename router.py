@@ -31,10 +31,13 @@ app.wsgi_app = flask_util.ndb_context_middleware(
 app.add_url_rule('/queue/poll-feed', view_func=web.poll_feed_task, methods=['POST'])
 app.add_url_rule('/queue/receive', view_func=protocol.receive_task, methods=['POST'])
 app.add_url_rule('/queue/send', view_func=protocol.send_task, methods=['POST'])
+app.add_url_rule('/queue/fanout', view_func=protocol.fanout_task, methods=['POST'])
 app.add_url_rule('/queue/notify', view_func=notifications.notify_task, methods=['POST'])
 app.add_url_rule('/queue/webmention', view_func=web.webmention_task, methods=['POST'])
 app.add_url_rule('/cron/atproto-poll-chat', view_func=atproto.poll_chat_task,
                  methods=['GET'])
+app.add_url_rule('/cron/refill-rsa-key-pool',
+                 view_func=models.refill_rsa_key_pool_task, methods=['GET'])
 # app.add_url_rule('/router/eval', view_func=pages.python_eval, methods=['POST'])
 
 
@@ -0,0 +1,93 @@
+"""Backfills CopyIndex entries from existing User and Object copies.
+
+For each kind, queries for entities with copies in each protocol that has
+them, in pages, and writes any missing or stale CopyIndex entries. Safe to
+rerun or interrupt. Prints the query cursor after each page, which can be
+passed back in to resume. Once it's finished for every kind, set
+models.COPY_INDEX_BACKFILLED to True so that lookups stop falling back to
+queries on index misses.
+
+Usage: backfill_copy_index.py [KIND [PROTOCOL [CURSOR]]]
+
+KIND: kind to backfill, eg Object or ATProto. Defaults to all of them.
+PROTOCOL: protocol label of the copies to backfill, eg atproto or nostr.
+  Defaults to all protocols with copies.
+CURSOR: urlsafe query cursor to resume from.
+
+Run from repo top level directory:
+
+source local/bin/activate.csh
+env PYTHONPATH=. GOOGLE_APPLICATION_CREDENTIALS=service_account_creds.json \
+  python scripts/backfill_copy_index.py [KIND [PROTOCOL [CURSOR]]]
+"""
+import sys
+
+from google.cloud.ndb.query import Cursor
+from oauth_dropins.webutil import appengine_config
+
+# import protocols so that they're registered in PROTOCOLS_BY_KIND
+from activitypub import ActivityPub
+from atproto import ATProto
+from common import NDB_CONTEXT_KWARGS
+import ids
+import models
+from models import CopyIndex, PROTOCOLS_BY_KIND
+from nostr import Nostr
+from web import Web
+
+PAGE_SIZE = 500
+
+
+def backfill(kind, label, cursor=None):
+    """Backfills one kind's copies in one protocol.
+
+    Args:
+      kind (str)
+      label (str)
+      cursor (google.cloud.ndb.query.Cursor): optional, where to start
+
+    Returns:
+      int: number of entities processed
+    """
+    model = PROTOCOLS_BY_KIND.get(kind) or models.Object
+    query = model.query(model.copies.protocol == label).order(model.key)
+
+    count = 0
+    more = True
+    while more:
+        entities, cursor, more = query.fetch_page(PAGE_SIZE, start_cursor=cursor)
+        CopyIndex.update_for(*entities)
+        count += len(entities)
+        print(f'{kind} {label}: {count} '
+              f'{cursor.urlsafe().decode() if cursor else ""}', flush=True)
+
+    return count
+
+
+def run():
+    models.reset_protocol_properties()
+
+    kinds = ['Object'] + sorted(kind for kind, proto in PROTOCOLS_BY_KIND.items()
+                                if proto.LABEL != 'ui')
+    labels = ids.COPIES_PROTOCOLS
+    cursor = None
+
+    if len(sys.argv) > 1:
+        assert sys.argv[1] in kinds, f'Unknown kind {sys.argv[1]}'
+        kinds = [sys.argv[1]]
+    if len(sys.argv) > 2:
+        assert sys.argv[2] in labels, f'{sys.argv[2]} has no copies'
+        labels = [sys.argv[2]]
+    if len(sys.argv) > 3:
+        cursor = Cursor(urlsafe=sys.argv[3])
+
+    for kind in kinds:
+        for label in labels:
+            count = backfill(kind, label, cursor=cursor)
+            print(f'{kind} {label}: done, {count} total')
+            cursor = None
+
+
+if __name__ == '__main__':
+    with appengine_config.ndb_client.context(**NDB_CONTEXT_KWARGS):
+        run()
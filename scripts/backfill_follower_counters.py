@@ -0,0 +1,92 @@
+"""Initializes FollowerCounters for existing users.
+
+For each user kind, pages through users and, for each user whose followers or
+following counter isn't initialized yet, or is missing any shards, sets it from
+a count query with FollowerCounter.reconcile. Safe to rerun or interrupt. Prints the query cursor
+after each page, which can be passed back in to resume.
+
+Usage: backfill_follower_counters.py [KIND [CURSOR]]
+
+KIND: user kind to backfill, eg ActivityPub or ATProto. Defaults to all of them.
+CURSOR: urlsafe query cursor to resume from.
+
+Run from repo top level directory:
+
+source local/bin/activate.csh
+env PYTHONPATH=. GOOGLE_APPLICATION_CREDENTIALS=service_account_creds.json \
+  python scripts/backfill_follower_counters.py [KIND [CURSOR]]
+"""
+import sys
+
+from google.cloud import ndb
+from google.cloud.ndb.query import Cursor
+from oauth_dropins.webutil import appengine_config
+
+# import protocols so that they're registered in PROTOCOLS_BY_KIND
+from activitypub import ActivityPub
+from atproto import ATProto
+from common import NDB_CONTEXT_KWARGS
+import models
+from models import FollowerCounter, PROTOCOLS_BY_KIND
+from nostr import Nostr
+from web import Web
+
+PAGE_SIZE = 500
+COLLECTIONS = ('followers', 'following')
+
+
+def backfill(kind, cursor=None):
+    """Initializes one kind's users' counters.
+
+    Args:
+      kind (str)
+      cursor (google.cloud.ndb.query.Cursor): optional, where to start
+
+    Returns:
+      int: number of counters initialized
+    """
+    model = PROTOCOLS_BY_KIND[kind]
+    query = model.query().order(model.key)
+
+    count = 0
+    more = True
+    while more:
+        keys, cursor, more = query.fetch_page(PAGE_SIZE, start_cursor=cursor,
+                                              keys_only=True)
+        todo = [(key, collection) for key in keys for collection in COLLECTIONS]
+        shards = ndb.get_multi([shard_key for key, collection in todo
+                                for shard_key in FollowerCounter.keys(key, collection)])
+        for i, (key, collection) in enumerate(todo):
+            num = FollowerCounter.NUM_SHARDS
+            if not all(shards[i * num:(i + 1) * num]):
+                FollowerCounter.reconcile(key, collection)
+                count += 1
+
+        print(f'{kind}: {count} {cursor.urlsafe().decode() if cursor else ""}',
+              flush=True)
+
+    return count
+
+
+def run():
+    models.reset_protocol_properties()
+
+    kinds = sorted(kind for kind, proto in PROTOCOLS_BY_KIND.items()
+                   if proto.LABEL != 'ui')
+    cursor = None
+
+    if len(sys.argv) > 1:
+        assert sys.argv[1] in kinds, f'Unknown kind {sys.argv[1]}'
+        kinds = [sys.argv[1]]
+    if len(sys.argv) > 2:
+        cursor = Cursor(urlsafe=sys.argv[2])
+
+    for kind in kinds:
+        count = backfill(kind, cursor=cursor)
+        print(f'{kind}: done, {count} counters initialized')
+        cursor = None
+
+
+if __name__ == '__main__':
+    with appengine_config.ndb_client.context(**NDB_CONTEXT_KWARGS):
+        run()
@@ -0,0 +1,90 @@
+"""Initializes FollowerTargets for existing users.
+
+For each user kind, pages through users and, for each user whose
+FollowerTargets aren't initialized yet, builds them from their active Followers
+with FollowerTarget.reconcile. Safe to rerun or interrupt. Prints the query
+cursor after each page, which can be passed back in to resume.
+
+Usage: backfill_follower_targets.py [KIND [CURSOR]]
+
+KIND: user kind to backfill, eg ActivityPub or ATProto. Defaults to all of them.
+CURSOR: urlsafe query cursor to resume from.
+
+Run from repo top level directory:
+
+source local/bin/activate.csh
+env PYTHONPATH=. GOOGLE_APPLICATION_CREDENTIALS=service_account_creds.json \
+  python scripts/backfill_follower_targets.py [KIND [CURSOR]]
+"""
+import sys
+
+from google.cloud import ndb
+from google.cloud.ndb.query import Cursor
+from oauth_dropins.webutil import appengine_config
+
+# import protocols so that they're registered in PROTOCOLS_BY_KIND
+from activitypub import ActivityPub
+from atproto import ATProto
+from common import NDB_CONTEXT_KWARGS
+import models
+from models import FollowerTarget, PROTOCOLS_BY_KIND
+from nostr import Nostr
+from web import Web
+
+PAGE_SIZE = 500
+
+
+def backfill(kind, cursor=None):
+    """Initializes one kind's users' follower targets.
+
+    Args:
+      kind (str)
+      cursor (google.cloud.ndb.query.Cursor): optional, where to start
+
+    Returns:
+      int: number of users initialized
+    """
+    model = PROTOCOLS_BY_KIND[kind]
+    query = model.query().order(model.key)
+
+    count = 0
+    more = True
+    while more:
+        keys, cursor, more = query.fetch_page(PAGE_SIZE, start_cursor=cursor,
+                                              keys_only=True)
+        markers = ndb.get_multi([
+            ndb.Key(FollowerTarget, FollowerTarget.INITIALIZED_ID, parent=key)
+            for key in keys])
+        for key, marker in zip(keys, markers):
+            if not marker:
+                FollowerTarget.reconcile(key)
+                count += 1
+
+        print(f'{kind}: {count} {cursor.urlsafe().decode() if cursor else ""}',
+              flush=True)
+
+    return count
+
+
+def run():
+    models.reset_protocol_properties()
+
+    kinds = sorted(kind for kind, proto in PROTOCOLS_BY_KIND.items()
+                   if proto.LABEL != 'ui')
+    cursor = None
+
+    if len(sys.argv) > 1:
+        assert sys.argv[1] in kinds, f'Unknown kind {sys.argv[1]}'
+        kinds = [sys.argv[1]]
+    if len(sys.argv) > 2:
+        cursor = Cursor(urlsafe=sys.argv[2])
+
+    for kind in kinds:
+        count = backfill(kind, cursor=cursor)
+        print(f'{kind}: done, {count} users initialized')
+        cursor = None
+
+
+if __name__ == '__main__':
+    with appengine_config.ndb_client.context(**NDB_CONTEXT_KWARGS):
+        run()
@@ -0,0 +1,95 @@
+"""Benchmarks common.CompactSet vs a plain set for the firehose's DID filters.
+
+Measures memory, including the DID strings themselves, and lookup time for
+hits and misses. Defaults to 10M DIDs. The plain set needs ~1.2GB at that size.
+
+Also measures CompactSet build time three ways: the constructor, a single bulk
+update() into an empty set, like atproto_firehose's initial load, and
+incremental update()s in batches of UPDATE_BATCH, like its periodic reloads.
+
+Run from repo top level directory:
+
+env PYTHONPATH=. python scripts/benchmark_compact_set.py [NUM_DIDS]
+
+Results on a single core VM, Python 3.11, 10M DIDs:
+
+set: 1028.5 MB, 0.18 us/hit, 0.21 us/miss
+CompactSet: 78.1 MB, 1.71 us/hit, 1.69 us/miss
+CompactSet constructor: 10.0 s
+CompactSet bulk update(): 10.7 s
+CompactSet update() in batches of 1000: 57.9 s
+"""
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+from common import CompactSet
+
+ALPHABET = string.ascii_lowercase + '234567'
+NUM_LOOKUPS = 1000000
+UPDATE_BATCH = 1000
+
+
+def random_dids(num, seed):
+    """Generates did:plc DIDs deterministically, so that we can regenerate them."""
+    rand = random.Random(seed)
+    for _ in range(num):
+        yield 'did:plc:' + ''.join(rand.choices(ALPHABET, k=24))
+
+
+def measure(name, build, num, hits, misses):
+    tracemalloc.start()
+    elems = build(random_dids(num, seed=0))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    lookup_times = []
+    for lookups in hits, misses:
+        start = time.perf_counter()
+        for did in lookups:
+            did in elems
+        lookup_times.append((time.perf_counter() - start) / len(lookups) * 1e6)
+
+    hit, miss = lookup_times
+    print(f'{name}: {size / 1024 / 1024:.1f} MB, {hit:.2f} us/hit, {miss:.2f} us/miss')
+
+
+def measure_build(num):
+    dids = list(random_dids(num, seed=0))
+
+    def construct():
+        CompactSet(dids)
+
+    def bulk_update():
+        CompactSet().update(dids)
+
+    def incremental_update():
+        elems = CompactSet()
+        for i in range(0, num, UPDATE_BATCH):
+            elems.update(dids[i:i + UPDATE_BATCH])
+
+    for name, fn in (('constructor', construct),
+                     ('bulk update()', bulk_update),
+                     (f'update() in batches of {UPDATE_BATCH}', incremental_update)):
+        start = time.perf_counter()
+        fn()
+        print(f'CompactSet {name}: {time.perf_counter() - start:.1f} s')
+
+
+def main():
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 10 * 1000 * 1000
+    print(f'{num} DIDs, {NUM_LOOKUPS} lookups each')
+
+    # new string objects, so that their cached hashes don't skew lookup times
+    hits = list(random_dids(min(num, NUM_LOOKUPS), seed=0))
+    misses = list(random_dids(NUM_LOOKUPS, seed=1))
+
+    measure('set', set, num, hits, misses)
+    measure('CompactSet', CompactSet, num, hits, misses)
+    measure_build(num)
+
+
+if __name__ == '__main__':
+    main()
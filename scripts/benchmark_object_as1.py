@@ -0,0 +1,119 @@
+"""Benchmarks Protocol.receive with and without Object.as1's per-instance cache.
+
+Receives ITERATIONS new AS2 Create activities from a user with NUM_FOLLOWERS
+followers, through Protocol.receive, targets, and enqueueing send tasks. Runs
+it once with the cache and once with Object.as1 converting on every read. Also
+counts how many times receive reads as1.
+
+Uses the test harness, so it needs the datastore emulator running, like the
+tests. Run from repo top level directory:
+
+env PYTHONPATH=. python scripts/benchmark_object_as1.py [ITERATIONS]
+"""
+import copy
+import sys
+import time
+import unittest
+from unittest.mock import patch
+
+# import first so that Fake is defined before URL routes are registered
+from tests.testutil import Fake, OtherFake, TestCase
+
+import common
+from models import Follower, Object
+
+NUM_FOLLOWERS = 20
+ITERATIONS = 100
+
+AS2_CREATE = {
+    '@context': 'https://www.w3.org/ns/activitystreams',
+    'type': 'Create',
+    'actor': 'fake:user',
+    'to': ['https://www.w3.org/ns/activitystreams#Public'],
+    'object': {
+        'type': 'Note',
+        'attributedTo': 'fake:user',
+        'content': '<p>hi <a href="other:bob" class="mention">@bob</a></p>',
+        'published': '2024-01-02T03:04:05Z',
+        'inReplyTo': 'other:post',
+        'tag': [{
+            'type': 'Mention',
+            'href': 'other:bob',
+            'name': '@bob',
+        }, {
+            'type': 'Hashtag',
+            'href': 'https://mas.to/tags/x',
+            'name': '#x',
+        }],
+        'attachment': [{
+            'type': 'Document',
+            'mediaType': 'image/jpeg',
+            'url': 'https://mas.to/pic.jpg',
+            'name': 'alt text',
+        }],
+        'to': ['https://www.w3.org/ns/activitystreams#Public'],
+        'cc': ['fake:user/followers'],
+    },
+}
+
+
+class Benchmark(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        common.RUN_TASKS_INLINE = False
+
+        self.user = self.make_user('fake:user', cls=Fake, obj_id='fake:user')
+        self.make_user('other:bob', cls=OtherFake, obj_id='other:bob')
+        self.store_object(id='other:post', source_protocol='other', our_as1={
+            'objectType': 'note',
+            'id': 'other:post',
+            'author': 'other:bob',
+        })
+        for i in range(NUM_FOLLOWERS):
+            follower = self.make_user(f'other:{i}', cls=OtherFake,
+                                      obj_id=f'other:{i}')
+            Follower.get_or_create(to=self.user, from_=follower)
+
+    def receive(self, name, iterations):
+        start = time.perf_counter()
+        for i in range(iterations):
+            create = copy.deepcopy(AS2_CREATE)
+            create['id'] = f'fake:{name}:{i}#create'
+            create['object']['id'] = f'fake:{name}:{i}'
+            obj = Object(id=create['id'], as2=create, source_protocol='fake')
+            obj.new = True
+            Fake.receive(obj, authed_as='fake:user')
+
+        return (time.perf_counter() - start) / iterations * 1e3
+
+    @patch('oauth_dropins.webutil.appengine_config.tasks_client.create_task')
+    def test_receive(self, _):
+        iterations = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+        print(f'\n{NUM_FOLLOWERS} followers, {iterations} activities')
+
+        reads = 0
+        as1 = Object.as1
+
+        def counted(obj):
+            nonlocal reads
+            reads += 1
+            return as1.fget(obj)
+
+        with patch.object(Object, 'as1', property(counted)):
+            self.receive('count', 1)
+        print(f'{reads} as1 reads per activity')
+
+        # warm up
+        self.receive('warm', 5)
+
+        with patch.object(Object, 'as1', property(Object._convert_as1)):
+            uncached = self.receive('uncached', iterations)
+        cached = self.receive('cached', iterations)
+
+        print(f'uncached: {uncached:.2f} ms/activity')
+        print(f'cached: {cached:.2f} ms/activity')
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
@@ -5,7 +5,7 @@ from datetime import datetime, timedelta, UTC
 from hashlib import sha256
 import logging
 from unittest import skip
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 from google.cloud import ndb
 from granary import as1, as2, microformats2
@@ -36,7 +36,13 @@ from atproto import ATProto
 import common
 from flask_app import app
 import memcache
-from models import Follower, Object, Target
+from models import (
+    Follower,
+    FOLLOWERS_FALLBACK_COUNT_LIMIT,
+    FollowerCounter,
+    Object,
+    Target,
+)
 import protocol
 from protocol import DELETE_TASK_DELAY
 from web import Web
@@ -1473,6 +1479,60 @@ class ActivityPubTest(TestCase):
             self.as2_req('http://mas.to/key/id'),
         ))
 
+    def test_inbox_verify_sig_caches_key(self, _, mock_get, __):
+        mock_get.return_value = self.as2_resp(self.key_id_obj.as2)
+
+        note = {**NOTE, 'actor': 'http://mas.to/key/id'}
+        body = json_dumps(note)
+        headers = sign('/ap/sharedInbox', body, key_id='http://mas.to/key/id')
+        resp = self.client.post('/ap/sharedInbox', data=body, headers=headers)
+        self.assertEqual(204, resp.status_code, resp.get_data(as_text=True))
+
+        body = json_dumps({**note, 'id': 'http://mas.to/note/2'})
+        headers = sign('/ap/sharedInbox', body, key_id='http://mas.to/key/id')
+        with patch.object(ActivityPub, '_load_key') as mock_load_key:
+            resp = self.client.post('/ap/sharedInbox', data=body, headers=headers)
+            self.assertEqual(204, resp.status_code, resp.get_data(as_text=True))
+            mock_load_key.assert_not_called()
+
+    def test_inbox_verify_sig_cached_key_fails_reloads(self, _, mock_get, __):
+        mock_get.return_value = self.as2_resp(self.key_id_obj.as2)
+        activitypub.public_keys['http://mas.to/key/id'] = (
+            'http://mas.to/key/id', 'not a key', False)
+
+        note = {**NOTE, 'actor': 'http://mas.to/key/id'}
+        body = json_dumps(note)
+        headers = sign('/ap/sharedInbox', body, key_id='http://mas.to/key/id')
+        resp = self.client.post('/ap/sharedInbox', data=body, headers=headers)
+        self.assertEqual(204, resp.status_code, resp.get_data(as_text=True))
+        self.assertEqual(self.key_id_obj.as2['publicKey']['publicKeyPem'],
+                         activitypub.public_keys['http://mas.to/key/id'][1])
+
+    def test_inbox_verify_sig_caches_deleted_signer(self, _, mock_get, __):
+        actor = self.make_user(DELETE['actor'], cls=ActivityPub)
+        actor.obj.deleted = True
+        actor.obj.put()
+
+        got = self.post('/ap/sharedInbox', json=DELETE)
+        self.assertEqual(202, got.status_code)
+        self.assertEqual((DELETE['actor'], None, True),
+                         activitypub.public_keys[DELETE['actor']])
+
+        with patch.object(ActivityPub, '_load_key') as mock_load_key:
+            got = self.post('/ap/sharedInbox', json=DELETE)
+            self.assertEqual(202, got.status_code)
+            mock_load_key.assert_not_called()
+
+    def test_evict_public_keys(self, _, mock_get, __):
+        activitypub.public_keys.update({
+            'http://mas.to/key/1': ('http://mas.to/users/a', 'foo', False),
+            'http://mas.to/key/2': ('http://mas.to/users/a', 'bar', False),
+            'http://mas.to/key/3': ('http://mas.to/users/b', 'baz', False),
+        })
+
+        ActivityPub.evict_public_keys('http://mas.to/users/a')
+        self.assertEqual(['http://mas.to/key/3'], list(activitypub.public_keys))
+
     def test_inbox_verify_sig_fetch_key_fails(self, _, mock_get, __):
         # https://console.cloud.google.com/errors/detail/COLzgISI47vpMg?project=bridgy-federated
         # bad keyId, requests would raise InvalidURL
@@ -1934,6 +1994,19 @@ class ActivityPubTest(TestCase):
             },
         }, resp.json)
 
+    def test_followers_collection_uncounted_over_limit(self, *_):
+        # counter isn't initialized, and there are more followers than the
+        # fallback query counts, so we don't know the total
+        ndb.delete_multi(FollowerCounter.keys(self.user.key, 'followers'))
+        bar = self.make_user('http://bar', cls=ActivityPub, obj_as2=ACTOR)
+        with patch.object(FollowerCounter, 'increment'):
+            ndb.put_multi([Follower(from_=bar.key, to=self.user.key)
+                           for _ in range(FOLLOWERS_FALLBACK_COUNT_LIMIT + 1)])
+
+        resp = self.client.get('/user.com/followers')
+        self.assertEqual(200, resp.status_code)
+        self.assertNotIn('totalItems', resp.json)
+
     def test_followers_collection_protocol_bot_user(self, *_):
         self.user = self.make_user('bsky.brid.gy', cls=Web, ap_subdomain='bsky')
         self.store_followers()
@@ -3563,6 +3636,97 @@ class ActivityPubUtilsTest(TestCase):
                                           from_user=None))
         mock_post.assert_not_called()
 
+    def test_signature_auth_cached(self):
+        auth = activitypub.signature_auth(self.user)
+        self.assertIs(auth, activitypub.signature_auth(self.user))
+        self.assertIs(auth, activitypub.signature_auth(Web.get_by_id('user.com')))
+        other = self.make_user('other.com', cls=Web)
+        self.assertIsNot(auth, activitypub.signature_auth(other))
+
+    def test_delivery_client_session_per_host(self):
+        sessions = []
+        def new_session():
+            session = MagicMock()
+            session.post.return_value = requests_response()
+            sessions.append(session)
+            return session
+
+        client = activitypub.DeliveryClient(new_session=new_session)
+        client.post('https://a/inbox', data=b'x')
+        client.post('https://a/other', data=b'y')
+        client.post('https://b/inbox', data=b'z')
+
+        self.assertEqual(2, len(sessions))
+        self.assertEqual(2, sessions[0].post.call_count)
+        sessions[0].post.assert_called_with(
+            'https://a/other', data=b'y', headers={'User-Agent': util.user_agent},
+            timeout=util.HTTP_TIMEOUT, stream=True)
+        self.assertEqual(1, sessions[1].post.call_count)
+
+    @patch('requests.post', side_effect=[
+        requests_response(status=500),
+        requests.Timeout('foo'),
+        requests_response(status=500),
+    ])
+    def test_delivery_client_gateway(self, _):
+        client = activitypub.DeliveryClient(new_session=lambda: requests)
+
+        with self.assertRaises(BadGateway):
+            client.post('https://a/inbox', gateway=True)
+        with self.assertRaises(BadGateway):
+            client.post('https://a/inbox', gateway=True)
+        self.assertEqual(500, client.post('https://a/inbox').status_code)
+
+    def test_delivery_client_default_session(self):
+        client = activitypub.DeliveryClient()
+
+        session, _ = client._host('a')
+        self.assertIsInstance(session.cookies, util.NoCookieJar)
+
+        # bad URLs are still 400s, not 502s
+        with self.assertRaises(BadRequest):
+            client.get('http://', gateway=True)
+
+        # response size limit
+        too_big = 'x' * (util.MAX_HTTP_RESPONSE_SIZE + 1)
+        with patch.object(requests.Session, 'post', autospec=True,
+                          return_value=requests_response(
+                              too_big, content_type='text/plain')) as mock_post:
+            resp = client.post('https://a/inbox', data=b'x')
+
+        self.assertEqual(util.HTTP_RESPONSE_TOO_BIG_STATUS_CODE, resp.status_code)
+        self.assertNotIn(too_big, resp.text)
+        self.assertIs(session, mock_post.call_args_list[0].args[0])
+
+    @patch('activitypub.SEND_RETRY_DELAY_S', 0)
+    @patch('requests.post', side_effect=[
+        requests_response(status=503),
+        requests_response(),
+        requests_response(status=400),
+    ])
+    def test_send_batch(self, mock_post):
+        results = ActivityPub.send_batch(Object(as2=NOTE), [
+            'https://a/inbox',
+            'https://b/inbox',
+            'https://fed.brid.gy/ap/sharedInbox',
+        ], from_user=self.user)
+
+        self.assertTrue(results['https://a/inbox'])
+        self.assertIsInstance(results['https://b/inbox'], requests.HTTPError)
+        self.assertFalse(results['https://fed.brid.gy/ap/sharedInbox'])
+
+        # one serialized body and signature for all inboxes, 503 is retried
+        self.assertEqual(['https://a/inbox', 'https://a/inbox', 'https://b/inbox'],
+                         [args[0] for args, _ in mock_post.call_args_list])
+        self.assertEqual(1, len({kwargs['data'] for _, kwargs in mock_post.call_args_list}))
+        self.assertEqual(1, len({id(kwargs['auth']) for _, kwargs in mock_post.call_args_list}))
+
+    @patch('requests.post')
+    def test_send_batch_no_from_user(self, mock_post):
+        self.assertEqual({ACTOR['inbox']: False},
+                         ActivityPub.send_batch(Object(as2=NOTE), [ACTOR['inbox']]))
+        mock_post.assert_not_called()
+
     @patch('requests.post', return_value=requests_response())
     def test_send_convert_ids(self, mock_post):
         like = Object(our_as1={
@@ -1,8 +1,10 @@
 """Unit tests for atproto.py."""
 import base64
+from concurrent.futures import ThreadPoolExecutor
 import copy
-from datetime import timezone
+from datetime import timedelta, timezone
 from pathlib import Path
+import threading
 from unittest import skip
 from unittest.mock import ANY, call, MagicMock, patch
 
@@ -881,6 +883,40 @@ class ATProtoTest(TestCase):
         }), fetch_blobs=True))
         mock_get.assert_has_calls([self.req('http://my/pic/1'), self.req('http://my/pic/2')])
 
+    def test_convert_fetch_blobs_true_image_fetch_times_out(self):
+        slow = threading.Event()
+
+        def get(url, *args, **kwargs):
+            if url == 'http://my/pic/1':
+                slow.wait(5)
+                return requests_response(status=504)
+            return requests_response('second blob contents',
+                                     content_type='image/png')
+
+        with patch('requests.get', side_effect=get), \
+             patch.object(atproto, 'BLOB_FETCH_DEADLINE', timedelta(seconds=.5)), \
+             patch.object(atproto, 'blob_executor', ThreadPoolExecutor(2)):
+            got = ATProto.convert(Object(our_as1={
+                'objectType': 'note',
+                'image': [
+                    {'url': 'http://my/pic/1'},
+                    {'url': 'http://my/pic/2'},
+                ],
+            }), fetch_blobs=True)
+        slow.set()
+
+        cid = CID.decode('bafkreigapis7qpqslq2njkxnn6lgbrnf75byeilrt52ufhpr3uz2vrugfe')
+        self.assertEqual([{
+            '$type': 'app.bsky.embed.images#image',
+            'alt': '',
+            'image': {
+                '$type': 'blob',
+                'mimeType': 'image/png',
+                'ref': cid,
+                'size': 20,
+            },
+        }], got['embed']['images'])
+
     def test_convert_fetch_blobs_true_existing_atp_remote_blob(self):
         cid = 'bafkreicqpqncshdd27sgztqgzocd3zhhqnnsv6slvzhs5uz6f57cq6lmtq'
         AtpRemoteBlob(id='http://my/pic', cid=cid, size=8,
@@ -1186,7 +1222,9 @@ Sed tortor neque, aliquet quis posuere aliquam […]
     ])
     def test_migrate_in(self, _, mock_post):
         self.make_user_and_repo()
-        self.user.copies = self.user.enabled_protocols = []
+        for copy in list(self.user.copies):
+            self.user.remove('copies', copy)
+        self.user.enabled_protocols = []
         self.user.put()
 
         repo = self.storage.load_repo('did:plc:user')
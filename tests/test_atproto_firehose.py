@@ -1,8 +1,9 @@
 """Unit tests for atproto_firehose.py."""
 import copy
 from datetime import datetime, timedelta, timezone
+from queue import Queue
 from unittest import skip
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 from arroba.datastore_storage import AtpRepo
 import arroba.util
@@ -27,8 +28,10 @@ import simple_websocket
 
 from atproto import ATProto, Cursor
 import atproto_firehose
-from atproto_firehose import commits, handle, Op, STORE_CURSOR_FREQ
+from atproto_firehose import commits, handle, Op, Shards, STORE_CURSOR_FREQ
 import common
+from common import CompactSet, DID_CHANGES_FEED
+import memcache
 from models import Object, Target
 import protocol
 from protocol import DELETE_TASK_DELAY
@@ -47,12 +50,14 @@ def setup_firehose():
     assert commits.empty()
 
     atproto_firehose.cursor = None
-    atproto_firehose.atproto_dids = set()
+    atproto_firehose.shards = None
+    atproto_firehose.atproto_dids = CompactSet()
     atproto_firehose.atproto_loaded_at = datetime(1900, 1, 1)
-    atproto_firehose.bridged_dids = set()
+    atproto_firehose.bridged_dids = CompactSet()
     atproto_firehose.bridged_loaded_at = datetime(1900, 1, 1)
-    atproto_firehose.protocol_bot_dids = set()
+    atproto_firehose.protocol_bot_dids = CompactSet()
     atproto_firehose.dids_initialized.clear()
+    atproto_firehose.did_changes_seq = None
 
     cursor = Cursor(id='bgs.local com.atproto.sync.subscribeRepos')
     cursor.put()
@@ -474,9 +479,10 @@ class ATProtoFirehoseSubscribeTest(ATProtoTestCase):
         self.cursor.cursor = 1
         self.cursor.put()
 
-        FakeWebsocketClient.setup_receive(Op(repo='did:plc:user', action='create',
-                                             path='y', seq=4, record={'foo': 'bar'}))
-        with patch('libipld.decode_car', side_effect=RuntimeError('oops')), \
+        FakeWebsocketClient.setup_receive(Op(
+            repo='did:plc:user', action='create', path='app.bsky.feed.post/y',
+            seq=4, record={'foo': 'bar'}))
+        with patch('atproto_firehose.read_blocks', side_effect=RuntimeError('oops')), \
               self.assertRaises(RuntimeError):
             self.subscribe()
 
@@ -493,6 +499,35 @@ class ATProtoFirehoseSubscribeTest(ATProtoTestCase):
             'https://bgs.local/xrpc/com.atproto.sync.subscribeRepos?cursor=5',
             FakeWebsocketClient.url)
 
+    @patch('atproto_firehose.read_blocks')
+    def test_skip_unsupported_collection_without_decoding(self, mock_read_blocks):
+        self.assert_doesnt_enqueue({
+            '$type': 'app.bsky.feed.post',
+        }, path='app.bsky.nopey.nope/123')
+        mock_read_blocks.assert_not_called()
+
+    @patch('atproto_firehose.read_blocks')
+    def test_skip_unbridged_like_without_decoding(self, mock_read_blocks):
+        self.assert_doesnt_enqueue({
+            '$type': 'app.bsky.feed.like',
+            'subject': {'uri': 'at://did:alice/app.bsky.feed.post/tid'},
+        }, repo='did:plc:bob', path='app.bsky.feed.like/123')
+        mock_read_blocks.assert_not_called()
+
+    def test_read_blocks(self):
+        foo = Block(decoded={'foo': 'bar'})
+        baz = Block(decoded={'baz': 'biff'})
+        car = write_car([foo.cid], [foo, baz])
+
+        self.assertEqual({}, atproto_firehose.read_blocks(b'', [foo.cid.encode()]))
+        self.assertEqual({baz.cid.encode(): {'baz': 'biff'}},
+                         atproto_firehose.read_blocks(car, [baz.cid.encode()]))
+        self.assertEqual({
+            foo.cid.encode(): {'foo': 'bar'},
+            baz.cid.encode(): {'baz': 'biff'},
+        }, atproto_firehose.read_blocks(car, [foo.cid.encode(), baz.cid.encode(),
+                                              A_CID.encode()]))
+
     def test_load_dids_updated_atproto_user(self):
         self.cursor.cursor = 1
         self.cursor.put()
@@ -526,6 +561,54 @@ class ATProtoFirehoseSubscribeTest(ATProtoTestCase):
         self.subscribe()
         self.assertNotIn('did:plc:eve', atproto_firehose.atproto_dids)
 
+    def test_load_dids_removes_opted_out_atproto_user(self):
+        self.cursor.cursor = 1
+        self.cursor.put()
+
+        util.now = lambda: datetime.now(timezone.utc).replace(tzinfo=None)
+        self.subscribe()
+        self.assertIn('did:plc:user', atproto_firehose.atproto_dids)
+
+        self.user.manual_opt_out = True
+        self.user.put()
+        self.assertGreater(self.user.updated, atproto_firehose.atproto_loaded_at)
+
+        self.assert_doesnt_enqueue(POST_BSKY)
+        self.assertNotIn('did:plc:user', atproto_firehose.atproto_dids)
+
+    def test_read_did_changes(self):
+        atproto_firehose.load_dids()
+        self.assertNotIn('did:plc:eve', atproto_firehose.atproto_dids)
+
+        self.store_object(id='did:plc:eve', raw=DID_DOC)
+        self.make_user('did:plc:eve', cls=ATProto, enabled_protocols=['efake'])
+        memcache.append_to_feed(DID_CHANGES_FEED, ('bridged', 'did:plc:frank', True))
+
+        atproto_firehose._read_did_changes()
+        self.assertIn('did:plc:eve', atproto_firehose.atproto_dids)
+        self.assertIn('did:plc:frank', atproto_firehose.bridged_dids)
+
+        self.user.manual_opt_out = True
+        self.user.put()
+        memcache.append_to_feed(DID_CHANGES_FEED, ('bridged', 'did:plc:frank', False))
+
+        atproto_firehose._read_did_changes()
+        self.assertNotIn('did:plc:user', atproto_firehose.atproto_dids)
+        self.assertNotIn('did:plc:frank', atproto_firehose.bridged_dids)
+
+    def test_read_did_changes_missed_reloads(self):
+        atproto_firehose.load_dids()
+
+        util.now = lambda: datetime.now(timezone.utc).replace(tzinfo=None)
+        self.store_object(id='did:plc:eve', raw=DID_DOC)
+        self.make_user('did:plc:eve', cls=ATProto, enabled_protocols=['efake'])
+
+        # lose the feed entries
+        memcache.pickle_memcache.flush_all()
+
+        atproto_firehose._read_did_changes()
+        self.assertIn('did:plc:eve', atproto_firehose.atproto_dids)
+
     def test_load_dids_atprepo(self):
         FakeWebsocketClient.to_receive = [({'op': 1, 't': '#info'}, {})]
         self.subscribe()
@@ -579,6 +662,139 @@ class ATProtoFirehoseSubscribeTest(ATProtoTestCase):
         self.subscribe()
         self.assertEqual(790, self.cursor.key.get().cursor)
 
+    def test_sharded_dispatches_frames_to_workers(self):
+        self.cursor.cursor = 444
+        self.cursor.put()
+
+        shards = atproto_firehose.shards = Shards(2, start=444)
+        shards.inputs = [Queue(), Queue()]
+
+        FakeWebsocketClient.setup_receive(Op(
+            repo='did:plc:user', action='create', path='app.bsky.feed.post/abc123',
+            seq=789, record=POST_BSKY))
+
+        # subscribe shouldn't decode or filter the commit itself
+        with patch('libipld.decode_dag_cbor_multi',
+                   side_effect=AssertionError('decoded in parent')):
+            atproto_firehose.subscribe()
+
+        self.assertTrue(commits.empty())
+        self.assertEqual(789, shards.last_dispatched)
+
+        shard = shards.shard('did:plc:user')
+        self.assertTrue(shards.inputs[1 - shard].empty())
+        seq, frame = shards.inputs[shard].get()
+        self.assertEqual(789, seq)
+
+        # worker hasn't finished it yet, so the cursor shouldn't advance
+        self.assertEqual(445, atproto_firehose.cursor.cursor)
+
+        # workers load DIDs themselves
+        atproto_firehose.load_dids()
+        [op] = atproto_firehose.process_frame(frame)
+        self.assertEqual('did:plc:user', op.repo)
+        self.assertEqual('app.bsky.feed.post/abc123', op.path)
+        self.assertEqual(POST_BSKY, op.record)
+
+        # reconnect after the last frame we dispatched, not the stored cursor
+        FakeWebsocketClient.to_receive = []
+        atproto_firehose.subscribe()
+        self.assertEqual(
+            'https://bgs.local/xrpc/com.atproto.sync.subscribeRepos?cursor=790',
+            FakeWebsocketClient.url)
+
+    def test_scan_frame(self):
+        op = Op(repo='did:plc:user', action='create', seq=789, record=POST_BSKY,
+                # looks like rev and seq, but it's in ops, before them
+                path='app.bsky.feed.post/crevacseqx')
+        FakeWebsocketClient.setup_receive(op)
+        header, payload = FakeWebsocketClient.to_receive[0]
+        frame = dag_cbor.encode(header) + dag_cbor.encode(payload)
+
+        self.assertEqual(({'op': 1, 't': '#commit'}, {
+            'repo': 'did:plc:user',
+            'seq': 789,
+            'time': payload['time'],
+        }), atproto_firehose.scan_frame(frame))
+
+        account = {'did': 'did:plc:user', 'seq': 790, 'time': 'then', 'active': True}
+        frame = (dag_cbor.encode({'op': 1, 't': '#account'})
+                 + dag_cbor.encode(account))
+        self.assertEqual(({'op': 1, 't': '#account'}, {
+            'did': 'did:plc:user',
+            'seq': 790,
+            'time': 'then',
+        }), atproto_firehose.scan_frame(frame))
+
+        # other frame types get decoded
+        frame = (dag_cbor.encode({'op': -1})
+                 + dag_cbor.encode({'error': 'FutureCursor'}))
+        self.assertEqual(({'op': -1}, {'error': 'FutureCursor'}),
+                         atproto_firehose.scan_frame(frame))
+
+    def test_shards_finished_seq(self):
+        shards = Shards(3, start=10)
+        shards.inputs = [Queue(), Queue(), Queue()]
+        self.assertEqual(10, shards.finished_seq())
+
+        # put one frame on each shard
+        repos = {}
+        for i in range(100):
+            repos.setdefault(shards.shard(f'did:plc:{i}'), f'did:plc:{i}')
+        self.assertEqual(3, len(repos))
+
+        shards.dispatch(repos[0], 11, b'')
+        shards.dispatch(repos[1], 12, b'')
+        shards.dispatch(repos[2], 13, b'')
+        self.assertEqual(10, shards.finished_seq())
+
+        # shard 1 finishes first. shard 0 still holds us back.
+        shards.finish(1, 12)
+        self.assertEqual(10, shards.finished_seq())
+
+        shards.finish(0, 11)
+        self.assertEqual(11, shards.finished_seq())
+
+        shards.finish(2, 13)
+        self.assertEqual(13, shards.finished_seq())
+
+    def test_shards_restart_dead_worker(self):
+        shards = Shards(2)
+        with patch.object(shards.ctx, 'Process',
+                          side_effect=lambda **kwargs: MagicMock()) as Process:
+            shards.start_worker(0)
+            shards.start_worker(1)
+
+            repo = next(f'did:plc:{i}' for i in range(100) if shards.shard(f'did:plc:{i}') == 0)
+            shards.dispatch(repo, 11, b'a')
+            shards.dispatch(repo, 12, b'b')
+            shards.dispatch(repo, 13, b'c')
+            shards.finish(0, 11)
+            self.assertEqual([(12, b'b'), (13, b'c')], list(shards.pending[0]))
+
+            old_input = shards.inputs[0]
+            shards.processes[0].is_alive.return_value = False
+            shards.processes[1].is_alive.return_value = True
+            Process.reset_mock()
+            shards.check_workers()
+
+        # only the dead one is restarted, and we resend the frames it hadn't
+        # finished
+        Process.assert_called_once()
+        new_input = shards.inputs[0]
+        self.assertIsNot(old_input, new_input)
+        self.assertEqual((12, b'b'), new_input.get(timeout=1))
+        self.assertEqual((13, b'c'), new_input.get(timeout=1))
+
+    def test_shards_start_none(self):
+        shards = Shards(2)
+        shards.inputs = [Queue(), Queue()]
+        shards.dispatch('did:plc:user', 5, b'')
+        self.assertEqual(4, shards.finished_seq())
+
+        shards.finish(shards.shard('did:plc:user'), 5)
+        self.assertEqual(5, shards.finished_seq())
+
 
 @patch('oauth_dropins.webutil.appengine_config.tasks_client.create_task')
 class ATProtoFirehoseHandleTest(ATProtoTestCase):
@@ -719,3 +935,22 @@ class ATProtoFirehoseHandleTest(ATProtoTestCase):
                        path='app.bsky.feed.post/123', record=REPLY_BSKY))
         handle(limit=1)
         # just check that we return instead of raising
+
+    @patch.object(common.error_reporting_client, 'report')
+    @patch('common.create_task', side_effect=[RuntimeError('oops'), None])
+    @patch('common.DEBUG', new=False)  # with DEBUG True, report_error just logs
+    def test_enqueue_failure_reports_and_continues(self, mock_create, mock_report,
+                                                   _):
+        common.RUN_TASKS_INLINE = True  # so the batcher creates tasks in add()
+
+        commits.put(Op(repo='did:plc:user', action='create', seq=789,
+                       path='app.bsky.feed.post/123', record=POST_BSKY))
+        commits.put(Op(repo='did:plc:user', action='create', seq=790,
+                       path='app.bsky.feed.post/456', record=POST_BSKY))
+        handle(limit=2)
+
+        self.assertEqual(2, mock_create.call_count)
+        mock_report.assert_called_once()
+        self.assertEqual(
+            'Failed to enqueue receive task for at://did:plc:user/app.bsky.feed.post/123: oops',
+            mock_report.call_args[0][0])
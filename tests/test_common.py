@@ -190,3 +190,110 @@ class CommonTest(TestCase):
         self.request_context.pop()
         common.create_task('foo')
         mock_create_task.assert_called()
+
+    def test_compact_set(self):
+        elems = common.CompactSet(['did:plc:a', 'did:plc:b'])
+        self.assertEqual(2, len(elems))
+        self.assertIn('did:plc:a', elems)
+        self.assertIn('did:plc:b', elems)
+        self.assertNotIn('did:plc:c', elems)
+        self.assertNotIn(None, elems)
+
+        elems.add('did:plc:c')
+        elems.add('did:plc:c')
+        elems.discard('did:plc:a')
+        elems.discard('did:plc:x')
+        self.assertEqual(2, len(elems))
+        self.assertNotIn('did:plc:a', elems)
+        self.assertIn('did:plc:c', elems)
+
+        elems.add('did:plc:a')
+        self.assertIn('did:plc:a', elems)
+        self.assertEqual(3, len(elems))
+
+        self.assertFalse(common.CompactSet())
+
+    @patch.object(common.CompactSet, 'COMPACT_THRESHOLD', new=3)
+    def test_compact_set_compacts(self):
+        elems = common.CompactSet(['a', 'b'])
+        elems.update(['c', 'd'])
+        elems.discard('a')
+        self.assertEqual(3, len(elems._sorted))
+        self.assertEqual(set(), elems._added)
+        self.assertEqual(set(), elems._removed)
+
+        self.assertNotIn('a', elems)
+        for elem in 'b', 'c', 'd':
+            self.assertIn(elem, elems)
+        self.assertEqual(sorted(elems._sorted), list(elems._sorted))
+
+        elems.difference_update(['b', 'c', 'd'])
+        self.assertEqual(0, len(elems))
+
+    @patch.object(common.CompactSet, 'COMPACT_THRESHOLD', new=3)
+    def test_compact_set_bulk_update(self):
+        elems = common.CompactSet(['a', 'x'])
+        elems.discard('a')
+        elems.add('y')
+
+        with patch.object(elems, '_compact', wraps=elems._compact) as mock_compact:
+            elems.update(['a', 'b', 'c', 'b', 'y'])
+        mock_compact.assert_called_once()
+
+        self.assertEqual(5, len(elems))
+        self.assertEqual(set(), elems._added)
+        self.assertEqual(set(), elems._removed)
+        self.assertEqual(sorted(set(elems._sorted)), list(elems._sorted))
+        for elem in 'a', 'b', 'c', 'x', 'y':
+            self.assertIn(elem, elems)
+
+        elems.difference_update(['a', 'b', 'c', 'z'])
+        self.assertEqual(2, len(elems))
+        self.assertNotIn('a', elems)
+        self.assertIn('x', elems)
+        self.assertIn('y', elems)
+
+    @patch('oauth_dropins.webutil.appengine_config.tasks_client.create_task')
+    def test_task_batcher(self, mock_create_task):
+        common.RUN_TASKS_INLINE = False
+
+        batcher = common.TaskBatcher(batch_size=2)
+        futures = [batcher.add('send', url=f'http://inbox/{i}') for i in range(3)]
+        # first two were flushed when the batch filled up
+        futures[0].result()
+        futures[1].result()
+        self.assertFalse(futures[2].done())
+
+        results = batcher.wait()
+        self.assertEqual(3, len(results))
+        self.assertEqual(3, mock_create_task.call_count)
+        for i in range(3):
+            self.assert_task(mock_create_task, 'send', url=f'http://inbox/{i}')
+            self.assertEqual(202, results[i][1])
+
+    @patch('oauth_dropins.webutil.appengine_config.tasks_client.create_task')
+    def test_task_batcher_error(self, mock_create_task):
+        common.RUN_TASKS_INLINE = False
+
+        def create_task(parent, task):
+            if b'bad' in task['app_engine_http_request']['body']:
+                raise RuntimeError('foo')
+            return Mock()
+
+        mock_create_task.side_effect = create_task
+
+        with common.TaskBatcher() as batcher:
+            ok = batcher.add('send', url='http://good')
+            bad = batcher.add('send', url='http://bad')
+
+        self.assertEqual(202, ok.result()[1])
+        with self.assertRaises(RuntimeError):
+            bad.result()
+
+    def test_task_batcher_inline(self):
+        batcher = common.TaskBatcher()
+        with patch.object(common, 'create_task', return_value='ok') as mock:
+            self.assertEqual('ok', batcher.add('receive', id='x').result())
+            mock.assert_called_once_with('receive', app_id=common.GCP_PROJECT_ID,
+                                         delay=None, id='x')
+        self.assertEqual(['ok'], batcher.wait())
@@ -4,9 +4,10 @@ from unittest.mock import patch
 from activitypub import ActivityPub
 from atproto import ATProto
 from flask_app import app
+from google.cloud import ndb
 import ids
 from ids import translate_handle, translate_object_id, translate_user_id
-from models import Target
+from models import CopyIndex, Target
 from nostr import Nostr
 from .testutil import Fake, TestCase
 from web import Web
@@ -20,13 +21,14 @@ class IdsTest(TestCase):
         Web(id='nostr.brid.gy', ap_subdomain='nostr', has_redirects=True).put()
 
     def test_translate_user_id(self):
-        Web(id='user.com',
-            copies=[Target(uri='did:plc:123', protocol='atproto')]).put()
-        ActivityPub(id='https://inst/user',
-                    copies=[Target(uri='did:plc:456', protocol='atproto')]).put()
+        web_user = Web(id='user.com',
+                       copies=[Target(uri='did:plc:123', protocol='atproto')])
+        ap_user = ActivityPub(id='https://inst/user',
+                              copies=[Target(uri='did:plc:456', protocol='atproto')])
         fake_user = Fake(id='fake:user',
                          copies=[Target(uri='did:plc:789', protocol='atproto')])
-        fake_user.put()
+        ndb.put_multi([web_user, ap_user, fake_user])
+        CopyIndex.update_for(web_user, ap_user, fake_user)
 
         # ATProto with DID docs, used to resolve handle in bsky.app URL
         did = self.store_object(id='did:plc:123', raw={
@@ -335,6 +337,57 @@ class IdsTest(TestCase):
                 self.assertEqual(expected, translate_object_id(
                     id=id, from_=from_, to=to))
 
+    def test_translate_multi(self):
+        user = Fake(id='fake:user',
+                    copies=[Target(uri='did:plc:789', protocol='atproto')])
+        user.put()
+        CopyIndex.update_for(user)
+        Fake(id='fake:alias', use_instead=user.key).put()
+        self.store_object(id='fake:post',
+                          copies=[Target(uri='at://did/fa/post', protocol='atproto')])
+
+        with patch.object(Fake, 'get_by_id', return_value=None) as mock_get, \
+             patch.object(Fake, 'load', return_value=None) as mock_load:
+            users, objs = ids.translate_multi(
+                user_ids={'fake:user': Fake, 'fake:alias': Fake, 'fake:nope': Fake},
+                object_ids={'fake:post': Fake, 'fake:nope': Fake},
+                to=ATProto)
+
+        # only ids that weren't prefetched fall back to loading
+        mock_get.assert_called_once_with('fake:nope', allow_opt_out=True)
+        mock_load.assert_called_once_with('fake:nope', remote=False)
+
+        self.assertEqual({
+            'fake:user': 'did:plc:789',
+            'fake:alias': 'did:plc:789',
+            'fake:nope': None,
+        }, users)
+        self.assertEqual({
+            'fake:post': 'at://did/fa/post',
+            'fake:nope': 'fake:nope',
+        }, objs)
+
+    def test_translate_multi_normalizes_atproto_object_ids(self):
+        self.store_object(id='at://did:plc:user/app.bsky.actor.profile/self',
+                          copies=[Target(uri='nostr:nprofile', protocol='nostr')])
+        self.store_object(id='at://did:plc:user/app.bsky.feed.post/123',
+                          copies=[Target(uri='nostr:nevent', protocol='nostr')])
+
+        object_ids = {
+            'did:plc:user': ATProto,
+            'https://bsky.app/profile/did:plc:user/post/123': ATProto,
+        }
+        expected = {
+            'did:plc:user': 'nostr:nprofile',
+            'https://bsky.app/profile/did:plc:user/post/123': 'nostr:nevent',
+        }
+        for id, from_ in object_ids.items():
+            self.assertEqual(expected[id],
+                             translate_object_id(id=id, from_=from_, to=Nostr))
+
+        _, objs = ids.translate_multi(object_ids=object_ids, to=Nostr)
+        self.assertEqual(expected, objs)
+
     def test_translate_object_id_web_ap_subdomain_fed(self):
         self.make_user('on-fed.com', cls=Web, ap_subdomain='fed')
 
@@ -105,7 +105,7 @@ class IntegrationTests(TestCase):
 
     def make_atproto_copy(self, user, did):
         user.enabled_protocols = ['atproto']
-        user.copies = [Target(uri=did, protocol='atproto')]
+        user.add('copies', Target(uri=did, protocol='atproto'))
         user.put()
 
         Repo.create(self.storage, did, signing_key=ATPROTO_KEY)
@@ -118,7 +118,7 @@ class IntegrationTests(TestCase):
         if user.obj.as1:
             profile_id = f'at://{did}/app.bsky.actor.profile/self'
             self.store_object(id=profile_id, bsky=bluesky.from_as1(user.obj.as1))
-            user.obj.copies = [Target(uri=profile_id, protocol='atproto')]
+            user.obj.add('copies', Target(uri=profile_id, protocol='atproto'))
             user.obj.put()
 
     def firehose(self, limit=1, **op):
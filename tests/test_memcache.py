@@ -1,4 +1,7 @@
 """Unit tests for memcache.py."""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from threading import Event
 from unittest.mock import patch
 
 from google.cloud.ndb import Key
@@ -6,8 +9,8 @@ from google.cloud.ndb import Key
 import config
 import memcache
 from memcache import memoize, pickle_memcache
-from models import get_original_user_key, Object, Target
-from oauth_dropins.webutil.testutil import requests_response
+from models import CopyIndex, Object, Target
+from oauth_dropins.webutil.testutil import NOW, requests_response
 from .testutil import Fake, TestCase
 
 
@@ -183,6 +186,155 @@ class MemcacheTest(TestCase):
         self.assertEqual('5', foo(5))
         self.assertEqual([5], calls)
 
+    def test_memoize_local(self):
+        calls = []
+
+        @memoize(local_size=10)
+        def foo(x):
+            calls.append(x)
+            return str(x)
+
+        self.assertEqual('5', foo(5))
+        self.assertEqual([5], calls)
+        self.assertEqual('5', foo.cache[(5,)])
+
+        with patch.object(pickle_memcache, 'get') as mock_get:
+            self.assertEqual('5', foo(5))
+            mock_get.assert_not_called()
+
+        # falls back to memcache
+        foo.cache_clear()
+        self.assertEqual('5', foo(5))
+        self.assertEqual([5], calls)
+
+    def test_memoize_local_key_fn(self):
+        calls = []
+
+        @memoize(key=lambda x: x + 1, local_size=10)
+        def foo(x):
+            calls.append(x)
+            return str(x)
+
+        self.assertEqual('5', foo(5))
+        self.assertEqual('5', foo.cache[6])
+
+    def test_memoize_local_single_flight(self):
+        calls = []
+        started = Event()
+        release = Event()
+
+        @memoize(local_size=10)
+        def foo(x):
+            calls.append(x)
+            started.set()
+            release.wait()
+            return str(x)
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            first = executor.submit(foo, 5)
+            started.wait()
+            others = [executor.submit(foo, 5) for _ in range(2)]
+            release.set()
+            self.assertEqual(['5', '5', '5'],
+                             [f.result() for f in [first] + others])
+
+        self.assertEqual([5], calls)
+
+    def test_memoize_local_stamp_check_doesnt_block_other_callers(self):
+        fetching = Event()
+        release = Event()
+        get = memcache.memcache.get
+
+        def slow_get(*args, **kwargs):
+            fetching.set()
+            release.wait()
+            return get(*args, **kwargs)
+
+        @memoize(local_size=10)
+        def foo(x):
+            return str(x)
+
+        foo.cache[(5,)] = '5'
+
+        with patch.object(memcache.memcache, 'get', side_effect=slow_get), \
+             ThreadPoolExecutor(max_workers=2) as executor:
+            first = executor.submit(foo, 5)
+            fetching.wait()
+
+            # the first call is fetching the stamp, but that shouldn't block us
+            self.assertEqual('5', executor.submit(foo, 5).result(timeout=5))
+            self.assertFalse(first.done())
+
+            release.set()
+            self.assertEqual('5', first.result())
+
+    @patch('memcache.LOCAL_STAMP_CHECK_INTERVAL', new=timedelta(0))
+    def test_memoize_local_invalidate(self):
+        calls = []
+
+        @memoize(local_size=10)
+        def foo(x):
+            calls.append(x)
+            return str(x)
+
+        self.assertEqual('5', foo(5))
+        self.assertEqual('6', foo(6))
+        self.assertEqual([5, 6], calls)
+
+        foo.invalidate(5)
+        self.assertIsNone(pickle_memcache.get(
+            b'MemcacheTest.test_memoize_local_invalidate.<locals>.foo-2-(5,)-{}'))
+
+        # bumping the stamp clears local caches, including ours
+        self.assertEqual('5', foo(5))
+        self.assertEqual([5, 6, 5], calls)
+        self.assertEqual({(5,): '5'}, dict(foo.cache))
+
+    def test_memoize_many(self):
+        calls = []
+
+        @memoize()
+        def foo(x):
+            calls.append(x)
+            return None if x == 3 else str(x)
+
+        self.assertEqual('1', foo(1))
+        self.assertEqual([1], calls)
+
+        with patch.object(pickle_memcache, 'get_many',
+                          wraps=pickle_memcache.get_many) as mock_get_many, \
+             patch.object(pickle_memcache, 'set_many',
+                          wraps=pickle_memcache.set_many) as mock_set_many:
+            self.assertEqual(['1', '2', None, '2'],
+                             foo.many([(1,), (2,), (3,), (2,)]))
+
+        mock_get_many.assert_called_once()
+        mock_set_many.assert_called_once()
+        self.assertEqual([1, 2, 3], calls)
+
+        self.assertEqual(['1', '2', None], foo.many([(1,), (2,), (3,)]))
+        self.assertEqual([1, 2, 3], calls)
+
+    def test_memoize_many_local_executor(self):
+        calls = []
+
+        @memoize(key=lambda x: x if x > 1 else None, local_size=10)
+        def foo(x):
+            calls.append(x)
+            return x * 2
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual([2, 4, 6], foo.many([(1,), (2,), (3,)],
+                                                 executor=executor))
+        self.assertCountEqual([1, 2, 3], calls)
+        self.assertEqual({(1,): 2, 2: 4, 3: 6}, dict(foo.cache))
+
+        with patch.object(pickle_memcache, 'get_many') as mock_get_many:
+            self.assertEqual([2, 4, 6], foo.many([(1,), (2,), (3,)]))
+            mock_get_many.assert_not_called()
+
+        self.assertCountEqual([1, 2, 3], calls)
+
     @patch('memcache.KEY_MAX_LEN', new=10)
     def test_key(self):
         for input, expected in (
@@ -206,21 +358,22 @@ class MemcacheTest(TestCase):
     def test_evict_nonexistent_entity(self):
         memcache.evict(Key(Fake, 'fake:nope'))
 
-    def test_evict_user_clears_copies_from_memoize(self):
+    def test_evict_user_evicts_copy_index(self):
         user = Fake(id='fake:foo', copies=[Target(protocol='other', uri='other:a'),
                                            Target(protocol='other', uri='other:b')])
         user.put()
+        CopyIndex.update_for(user)
 
-        # populate the get_original_user_key memoize cache
-        self.assertEqual(user.key, get_original_user_key('other:a'))
-        self.assertEqual(user.key, get_original_user_key('other:b'))
+        keys = [CopyIndex.key_for('other:a'), CopyIndex.key_for('other:b')]
+        for key in keys:
+            key.get(use_cache=False)
+            self.assertIsNotNone(key.get(use_cache=False, use_datastore=False,
+                                         use_global_cache=True))
 
         memcache.evict(user.key)
-        get_original_user_key.cache_clear()
-        user.key.delete()
-
-        self.assertIsNone(get_original_user_key('other:a'))
-        self.assertIsNone(get_original_user_key('other:b'))
+        for key in keys:
+            self.assertIsNone(key.get(use_cache=False, use_datastore=False,
+                                      use_global_cache=True))
 
     @patch('requests.post', return_value=requests_response())
     def test_remote_evict(self, mock_post):
@@ -231,3 +384,74 @@ class MemcacheTest(TestCase):
             headers={'Authorization': config.SECRET_KEY},
             data={'key': key.urlsafe()},
         )])
+
+    def test_feed(self):
+        self.assertEqual(([], 0, True), memcache.read_feed('foo'))
+
+        self.assertEqual(1, memcache.append_to_feed('foo', 'a'))
+        self.assertEqual(2, memcache.append_to_feed('foo', ('b', 3)))
+        self.assertEqual((['a', ('b', 3)], 2, True),
+                         memcache.read_feed('foo', after=0))
+        self.assertEqual(([('b', 3)], 2, True), memcache.read_feed('foo', after=1))
+        self.assertEqual(([], 2, True), memcache.read_feed('foo', after=2))
+
+        # starting from now
+        self.assertEqual(([], 2, True), memcache.read_feed('foo'))
+
+        # other feeds are separate
+        self.assertEqual(([], 0, True), memcache.read_feed('bar', after=0))
+
+    def test_feed_missed_entries(self):
+        for val in 'a', 'b', 'c':
+            memcache.append_to_feed('foo', val)
+
+        pickle_memcache.delete(memcache.key('feed-foo-2'))
+        self.assertEqual((['a', 'c'], 3, False), memcache.read_feed('foo', after=0))
+
+        # past limit
+        self.assertEqual((['c'], 3, False),
+                         memcache.read_feed('foo', after=0, limit=1))
+
+        # reset
+        self.assertEqual(([], 3, False), memcache.read_feed('foo', after=5))
+
+    def test_host_health(self):
+        self.assertEqual({}, memcache.hosts_retry_after(['a.com']))
+
+        memcache.record_host_request('a.com', ok=True, latency=1)
+        memcache.record_host_request('a.com', ok=True, latency=2)
+        for _ in range(memcache.HOST_FAILURES_BEFORE_BACKOFF - 1):
+            memcache.record_host_request('a.com', ok=False)
+        self.assertEqual({}, memcache.hosts_retry_after(['a.com']))
+        self.assertEqual({}, memcache.host_health())
+
+        memcache.record_host_request('a.com', ok=False)
+        retry_after = NOW + memcache.HOST_BACKOFF_MIN
+        self.assertEqual({'a.com': retry_after},
+                         memcache.hosts_retry_after(['a.com', 'b.com']))
+        self.assertEqual({'a.com': {
+            'failures': memcache.HOST_FAILURES_BEFORE_BACKOFF,
+            'latency': 1.2,
+            'last_ok': NOW,
+            'last_failure': NOW,
+            'retry_after': retry_after,
+        }}, memcache.host_health())
+
+        with patch('oauth_dropins.webutil.util.now', return_value=retry_after):
+            # first caller probes, others keep waiting
+            self.assertEqual({}, memcache.hosts_retry_after(['a.com']))
+            self.assertEqual({'a.com': retry_after + memcache.HOST_PROBE_TIMEOUT},
+                             memcache.hosts_retry_after(['a.com']))
+
+            # probe fails, back off twice as long
+            memcache.record_host_request('a.com', ok=False)
+            retry_after += 2 * memcache.HOST_BACKOFF_MIN
+            self.assertEqual({'a.com': retry_after},
+                             memcache.hosts_retry_after(['a.com']))
+
+        with patch('oauth_dropins.webutil.util.now', return_value=retry_after):
+            # probe succeeds
+            self.assertEqual({}, memcache.hosts_retry_after(['a.com']))
+            memcache.record_host_request('a.com', ok=True)
+            self.assertEqual({}, memcache.hosts_retry_after(['a.com']))
+            self.assertEqual(0, memcache.host_health()['a.com']['failures'])
@@ -7,6 +7,7 @@ import arroba.server
 from arroba.util import at_uri
 from google.cloud import ndb
 from google.cloud.ndb import tasklets
+from google.cloud.ndb.model import _entity_to_protobuf
 from google.cloud.tasks_v2.types import Task
 from granary.bluesky import NO_AUTHENTICATED_LABEL
 from granary.tests.test_bluesky import ACTOR_AS, ACTOR_PROFILE_BSKY
@@ -23,7 +24,19 @@ from atproto import ATProto
 import common
 import memcache
 import models
-from models import Follower, Object, OBJECT_EXPIRE_AGE, PROTOCOLS, Target, User
+from models import (
+    CopyIndex,
+    Follower,
+    FollowerCounter,
+    FollowerTarget,
+    NostrPubkey,
+    Object,
+    OBJECT_EXPIRE_AGE,
+    PROTOCOLS,
+    RsaKey,
+    Target,
+    User,
+)
 from nostr import Nostr
 import protocol
 from protocol import Protocol
@@ -68,6 +81,31 @@ class UserTest(TestCase):
         self.user.put()
         self.assertIsNone(Web.get_by_id('y.za'))
 
+    @patch('memcache.append_to_feed', side_effect=ConnectionRefusedError('nope'))
+    def test_put_atproto_did_changes_feed_fails(self, mock_append):
+        user = self.make_user('did:plc:user', cls=ATProto,
+                              enabled_protocols=['fake'])
+        mock_append.assert_called_with(common.DID_CHANGES_FEED,
+                                       ('atproto', 'did:plc:user', True))
+        self.assert_entities_equal(user, ATProto.get_by_id('did:plc:user'))
+
+    @patch('memcache.append_to_feed')
+    def test_put_atproto_only_appends_did_change_when_enabled_changes(self, mock_append):
+        user = self.make_user('did:plc:user', cls=ATProto,
+                              enabled_protocols=['fake'])
+        mock_append.assert_called_once_with(common.DID_CHANGES_FEED,
+                                            ('atproto', 'did:plc:user', True))
+
+        mock_append.reset_mock()
+        user.send_notifs = 'none'
+        user.put()
+        mock_append.assert_not_called()
+
+        user.enabled_protocols = []
+        user.put()
+        mock_append.assert_called_once_with(common.DID_CHANGES_FEED,
+                                            ('atproto', 'did:plc:user', False))
+
     def test_get_or_create(self):
         user = Fake.get_or_create('fake:user')
 
@@ -80,6 +118,32 @@ class UserTest(TestCase):
         assert user.public_pem()
         assert user.private_pem()
 
+    def test_get_or_create_claims_pooled_key(self):
+        pooled = RsaKey.generate()
+        pooled.put()
+
+        user = Fake.get_or_create('fake:user')
+        self.assertEqual(pooled.mod, user.mod)
+        self.assertEqual(pooled.private_exponent, user.private_exponent)
+        self.assertIsNone(pooled.key.get())
+        self.assertIsNone(RsaKey.claim())
+
+    @patch('models.RSA_KEY_POOL_SIZE', new=3)
+    @patch('models.RSA_KEY_POOL_REFILL_BATCH', new=2)
+    def test_rsa_key_pool_refill(self):
+        self.assertEqual(0, RsaKey.pool_depth())
+
+        self.assertEqual(2, RsaKey.refill())
+        self.assertEqual(2, RsaKey.pool_depth())
+
+        self.assertEqual(1, RsaKey.refill())
+        self.assertEqual(0, RsaKey.refill())
+        self.assertEqual(3, RsaKey.pool_depth())
+
+        claimed = RsaKey.claim()
+        self.assertIsNotNone(claimed.mod)
+        self.assertEqual(2, RsaKey.pool_depth())
+
     def test_get_or_create_existing_merge_enabled_protocols(self):
         self.user.enabled_protocols = ['fake']
         self.user.put()
@@ -469,18 +533,115 @@ class UserTest(TestCase):
         Follower(from_=self.user.key, to=Fake(id='b').key).put()
         Follower(from_=Fake(id='c').key, to=self.user.key).put()
 
-        # cached in both memcache and memory
-        user = Web.get_by_id('y.za')
-        self.assertEqual((0, 0), user.count_followers())
+        # counters aren't initialized yet, so the query counts are cached
+        self.assertEqual((0, 0), self.user.count_followers())
 
-        # clear memory cache, still cached in memcache
-        user.count_followers.cache.clear()
-        self.assertEqual((0, 0), user.count_followers())
+        FollowerCounter.reconcile(self.user.key, 'followers')
+        FollowerCounter.reconcile(self.user.key, 'following')
+        self.assertEqual((1, 2), self.user.count_followers())
 
-        # clear both
-        memcache.pickle_memcache.client_pool.clear()
-        user.count_followers.cache.clear()
-        self.assertEqual((1, 2), user.count_followers())
+    def test_follower_counter(self):
+        alice = Fake(id='fake:alice').key
+        Follower(from_=alice, to=self.user.key).put()
+
+        # not initialized yet, so this counts with a query
+        base_key = FollowerCounter.keys(self.user.key, 'followers')[0]
+        self.assertEqual(1, FollowerCounter.get_count(self.user.key, 'followers'))
+        self.assertIsNone(base_key.get())
+
+        # initialize. the increment above is already in another shard, so
+        # shard 0 doesn't count it again
+        self.assertEqual(1, FollowerCounter.reconcile(self.user.key, 'followers'))
+        self.assertEqual(0, base_key.get().count)
+        self.assertEqual(1, FollowerCounter.get_count(self.user.key, 'followers'))
+
+        bob_key = Fake(id='fake:bob').key
+        Follower(from_=bob_key, to=self.user.key).put()
+        self.assertEqual(2, FollowerCounter.get_count(self.user.key, 'followers'))
+
+        # loaded from the datastore. rewriting without changing status doesn't
+        # count again
+        bob = Follower.query(Follower.from_ == bob_key).get()
+        bob.put()
+        self.assertEqual(2, FollowerCounter.get_count(self.user.key, 'followers'))
+
+        bob.status = 'inactive'
+        bob.put()
+        self.assertEqual(1, FollowerCounter.get_count(self.user.key, 'followers'))
+
+        bob.status = 'inactive'
+        bob.put()
+        self.assertEqual(1, FollowerCounter.get_count(self.user.key, 'followers'))
+
+        bob.status = 'active'
+        bob.put()
+        self.assertEqual(2, FollowerCounter.get_count(self.user.key, 'followers'))
+        self.assertEqual(1, FollowerCounter.get_count(alice, 'following'))
+
+        bob.key.delete()
+        self.assertEqual(1, FollowerCounter.get_count(self.user.key, 'followers'))
+
+        # already deleted, don't decrement again
+        bob.key.delete()
+        self.assertEqual(1, FollowerCounter.get_count(self.user.key, 'followers'))
+
+    def test_follower_counter_new_user(self):
+        user = Fake.get_or_create('fake:new')
+        for collection in 'followers', 'following':
+            shards = ndb.get_multi(FollowerCounter.keys(user.key, collection))
+            self.assertEqual([0] * FollowerCounter.NUM_SHARDS,
+                             [shard.count for shard in shards])
+
+        Follower(from_=Fake(id='fake:a').key, to=user.key).put()
+        with patch.object(FollowerCounter, '_query_count') as query_count:
+            self.assertEqual((1, 0), user.count_followers())
+            query_count.assert_not_called()
+
+    def test_nostr_pubkey_update_for(self):
+        # not enabled, no entry
+        user = self.make_user('fake:user', cls=Fake,
+                              nostr_key_bytes=bytes.fromhex(PRIVKEY))
+        self.assertIsNone(NostrPubkey.get_by_id(PUBKEY))
+
+        user.enabled_protocols = ['nostr']
+        user.put()
+        pubkey = NostrPubkey.get_by_id(PUBKEY)
+        self.assertEqual(user.key, pubkey.user)
+        self.assertFalse(pubkey.native)
+        self.assertTrue(pubkey.active)
+
+        user.enabled_protocols = []
+        user.put()
+        self.assertFalse(NostrPubkey.get_by_id(PUBKEY).active)
+
+        # native Nostr user
+        self.make_user(NPUB_URI, cls=Nostr, enabled_protocols=['fake'])
+        pubkey = NostrPubkey.get_by_id(PUBKEY)
+        self.assertTrue(pubkey.native)
+        self.assertTrue(pubkey.active)
+
+    def test_nostr_pubkey_update_for_skips_unchanged(self):
+        user = self.make_user('fake:user', cls=Fake, enabled_protocols=['nostr'],
+                              nostr_key_bytes=bytes.fromhex(PRIVKEY))
+        self.assertTrue(NostrPubkey.get_by_id(PUBKEY).active)
+
+        # unchanged, so this put doesn't read or write the entry
+        NostrPubkey.get_by_id(PUBKEY).key.delete()
+        user.put()
+        self.assertIsNone(NostrPubkey.get_by_id(PUBKEY))
+
+        # changed, so these do
+        user.enabled_protocols = []
+        user.put()
+        user.enabled_protocols = ['nostr']
+        user.put()
+        self.assertTrue(NostrPubkey.get_by_id(PUBKEY).active)
+
+    @patch.object(NostrPubkey, 'update_for', side_effect=RuntimeError('foo'))
+    def test_nostr_pubkey_update_for_fails_user_put_succeeds(self, _):
+        user = self.make_user('fake:user', cls=Fake, enabled_protocols=['nostr'],
+                              nostr_key_bytes=bytes.fromhex(PRIVKEY))
+        self.assertEqual(['nostr'], Fake.get_by_id('fake:user').enabled_protocols)
 
     def test_count_followers_protocol_bot_user(self):
         bot = self.make_user(id='fa.brid.gy', cls=Web)
@@ -581,46 +742,40 @@ class UserTest(TestCase):
         self.assertFalse(Web(id='ap.brid.gy').is_enabled(ActivityPub))
         self.assertFalse(Web(id='bsky.brid.gy').is_enabled(ATProto))
 
-    def test_add_to_copies_updates_memcache(self):
-        cache_key = memcache.memoize_key(
-            models.get_original_user_key, 'other:x')
-        self.assertIsNone(memcache.pickle_memcache.get(cache_key))
+    def test_add_to_copies_updates_copy_index(self):
+        self.assertIsNone(CopyIndex.get_by_id('other:x'))
 
         user = Fake(id='fake:x')
         copy = Target(protocol='other', uri='other:x')
         user.add('copies', copy)
 
-        self.assertEqual(user.key, memcache.pickle_memcache.get(cache_key))
+        self.assertEqual(user.key, CopyIndex.get_by_id('other:x').user)
+        self.assertEqual(user.key, models.get_original_user_key('other:x'))
 
     def test_add_to_copies_doesnt_update_if_already_there(self):
         copy = Target(protocol='other', uri='other:x')
         user = Fake(id='fake:x', copies=[copy])
         user.add('copies', copy)
 
-        cache_key = memcache.memoize_key(
-            models.get_original_user_key, 'other:x')
-        self.assertIsNone(memcache.pickle_memcache.get(cache_key))
+        self.assertIsNone(CopyIndex.get_by_id('other:x'))
 
     def test_remove(self):
         user = Fake(id='fake:x', enabled_protocols=['web', 'activitypub'])
         user.remove('enabled_protocols', 'web')
         self.assertEqual(['activitypub'], user.enabled_protocols)
 
-    def test_remove_from_copies_deletes_from_get_original_user_memoize(self):
+    def test_remove_from_copies_removes_from_copy_index(self):
         copy = Target(protocol='other', uri='other:x')
-        user = Fake(id='fake:x', copies=[copy])
+        user = Fake(id='fake:x')
+        user.add('copies', copy)
         user.put()
-
-        # check that it's memoized
         self.assertEqual(user.key, models.get_original_user_key('other:x'))
-        cache_key = memcache.memoize_key(models.get_original_user_key, 'other:x')
-        self.assertEqual(user.key, memcache.pickle_memcache.get(cache_key))
 
+        # also evicts from get_original_*'s in-process cache
         user.remove('copies', copy)
         user.put()
 
-        # check that it's no longer memoized
-        models.get_original_user_key.cache_clear()  # lru_cache
+        self.assertIsNone(CopyIndex.get_by_id('other:x'))
         self.assertIsNone(models.get_original_user_key('other:x'))
 
     def test_remove_nonexistent_value_noop(self):
@@ -1057,6 +1212,47 @@ class ObjectTest(TestCase):
             'image': ['http://pic/1', {'url': 'http://pic/2'}],
         }).as1)
 
+    @patch('granary.as2.to_as1', wraps=models.as2.to_as1)
+    def test_as1_cached(self, mock_to_as1):
+        obj = Object(id='x', as2={'type': 'Note', 'content': 'foo'})
+        first = obj.as1
+        self.assertIs(first, obj.as1)
+        self.assertEqual('note', obj.type)
+        mock_to_as1.assert_called_once()
+
+        obj.as2 = {'type': 'Article', 'content': 'bar'}
+        self.assertEqual('article', obj.as1['objectType'])
+        self.assertEqual(2, mock_to_as1.call_count)
+
+        obj.our_as1 = {'objectType': 'comment'}
+        self.assertEqual({'id': 'x', 'objectType': 'comment'}, obj.as1)
+
+        obj.our_as1 = None
+        obj.as2 = None
+        self.assertIsNone(obj.as1)
+
+        obj.mf2 = {'type': ['h-entry'], 'properties': {'content': ['baz']}}
+        self.assertEqual('baz', obj.as1['content'])
+        obj.mf2['properties']['content'] = ['biff']
+        self.assertEqual('baz', obj.as1['content'])
+        obj.clear_as1_cache()
+        self.assertEqual('biff', obj.as1['content'])
+
+    def test_estimate_size(self):
+        user = self.make_user('fake:user', cls=Fake)
+
+        for obj in (
+            Object(id='fake:a'),
+            Object(id='fake:b', our_as1={'content': 'caf\u00e9 ' * 100}),
+            Object(id='https://mas.to/users/alice', as2=ACTOR, users=[user.key]),
+            Object(id='at://did:plc:user/app.bsky.actor.profile/self',
+                   bsky=ACTOR_PROFILE_BSKY, feed=[user.key] * 10,
+                   copies=[Target(protocol='fake', uri='fake:profile')]),
+        ):
+            with self.subTest(id=obj.key.id()):
+                actual = len(_entity_to_protobuf(obj)._pb.SerializeToString())
+                self.assertGreaterEqual(obj.estimate_size(), actual)
+
     def test_validate_id(self):
         # DID repo ids
         Object(id='at://did:plc:123/app.bsky.feed.post/abc').put()
@@ -1338,6 +1534,20 @@ class ObjectTest(TestCase):
                               copies=[Target(uri='other:user', protocol='other')])
         self.assertEqual(user.key, models.get_original_user_key('other:user'))
 
+    def test_get_original_user_key_not_indexed_falls_back_to_query(self):
+        # not in CopyIndex yet, eg not backfilled
+        user = Fake(id='fake:user', copies=[Target(uri='other:x', protocol='other')])
+        user.put()
+        self.assertIsNone(CopyIndex.get_by_id('other:x'))
+
+        self.assertEqual(user.key, models.get_original_user_key('other:x'))
+        self.assertEqual(user.key, CopyIndex.get_by_id('other:x').user)
+
+    @patch('models.COPY_INDEX_BACKFILLED', True)
+    def test_get_original_user_key_not_indexed_backfilled(self):
+        Fake(id='fake:user', copies=[Target(uri='other:x', protocol='other')]).put()
+        self.assertIsNone(models.get_original_user_key('other:x'))
+
     def test_get_original_object_key(self):
         self.assertIsNone(models.get_original_object_key('other:post'))
         models.get_original_object_key.cache_clear()
@@ -1359,46 +1569,80 @@ class ObjectTest(TestCase):
         obj.copies.append(Target(uri='fake:foo', protocol='fake'))
         self.assertEqual('fake:foo', obj.get_copy(Fake))
 
-    def test_add_to_copies_updates_memcache(self):
-        cache_key = memcache.memoize_key(
-            models.get_original_object_key, 'other:x')
-        self.assertIsNone(memcache.pickle_memcache.get(cache_key))
+    def test_add_to_copies_updates_copy_index(self):
+        self.assertIsNone(CopyIndex.get_by_id('other:x'))
 
         obj = Object(id='x')
         copy = Target(protocol='other', uri='other:x')
         obj.add('copies', copy)
 
-        self.assertEqual(obj.key, memcache.pickle_memcache.get(cache_key))
+        self.assertEqual(obj.key, CopyIndex.get_by_id('other:x').object)
+        self.assertEqual(obj.key, models.get_original_object_key('other:x'))
 
     def test_add_to_copies_doesnt_update_if_already_there(self):
         copy = Target(protocol='other', uri='other:x')
-        user = Object(id='x', copies=[copy])
-        user.add('copies', copy)
+        obj = Object(id='x', copies=[copy])
+        obj.add('copies', copy)
 
-        cache_key = memcache.memoize_key(
-            models.get_original_object_key, 'other:x')
-        self.assertIsNone(memcache.pickle_memcache.get(cache_key))
+        self.assertIsNone(CopyIndex.get_by_id('other:x'))
 
     def test_remove(self):
         obj = Object(id='x', users=[ndb.Key(Web, 'user1'), ndb.Key(Web, 'user2')])
         obj.remove('users', ndb.Key(Web, 'user1'))
         self.assertEqual([ndb.Key(Web, 'user2')], obj.users)
 
-    def test_remove_from_copies_deletes_from_get_original_object_memoize(self):
+    def test_remove_from_copies_removes_from_copy_index(self):
         copy = Target(protocol='other', uri='other:x')
-        obj = Object(id='x', copies=[copy])
+        obj = Object(id='x')
+        obj.add('copies', copy)
         obj.put()
-
-        # check that it's memoized
         self.assertEqual(obj.key, models.get_original_object_key('other:x'))
-        cache_key = memcache.memoize_key(models.get_original_object_key, 'other:x')
-        self.assertEqual(obj.key, memcache.pickle_memcache.get(cache_key))
 
+        # also evicts from get_original_*'s in-process cache
         obj.remove('copies', copy)
         obj.put()
 
-        # check that it's no longer memoized
-        models.get_original_object_key.cache_clear()  # lru_cache
+        self.assertIsNone(CopyIndex.get_by_id('other:x'))
+        self.assertIsNone(models.get_original_object_key('other:x'))
+
+    def test_copy_index_user_and_object_with_same_copy(self):
+        user = self.make_user('fake:user', cls=Fake,
+                              copies=[Target(uri='other:x', protocol='other')])
+        obj = self.store_object(id='fake:post',
+                                copies=[Target(uri='other:x', protocol='other')])
+
+        entry = CopyIndex.get_by_id('other:x')
+        self.assertEqual(user.key, entry.user)
+        self.assertEqual(obj.key, entry.object)
+
+        CopyIndex.remove('other:x', obj.key)
+        entry = CopyIndex.get_by_id('other:x')
+        self.assertEqual(user.key, entry.user)
+        self.assertIsNone(entry.object)
+
+        # doesn't remove another original's entry
+        CopyIndex.remove('other:x', Fake(id='fake:other').key)
+        self.assertEqual(user.key, CopyIndex.get_by_id('other:x').user)
+
+    def test_get_original_object_key_long_copy_id_falls_back_to_query(self):
+        copy_id = 'other:' + 'x' * 1600
+        obj = self.store_object(id='fake:post',
+                                copies=[Target(uri=copy_id, protocol='other')])
+        self.assertIsNone(CopyIndex.key_for(copy_id))
+        self.assertEqual(obj.key, models.get_original_object_key(copy_id))
+
+    def test_get_original_object_key_not_indexed_falls_back_to_query(self):
+        # not in CopyIndex yet, eg not backfilled
+        obj = Object(id='fake:post', copies=[Target(uri='other:x', protocol='other')])
+        obj.put()
+        self.assertIsNone(CopyIndex.get_by_id('other:x'))
+
+        self.assertEqual(obj.key, models.get_original_object_key('other:x'))
+        self.assertEqual(obj.key, CopyIndex.get_by_id('other:x').object)
+
+    @patch('models.COPY_INDEX_BACKFILLED', True)
+    def test_get_original_object_key_not_indexed_backfilled(self):
+        Object(id='fake:post', copies=[Target(uri='other:x', protocol='other')]).put()
         self.assertIsNone(models.get_original_object_key('other:x'))
 
     def test_remove_nonexistent_value_noop(self):
@@ -1505,3 +1749,86 @@ class FollowerTest(TestCase):
                                           status='inactive')
         got = follower.key.get()
         self.assertEqual('inactive', got.status)
+
+    def test_get_or_create_sets_target(self):
+        follower = Follower.get_or_create(from_=self.user, to=self.other_user)
+        self.assertEqual('fake:shared:target', follower.key.get().target)
+
+    def test_update_targets(self):
+        other_target = OtherFake.target_for(self.other_user.obj)
+        follower = Follower.get_or_create(from_=self.other_user, to=self.user)
+        self.assertEqual(other_target, follower.target)
+
+        efake = self.make_user('efake:baz', cls=ExplicitFake)
+        inactive = Follower.get_or_create(from_=self.other_user, to=efake,
+                                          status='inactive')
+
+        self.other_user.obj = self.store_object(id='other:new-profile',
+                                                our_as1={'x': 'y'})
+        Follower.update_targets(self.other_user)
+
+        self.assertEqual('other:new-profile:target', follower.key.get().target)
+        self.assertEqual(other_target, inactive.key.get().target)
+
+    def test_follower_target(self):
+        shared = FollowerTarget.key_for(self.other_user.key, 'fake',
+                                        'fake:shared:target')
+
+        alice = self.make_user('fake:alice', cls=Fake)
+        bob = self.make_user('fake:bob', cls=Fake)
+        Follower.get_or_create(from_=alice, to=self.other_user)
+        bob_follower = Follower.get_or_create(from_=bob, to=self.other_user)
+        target = shared.get()
+        self.assertEqual(('fake', 'fake:shared:target', 2, []),
+                         (target.protocol, target.uri, target.count, target.feed))
+
+        # rewriting without changes doesn't count again
+        Follower.get_or_create(from_=alice, to=self.other_user)
+        self.assertEqual(2, shared.get().count)
+
+        bob_follower.status = 'inactive'
+        bob_follower.put()
+        self.assertEqual(1, shared.get().count)
+
+        # target changed
+        alice_follower = Follower.query(Follower.from_ == alice.key).get()
+        alice_follower.target = 'fake:new:target'
+        alice_follower.put()
+        self.assertIsNone(shared.get())
+        new = FollowerTarget.key_for(self.other_user.key, 'fake', 'fake:new:target')
+        self.assertEqual(1, new.get().count)
+
+        alice_follower.key.delete()
+        self.assertIsNone(new.get())
+
+    def test_follower_target_feed(self):
+        web = Web(id='web.com').key
+        Follower(from_=web, to=self.user.key, target='https://web.com/').put()
+
+        target = FollowerTarget.key_for(self.user.key, 'web', 'https://web.com/')
+        self.assertEqual([web], target.get().feed)
+
+    def test_follower_target_reconcile(self):
+        alice = self.make_user('fake:alice', cls=Fake)
+        Follower.get_or_create(from_=alice, to=self.other_user)
+        bob = self.make_user('fake:bob', cls=Fake)
+        Follower(from_=bob.key, to=self.other_user.key).put()  # no target yet
+        Follower(from_=Fake(id='fake:eve').key, to=self.other_user.key,
+                 target='fake:eve:target', status='inactive').put()
+
+        shared = FollowerTarget.key_for(self.other_user.key, 'fake',
+                                        'fake:shared:target')
+        stale = FollowerTarget.key_for(self.other_user.key, 'fake', 'fake:stale')
+        FollowerTarget(key=stale, protocol='fake', uri='fake:stale', count=3).put()
+        self.assertFalse(FollowerTarget.initialized(self.other_user.key))
+
+        self.assertEqual(1, FollowerTarget.reconcile(self.other_user.key))
+        self.assertTrue(FollowerTarget.initialized(self.other_user.key))
+        self.assertEqual(2, shared.get().count)
+        self.assertIsNone(stale.get())
+        self.assertEqual('fake:shared:target',
+                         Follower.query(Follower.from_ == bob.key).get().target)
+
+    def test_follower_target_new_user_initialized(self):
+        user = Fake.get_or_create('fake:new')
+        self.assertTrue(FollowerTarget.initialized(user.key))
@@ -3,7 +3,7 @@ from datetime import datetime, timedelta
 from threading import Barrier
 import time
 from unittest import skip
-from unittest.mock import patch
+from unittest.mock import DEFAULT, patch
 
 from granary.nostr import (
     id_and_sign,
@@ -54,12 +54,13 @@ class NostrHubTest(TestCase):
         common.RUN_TASKS_INLINE = False
 
         nostr_hub.nostr_pubkeys = set()
-        nostr_hub.nostr_loaded_at = datetime(1900, 1, 1)
         nostr_hub.bridged_pubkeys = set()
-        nostr_hub.bridged_loaded_at = datetime(1900, 1, 1)
+        nostr_hub.pubkeys_loaded_at = nostr_hub.NEVER_LOADED
         nostr_hub.protocol_bot_pubkeys = set()
         nostr_hub.pubkeys_initialized.clear()
         nostr_hub.subscribed_relays = []
+        nostr_hub.relay_live_at = {}
+        nostr_hub.handled_ids.clear()
 
         self.alice = self.make_user(
             'fake:alice', cls=Fake, enabled_protocols=['nostr'],
@@ -105,6 +106,15 @@ class NostrHubTest(TestCase):
         self.assertEqual(set((PUBKEY, EVE_PUBKEY)), nostr_hub.bridged_pubkeys)
         self.assertEqual(set((BOB_PUBKEY, FRANK_PUBKEY)), nostr_hub.nostr_pubkeys)
 
+    def test_init_load_users_removes_disabled(self, _, __):
+        nostr_hub.init(subscribe=False)
+        self.assertEqual(set((PUBKEY,)), nostr_hub.bridged_pubkeys)
+
+        self.alice.disable_protocol(Nostr)
+        nostr_hub.init(subscribe=False)
+        self.assertEqual(set(), nostr_hub.bridged_pubkeys)
+        self.assertEqual(set((BOB_PUBKEY,)), nostr_hub.nostr_pubkeys)
+
     def test_init_subscribe_to_relays(self, _, __):
         self.assertEqual([], FakeConnection.relays)
         nostr_hub.init()
@@ -139,7 +149,7 @@ class NostrHubTest(TestCase):
         self.assertEqual(['wss://b'], FakeConnection.relays)
 
     @patch('nostr_hub.RECONNECT_DELAY', timedelta(seconds=.01))
-    def test_load_new_user_makes_existing_subscribers_reconnect(self, _, __):
+    def test_load_new_user_adds_subscription_without_reconnecting(self, _, __):
         util.now = datetime.now
 
         recving = Barrier(2)
@@ -168,12 +178,81 @@ class NostrHubTest(TestCase):
             recving.wait()
             recving.wait()
 
-        both_req = [
+        eve_req = ['REQ', 'sub123', {'authors': [EVE_PUBKEY]}]
+        self.assertEqual([bob_req, eve_req], FakeConnection.sent)
+        self.assertEqual([Nostr.DEFAULT_TARGET], FakeConnection.relays)
+
+    @patch('nostr_hub.RECONNECT_DELAY', timedelta(seconds=.01))
+    @patch('nostr_hub.MAX_SUBSCRIPTIONS', 1)
+    def test_load_new_user_consolidates_subscriptions(self, _, __):
+        util.now = datetime.now
+
+        recving = Barrier(2)
+        def recv(**kwargs):
+            recving.wait()
+            raise TimeoutError()
+
+        with patch.object(FakeConnection, 'recv', side_effect=recv):
+            nostr_hub.init()
+
+            bob_req = [
+                'REQ', 'sub123',
+                {'#p': [PUBKEY]},
+                {'authors': [BOB_PUBKEY]},
+            ]
+            self.assertEqual([bob_req], FakeConnection.sent)
+
+            relays = Object(id='nostr:neventa', nostr={
+                'kind': KIND_RELAYS,
+                'tags': [['r', Nostr.DEFAULT_TARGET]],
+            }).put()
+            eve = self.make_nostr('eve', EVE_NSEC_URI, EVE_NPUB_URI, relays=relays)
+
+            recving.wait()
+            nostr_hub.init(subscribe=False)
+            recving.wait()
+            recving.wait()
+
+        # already subscribed pubkeys use since, eve's new one doesn't
+        sent = FakeConnection.sent
+        self.assertEqual(4, len(sent), sent)
+        self.assertEqual(['CLOSE', 'sub123'], sent[1])
+        since = sent[2][2]['since']
+        self.assertEqual([
             'REQ', 'sub123',
-            {'#p': [PUBKEY]},
-            {'authors': [EVE_PUBKEY, BOB_PUBKEY]},
-        ]
-        self.assertEqual([bob_req, both_req], FakeConnection.sent)
+            {'#p': [PUBKEY], 'since': since},
+            {'authors': [BOB_PUBKEY], 'since': since},
+        ], sent[2])
+        self.assertEqual(['REQ', 'sub123', {'authors': [EVE_PUBKEY]}], sent[3])
+
+    def test_subscribe_reconnect_uses_since(self, _, __):
+        nostr_hub.init(subscribe=False)
+
+        FakeConnection.to_receive = [['EOSE', 'sub123']]
+        nostr_hub.subscribe('wss://reelaay', limit=1)
+        self.assertEqual({'wss://reelaay': util.now()}, nostr_hub.relay_live_at)
+
+        FakeConnection.to_receive = [['EOSE', 'sub123']]
+        nostr_hub.subscribe('wss://reelaay', limit=1)
+
+        since = int((util.now() - nostr_hub.SINCE_SLACK).timestamp())
+        self.assertEqual([
+            ['REQ', 'sub123', {'#p': [PUBKEY]}, {'authors': [BOB_PUBKEY]}],
+            ['REQ', 'sub123',
+             {'#p': [PUBKEY], 'since': since},
+             {'authors': [BOB_PUBKEY], 'since': since}],
+        ], FakeConnection.sent)
+
+    @patch('nostr_hub.MAX_FILTER_PUBKEYS', 2)
+    @patch('nostr_hub.MAX_REQ_FILTERS', 2)
+    def test_filters_chunked(self, _, __):
+        self.assertEqual([
+            [{'#p': ['a', 'b']}, {'#p': ['c']}],
+            [{'authors': ['d', 'e']}, {'authors': ['f']}],
+        ], nostr_hub._filters(nostr={'f', 'e', 'd'}, bridged={'c', 'b', 'a'}))
+
+        self.assertEqual([[{'authors': ['x'], 'since': 123}]],
+                         nostr_hub._filters(nostr={'x'}, bridged=set(), since=123))
 
     def test_subscribe_reply_to_bridged_user(self, mock_create_task, _):
         event = id_and_sign({
@@ -328,3 +407,122 @@ class NostrHubTest(TestCase):
                          authed_as=BOB_NPUB_URI,
                          nostr=event,
                          eta_seconds=delayed_eta)
+
+    @patch('nostr_hub.verify', wraps=nostr_hub.verify)
+    def test_handle_duplicate_event(self, mock_verify, mock_create_task, _):
+        event = id_and_sign({
+            'pubkey': BOB_PUBKEY,
+            'kind': KIND_NOTE,
+            'content': 'Hello world!',
+            'created_at': NOW_TS,
+        }, privkey=BOB_NSEC_URI)
+
+        nostr_hub.init(subscribe=False)
+        nostr_hub.handle(event)
+        nostr_hub.handle(event)
+
+        mock_verify.assert_called_once_with(event)
+        self.assertEqual(1, mock_create_task.call_count)
+
+    def test_handle_duplicate_event_while_verifying(self, mock_create_task, _):
+        event = id_and_sign({
+            'pubkey': BOB_PUBKEY,
+            'kind': KIND_NOTE,
+            'content': 'Hello world!',
+            'created_at': NOW_TS,
+        }, privkey=BOB_NSEC_URI)
+
+        verify = nostr_hub.verify
+        def verify_and_handle_again(event):
+            # another relay's thread gets the same event while we're verifying
+            nostr_hub.handle(event)
+            return verify(event)
+
+        nostr_hub.init(subscribe=False)
+        with patch('nostr_hub.verify', side_effect=verify_and_handle_again) \
+                as mock_verify:
+            nostr_hub.handle(event)
+
+        mock_verify.assert_called_once_with(event)
+        self.assertEqual(1, mock_create_task.call_count)
+
+    def test_handle_retries_after_enqueue_fails(self, mock_create_task, _):
+        event = id_and_sign({
+            'pubkey': BOB_PUBKEY,
+            'kind': KIND_NOTE,
+            'content': 'Hello world!',
+            'created_at': NOW_TS,
+        }, privkey=BOB_NSEC_URI)
+
+        nostr_hub.init(subscribe=False)
+        mock_create_task.side_effect = [RuntimeError('foo'), DEFAULT]
+        with self.assertRaises(RuntimeError):
+            nostr_hub.handle(event)
+
+        # the same event from another relay
+        nostr_hub.handle(event)
+        self.assertEqual(2, mock_create_task.call_count)
+        self.assert_task(mock_create_task, 'receive',
+                         id=uri_for(event),
+                         source_protocol='nostr',
+                         authed_as=BOB_NPUB_URI,
+                         nostr=event)
+
+    @patch('nostr_hub.verify', wraps=nostr_hub.verify)
+    def test_subscribe_batches_stored_events(self, mock_verify, mock_create_task, _):
+        note = id_and_sign({
+            'pubkey': BOB_PUBKEY,
+            'kind': KIND_NOTE,
+            'content': 'Hello world!',
+            'created_at': NOW_TS,
+        }, privkey=BOB_NSEC_URI)
+        reply = id_and_sign({
+            'pubkey': EVE_PUBKEY,
+            'kind': KIND_NOTE,
+            'content': 'Hello Alice!',
+            'tags': [['p', PUBKEY]],
+            'created_at': NOW_TS,
+        }, privkey=EVE_NSEC_URI)
+
+        with patch('nostr_hub.handle') as mock_handle:
+            self.serve_and_subscribe([note, reply, note])
+            mock_handle.assert_not_called()
+
+        self.assertEqual(2, mock_verify.call_count)
+        self.assertEqual(2, mock_create_task.call_count)
+        self.assert_task(mock_create_task, 'receive',
+                         id=id_to_uri('note', note['id']),
+                         source_protocol='nostr',
+                         authed_as=BOB_NPUB_URI,
+                         nostr=note)
+        self.assert_task(mock_create_task, 'receive',
+                         id=id_to_uri('note', reply['id']),
+                         source_protocol='nostr',
+                         authed_as=EVE_NPUB_URI,
+                         nostr=reply)
+
+        # the same event from another relay, after EOSE
+        nostr_hub.handle(note)
+        self.assertEqual(2, mock_verify.call_count)
+        self.assertEqual(2, mock_create_task.call_count)
+
+    def test_subscribe_batch_retries_after_enqueue_fails(self, mock_create_task, _):
+        note = id_and_sign({
+            'pubkey': BOB_PUBKEY,
+            'kind': KIND_NOTE,
+            'content': 'Hello world!',
+            'created_at': NOW_TS,
+        }, privkey=BOB_NSEC_URI)
+
+        mock_create_task.side_effect = [RuntimeError('foo'), DEFAULT]
+        self.serve_and_subscribe([note])
+        self.assertEqual(1, mock_create_task.call_count)
+
+        # the same event from another relay, after EOSE
+        nostr_hub.handle(note)
+        self.assertEqual(2, mock_create_task.call_count)
+        self.assert_task(mock_create_task, 'receive',
+                         id=id_to_uri('note', note['id']),
+                         source_protocol='nostr',
+                         authed_as=BOB_NPUB_URI,
+                         nostr=note)
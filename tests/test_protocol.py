@@ -2,7 +2,8 @@
 import copy
 from datetime import timedelta
 import logging
-from threading import Condition, Thread
+from threading import Condition, Event, Thread
+import time
 from unittest import skip
 from unittest.mock import ANY, patch
 
@@ -17,7 +18,7 @@ from oauth_dropins.webutil.flask_util import NoContent
 from oauth_dropins.webutil.testutil import NOW, requests_response
 from oauth_dropins.webutil.util import json_dumps
 import requests
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, Gone
 
 # import first so that Fake is defined before URL routes are registered
 from .testutil import ExplicitFake, Fake, OtherFake, TestCase
@@ -29,7 +30,7 @@ import common
 from common import ErrorButDoNotRetryTask
 import memcache
 import models
-from models import DM, Follower, Object, PROTOCOLS, Target, User
+from models import DM, Follower, FollowerTarget, Object, PROTOCOLS, Target, User
 import protocol
 from protocol import Protocol
 from ui import UIProtocol
@@ -159,6 +160,13 @@ class ProtocolTest(TestCase):
         self.assertEqual(Web, Protocol.for_id('http://web.site/'))
         self.assertIn(self.req('http://web.site/'), mock_get.mock_calls)
 
+    @patch('requests.get')
+    def test_for_id_skips_protocol_with_recent_load_failure(self, mock_get):
+        memcache.record_load_failure('http://web.site/', 'activitypub', '404')
+        mock_get.return_value = ACTOR_HTML_RESP
+        self.assertEqual(Web, Protocol.for_id('http://web.site/'))
+        self.assertNotIn(self.as2_req('http://web.site/'), mock_get.mock_calls)
+
     @patch('requests.get')
     def test_for_id_web_fetch_not_html(self, mock_get):
         mock_get.return_value = requests_response('not html', content_type='text/abc')
@@ -438,6 +446,141 @@ class ProtocolTest(TestCase):
             'content': 'a bit of text that makes sure we end up over the limit ',
         }
         self.assertIsNone(Fake.load('fake:foo'))
+        self.assertEqual('too-big', memcache.load_failure('fake:foo', 'fake'))
+
+    @patch('protocol._entity_to_protobuf')
+    def test_load_small_skips_serialize(self, mock_to_pb):
+        Fake.fetchable['fake:foo'] = {'content': 'foo'}
+        self.assertEqual({'id': 'fake:foo', 'content': 'foo'},
+                         Fake.load('fake:foo').our_as1)
+        mock_to_pb.assert_not_called()
+
+    def test_load_remembers_failure(self):
+        self.assertIsNone(Fake.load('fake:foo', raise_=False))
+        self.assertEqual(['fake:foo'], Fake.fetched)
+        self.assertEqual('empty', memcache.load_failure('fake:foo', 'fake'))
+
+        # shouldn't refetch
+        Fake.fetchable['fake:foo'] = {'content': 'foo'}
+        self.assertIsNone(Fake.load('fake:foo', raise_=False))
+        self.assertEqual(['fake:foo'], Fake.fetched)
+
+        # remote=True forces a fetch, which clears the failure
+        self.assertEqual({'id': 'fake:foo', 'content': 'foo'},
+                         Fake.load('fake:foo', remote=True).our_as1)
+        self.assertEqual(['fake:foo', 'fake:foo'], Fake.fetched)
+        self.assertIsNone(memcache.load_failure('fake:foo', 'fake'))
+
+    @patch('requests.get', return_value=requests_response(status=410))
+    def test_load_remembers_gone(self, mock_get):
+        with self.assertRaises(requests.HTTPError):
+            Web.load('https://user.com/post')
+
+        self.assertEqual('410', memcache.load_failure('https://user.com/post', 'web'))
+        fetches = mock_get.call_count
+
+        # don't refetch, raise the same failure instead
+        with self.assertRaises(Gone):
+            Web.load('https://user.com/post')
+        self.assertIsNone(Web.load('https://user.com/post', raise_=False))
+        self.assertEqual(fetches, mock_get.call_count)
+
+        # failures are per protocol
+        self.assertIsNone(memcache.load_failure('https://user.com/post', 'fake'))
+
+    def test_get_by_id_cached(self):
+        self.store_object(id='fake:foo', our_as1={'content': 'foo'})
+        self.assertNotIn('fake:foo', models.object_local_cache)
+
+        first = Object.get_by_id_cached('fake:foo')
+        self.assertIn('fake:foo', models.object_local_cache)
+
+        # miss the ndb context cache
+        ndb.context.get_context().cache.clear()
+        with patch.object(Object, 'get_by_id', wraps=Object.get_by_id) as get:
+            second = Object.get_by_id_cached('fake:foo')
+            get.assert_not_called()
+
+        self.assertIsNot(first, second)
+        self.assertEqual(first.our_as1, second.our_as1)
+        # cache hits are read only snapshots, not added to the context cache
+        self.assertIsNot(second, Object.get_by_id('fake:foo'))
+
+        # puts and memcache.evict clear it
+        first.put()
+        self.assertNotIn('fake:foo', models.object_local_cache)
+
+        Object.get_by_id_cached('fake:foo')
+        memcache.evict(first.key)
+        self.assertNotIn('fake:foo', models.object_local_cache)
+
+    def test_load_only_uses_local_cache_if_cached(self):
+        self.store_object(id='fake:foo', our_as1={'content': 'foo'})
+        Object.get_by_id_cached('fake:foo')
+
+        # simulate a put in another process, which doesn't evict our local cache
+        with models.object_local_cache_lock:
+            stale = models.object_local_cache['fake:foo']
+        Object(id='fake:foo', our_as1={'content': 'bar'}).put()
+        with models.object_local_cache_lock:
+            models.object_local_cache['fake:foo'] = stale
+        ndb.context.get_context().cache.clear()
+
+        self.assertEqual('foo', Fake.load('fake:foo', cached=True).as1['content'])
+        self.assertEqual('bar', Fake.load('fake:foo').as1['content'])
+
+    def test_load_cached_refetch_reloads_from_datastore(self):
+        self.store_object(id='fake:foo', our_as1={'content': 'foo'})
+        Object.get_by_id_cached('fake:foo')
+
+        with models.object_local_cache_lock:
+            stale = models.object_local_cache['fake:foo']
+        Object(id='fake:foo', our_as1={'content': 'bar'}, source_protocol='fake',
+               copies=[Target(protocol='other', uri='other:foo')]).put()
+        with models.object_local_cache_lock:
+            models.object_local_cache['fake:foo'] = stale
+        ndb.context.get_context().cache.clear()
+
+        Fake.fetchable['fake:foo'] = {'content': 'baz'}
+        loaded = Fake.load('fake:foo', remote=True, cached=True)
+        self.assertEqual('baz', loaded.as1['content'])
+        # the put didn't clobber fields from the newer stored copy
+        self.assertEqual([Target(protocol='other', uri='other:foo')],
+                         Object.get_by_id('fake:foo').copies)
+
+    def test_load_multi(self):
+        self.store_object(id='fake:stored', our_as1={'content': 'stored'})
+        Fake.fetchable['fake:new'] = {'content': 'new'}
+        OtherFake.fetchable['other:new'] = {'content': 'other'}
+
+        loaded = Protocol.load_multi({
+            'fake:stored': Fake,
+            'fake:new': Fake,
+            'fake:missing': Fake,
+            'other:new': OtherFake,
+        })
+        self.assertEqual(['fake:stored', 'fake:new', 'fake:missing', 'other:new'],
+                         list(loaded))
+        self.assertEqual('stored', loaded['fake:stored'].as1['content'])
+        self.assertEqual('new', loaded['fake:new'].as1['content'])
+        self.assertEqual('other', loaded['other:new'].as1['content'])
+        self.assertIsNone(loaded['fake:missing'])
+
+        self.assertEqual(['fake:new', 'fake:missing'], Fake.fetched)
+        self.assertEqual(['other:new'], OtherFake.fetched)
+        self.assertIsNotNone(Object.get_by_id('fake:new'))
+
+    def test_load_multi_deadline(self):
+        done = Event()
+        with patch.object(Fake, 'fetch',
+                          side_effect=lambda *_, **__: done.wait() and False):
+            loaded = Protocol.load_multi({'fake:slow': Fake},
+                                         deadline=time.monotonic())
+            done.set()
+            # wait for the abandoned fetch to finish
+            protocol.load_executor.submit(lambda: None).result()
+
+        self.assertEqual({'fake:slow': None}, loaded)
 
     def test_actor_key(self):
         user = self.make_user(id='fake:a', cls=Fake)
@@ -530,6 +673,39 @@ class ProtocolTest(TestCase):
             Target(protocol='other', uri='other:orig:target'),
         }, Fake.targets(obj, from_user=self.user).keys())
 
+    def test_targets_followers_use_stored_delivery_targets(self):
+        user = self.make_user('fake:user', cls=Fake)
+        alice = self.make_user('other:alice', cls=OtherFake, obj_id='other:alice')
+        Follower.get_or_create(to=user, from_=alice)
+
+        # no stored target yet
+        bob = self.make_user('other:bob', cls=OtherFake, obj_id='other:bob')
+        bob_follow = Follower(to=user.key, from_=bob.key)
+        bob_follow.put()
+        self.assertIsNone(bob_follow.target)
+
+        # shouldn't need to load alice's user or profile
+        alice.key.delete()
+
+        post = Object(id='fake:post', our_as1={
+            'id': 'fake:post',
+            'objectType': 'note',
+            'author': 'fake:user',
+        })
+        create = Object(id='fake:create', our_as1={
+            'objectType': 'activity',
+            'verb': 'post',
+            'actor': 'fake:user',
+            'object': post.as1,
+        })
+        targets = Fake.targets(create, from_user=user, crud_obj=post)
+        self.assertLessEqual({
+            Target(protocol='other', uri='other:alice:target'),
+            Target(protocol='other', uri='other:bob:target'),
+        }, targets.keys())
+
+        self.assertEqual('other:bob:target', bob_follow.key.get().target)
+
     def test_targets_composite_inreplyto(self):
         Fake.fetchable['fake:post'] = {
             'objectType': 'note',
@@ -1149,6 +1325,144 @@ class ProtocolReceiveTest(TestCase):
             ('other:bob:target', create_as1),
         ], OtherFake.sent)
 
+    @patch('protocol.FANOUT_PAGE_SIZE', new=1)
+    def test_create_post_fanout(self):
+        self.user.enabled_protocols = ['efake']
+        self.user.put()
+
+        self.make_followers()
+
+        eve = self.make_user('efake:eve', cls=ExplicitFake, obj_id='efake:eve')
+        frank = self.make_user('efake:frank', cls=ExplicitFake, obj_id='efake:frank')
+        Follower.get_or_create(to=self.user, from_=eve)
+        Follower.get_or_create(to=self.user, from_=frank)
+
+        post_as1 = {
+            'id': 'fake:post',
+            'objectType': 'note',
+            'content': 'foo',
+        }
+        create_as1 = {
+            'id': 'fake:create',
+            'objectType': 'activity',
+            'verb': 'post',
+            'actor': 'fake:user',
+            'object': post_as1,
+        }
+        self.assertEqual(('OK', 202), Fake.receive_as1(create_as1))
+
+        self.assertCountEqual([
+            ('other:alice:target', create_as1),
+            ('other:bob:target', create_as1),
+        ], OtherFake.sent)
+
+        # eve and frank share a target, so only deliver to it once
+        self.assertEqual(1, [target for target, _ in ExplicitFake.sent]
+                            .count('efake:shared:target'))
+        self.assertCountEqual([eve.key, frank.key],
+                              Object.get_by_id('fake:post').feed)
+
+    @patch('protocol.FANOUT_PAGE_SIZE', new=1)
+    def test_create_post_fanout_follower_targets(self):
+        self.user.enabled_protocols = ['efake']
+        self.user.put()
+
+        self.make_followers()
+        eve = self.make_user('efake:eve', cls=ExplicitFake, obj_id='efake:eve')
+        frank = self.make_user('efake:frank', cls=ExplicitFake, obj_id='efake:frank')
+        Follower.get_or_create(to=self.user, from_=eve)
+        Follower.get_or_create(to=self.user, from_=frank)
+        FollowerTarget.reconcile(self.user.key)
+
+        create_as1 = {
+            'id': 'fake:create',
+            'objectType': 'activity',
+            'verb': 'post',
+            'actor': 'fake:user',
+            'object': {
+                'id': 'fake:post',
+                'objectType': 'note',
+                'content': 'foo',
+            },
+        }
+        with patch.object(Protocol, 'load_followers') as load_followers:
+            self.assertEqual(('OK', 202), Fake.receive_as1(create_as1))
+            load_followers.assert_not_called()
+
+        # one page per target. eve and frank share a target, so only deliver to
+        # it once
+        self.assertCountEqual(['other:alice:target', 'other:bob:target'],
+                              [target for target, _ in OtherFake.sent])
+        self.assertEqual(['efake:shared:target'],
+                         [target for target, _ in ExplicitFake.sent])
+        self.assertCountEqual([eve.key, frank.key],
+                              Object.get_by_id('fake:post').feed)
+
+    @patch('protocol.FANOUT_PAGE_SIZE', new=1)
+    def test_create_post_fanout_skips_blocklisted_target(self):
+        self.make_followers()
+        blocked = self.make_user('other:blocklisted', cls=OtherFake)
+        Follower.get_or_create(to=self.user, from_=blocked)
+
+        create_as1 = {
+            'id': 'fake:create',
+            'objectType': 'activity',
+            'verb': 'post',
+            'actor': 'fake:user',
+            'object': {
+                'id': 'fake:post',
+                'objectType': 'note',
+                'content': 'foo',
+            },
+        }
+        self.assertEqual(('OK', 202), Fake.receive_as1(create_as1))
+        self.assertCountEqual(['other:alice:target', 'other:bob:target'],
+                              [target for target, _ in OtherFake.sent])
+
+    @patch('protocol.FANOUT_PAGE_SIZE', new=1)
+    def test_fanout_task_retry_after_send_task_fails(self):
+        self.user.enabled_protocols = ['efake']
+        self.user.put()
+
+        eve = self.make_user('efake:eve', cls=ExplicitFake, obj_id='efake:eve')
+        frank = self.make_user('efake:frank', cls=ExplicitFake, obj_id='efake:frank')
+        Follower.get_or_create(to=self.user, from_=eve)
+        Follower.get_or_create(to=self.user, from_=frank)
+
+        self.store_object(id='fake:post', source_protocol='fake', our_as1={
+            'id': 'fake:post',
+            'objectType': 'note',
+            'author': 'fake:user',
+        })
+
+        # the fanout task for the second page
+        _, cursor = Protocol.load_followers(self.user.key, [ExplicitFake])
+        params = {
+            'followee': self.user.key.urlsafe(),
+            'cursor': cursor.urlsafe(),
+            'protocols': 'efake',
+            'fanout_id': 'fake:post',
+            'obj_id': 'fake:post',
+            'user': self.user.key.urlsafe(),
+        }
+
+        create_task = common.create_task
+        def fail_send(queue, **kwargs):
+            if queue == 'send':
+                raise RuntimeError('foo')
+            return create_task(queue, **kwargs)
+
+        with patch('common.create_task', side_effect=fail_send):
+            resp = self.post('/queue/fanout', data=params)
+        self.assertEqual(500, resp.status_code)
+        self.assertEqual([], ExplicitFake.sent)
+
+        # Cloud Tasks retries the fanout task
+        resp = self.post('/queue/fanout', data=params)
+        self.assertEqual(202, resp.status_code)
+        self.assertEqual(['efake:shared:target'],
+                         [target for target, _ in ExplicitFake.sent])
+
     def test_create_post_object_missing_id(self):
         self.make_followers()
 
@@ -2437,7 +2751,7 @@ class ProtocolReceiveTest(TestCase):
         self.assertEqual([], Fake.sent)
 
     def test_delete_actor(self):
-        self.alice.obj.copies = [Target(protocol='fake', uri='fa:profile:other:alice')]
+        self.alice.obj.add('copies', Target(protocol='fake', uri='fa:profile:other:alice'))
         self.alice.obj.put()
 
         follower = Follower.get_or_create(to=self.user, from_=self.alice)
@@ -2947,7 +3261,7 @@ class ProtocolReceiveTest(TestCase):
         (It's probably from a bridged user, and we only want to handle source
         activities, not bridged activities.)
         """
-        self.user.copies = [Target(uri='other:user', protocol='other')]
+        self.user.add('copies', Target(uri='other:user', protocol='other'))
         self.user.put()
 
         with self.assertRaises(NoContent):
@@ -3014,7 +3328,7 @@ class ProtocolReceiveTest(TestCase):
         self.assert_equals(follow, obj.our_as1)
 
         # matching copy user
-        self.alice.copies = [Target(uri='fake:alice', protocol='fake')]
+        self.alice.add('copies', Target(uri='fake:alice', protocol='fake'))
         self.alice.put()
 
         models.get_original_user_key.cache_clear()
@@ -3829,6 +4143,34 @@ class ProtocolReceiveTest(TestCase):
         self.assertEqual([], OtherFake.sent)
         self.assertEqual([], Fake.sent)
 
+    @patch.object(OtherFake, 'SEND_BATCH_SIZE', 100)
+    @patch('oauth_dropins.webutil.appengine_config.tasks_client.create_task')
+    def test_create_post_send_tasks_batched(self, mock_create_task):
+        common.RUN_TASKS_INLINE = False
+        self.make_followers()
+
+        note_as1 = {
+            'id': 'fake:post',
+            'objectType': 'note',
+            'author': 'fake:user',
+            'content': 'foo',
+        }
+        self.assertEqual(('OK', 202), Fake.receive_as1(note_as1))
+
+        self.assertEqual(1, mock_create_task.call_count)
+        self.assert_task(mock_create_task, 'send', source_protocol='fake',
+                         protocol='other', id='fake:post#bridgy-fed-create',
+                         our_as1={
+                             'id': 'fake:post#bridgy-fed-create',
+                             'objectType': 'activity',
+                             'verb': 'post',
+                             'actor': 'fake:user',
+                             'object': note_as1,
+                             'published': '2022-01-02T03:04:05+00:00',
+                         },
+                         urls='other:alice:target other:bob:target',
+                         user=self.user.key.urlsafe())
+
     @patch('oauth_dropins.webutil.appengine_config.tasks_client.create_task')
     def test_reply_send_tasks_orig_obj(self, mock_create_task):
         common.RUN_TASKS_INLINE = False
@@ -3897,6 +4239,119 @@ class ProtocolReceiveTest(TestCase):
         }, headers={'X-AppEngine-TaskRetryCount': '0'})
         self.assertEqual(200, resp.status_code)
 
+    def test_send_task_handler_urls(self):
+        self.store_object(id='fake:post', our_as1={
+            'id': 'fake:post',
+            'objectType': 'note',
+            'author': 'fake:user',
+        })
+        resp = self.post('/queue/send', data={
+            'protocol': 'fake',
+            'obj_id': 'fake:post',
+            'urls': 'fake:a:target fake:b:target',
+            'user': self.user.key.urlsafe(),
+        })
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(['fake:a:target', 'fake:b:target'],
+                         [target for target, _ in Fake.sent])
+
+    @patch.object(Fake, 'send', return_value=False)
+    def test_send_task_handler_urls_all_false_returns_204(self, _):
+        self.store_object(id='fake:post', our_as1={'objectType': 'note'})
+        resp = self.post('/queue/send', data={
+            'protocol': 'fake',
+            'obj_id': 'fake:post',
+            'urls': 'fake:a:target fake:b:target',
+            'user': self.user.key.urlsafe(),
+        })
+        self.assertEqual(204, resp.status_code)
+
+    @patch('oauth_dropins.webutil.appengine_config.tasks_client.create_task')
+    def test_send_task_handler_urls_retries_failed(self, mock_create_task):
+        common.RUN_TASKS_INLINE = False
+        self.store_object(id='fake:post', our_as1={'objectType': 'note'})
+
+        def send(obj, url, **kwargs):
+            if url == 'fake:b:target':
+                raise BadRequest('nope')
+            return url == 'fake:a:target'
+
+        with patch.object(Fake, 'send', side_effect=send):
+            resp = self.post('/queue/send', data={
+                'protocol': 'fake',
+                'obj_id': 'fake:post',
+                'urls': 'fake:a:target fake:b:target fake:c:target',
+                'user': self.user.key.urlsafe(),
+            })
+        self.assertEqual(200, resp.status_code)
+        self.assert_task(mock_create_task, 'send', protocol='fake',
+                         obj_id='fake:post', url='fake:b:target',
+                         user=self.user.key.urlsafe())
+
+    @patch('oauth_dropins.webutil.appengine_config.tasks_client.create_task')
+    def test_send_task_handler_urls_retries_only_failed_on_other_error(
+            self, mock_create_task):
+        common.RUN_TASKS_INLINE = False
+        self.store_object(id='fake:post', our_as1={'objectType': 'note'})
+
+        def send(obj, url, **kwargs):
+            if url == 'fake:b:target':
+                raise RuntimeError('nope')
+            return True
+
+        with patch.object(Fake, 'send', side_effect=send) as mock_send:
+            resp = self.post('/queue/send', data={
+                'protocol': 'fake',
+                'obj_id': 'fake:post',
+                'urls': 'fake:a:target fake:b:target fake:c:target',
+                'user': self.user.key.urlsafe(),
+            })
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(3, mock_send.call_count)
+        self.assert_task(mock_create_task, 'send', protocol='fake',
+                         obj_id='fake:post', url='fake:b:target',
+                         user=self.user.key.urlsafe())
+
+    @patch('oauth_dropins.webutil.appengine_config.tasks_client.create_task')
+    @patch.object(Fake, 'send', side_effect=BadRequest('nope'))
+    def test_send_task_handler_urls_all_failed_returns_error(
+            self, _, mock_create_task):
+        self.store_object(id='fake:post', our_as1={'objectType': 'note'})
+        resp = self.post('/queue/send', data={
+            'protocol': 'fake',
+            'obj_id': 'fake:post',
+            'urls': 'fake:a:target fake:b:target',
+            'user': self.user.key.urlsafe(),
+        })
+        self.assertEqual(304, resp.status_code)
+        mock_create_task.assert_not_called()
+
+    @patch('oauth_dropins.webutil.appengine_config.tasks_client.create_task')
+    def test_send_task_defers_down_host(self, mock_create_task):
+        common.RUN_TASKS_INLINE = False
+        for _ in range(memcache.HOST_FAILURES_BEFORE_BACKOFF):
+            memcache.record_host_request('a.com', ok=False)
+
+        self.store_object(id='fake:post', our_as1={
+            'id': 'fake:post',
+            'objectType': 'note',
+            'author': 'fake:user',
+        })
+        resp = self.post('/queue/send', data={
+            'protocol': 'fake',
+            'obj_id': 'fake:post',
+            'urls': 'https://a.com/inbox fake:b:target',
+            'user': self.user.key.urlsafe(),
+        })
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(['fake:b:target'], [target for target, _ in Fake.sent])
+
+        eta = util.to_utc_timestamp(NOW) + memcache.HOST_BACKOFF_MIN.total_seconds()
+        self.assert_task(mock_create_task, 'send', protocol='fake',
+                         obj_id='fake:post', url='https://a.com/inbox',
+                         user=self.user.key.urlsafe(), deferrals='1',
+                         eta_seconds=eta)
+
     def test_send_task_missing_url(self):
         obj = self.store_object(id='fake:post')
         resp = self.post('/queue/send', data={
@@ -26,6 +26,7 @@ import common
 from common import CONTENT_TYPE_HTML, TASKS_LOCATION
 from flask_app import app
 import ids
+import memcache
 from models import Follower, Object, Target
 import web
 from web import OWNS_WEBFINGER, Web
@@ -1650,7 +1651,7 @@ class WebTest(TestCase):
         self.make_followers()
 
         self.user.enabled_protocols = ['efake']
-        self.user.copies = [Target(protocol='efake', uri='efake:user')]
+        self.user.add('copies', Target(protocol='efake', uri='efake:user'))
         self.user.put()
 
         got = self.post('/queue/webmention', data={
@@ -3424,6 +3425,26 @@ class WebUtilTest(TestCase):
                     'target': 'https://user.com/post',
                 }, kwargs['data'])
 
+    def test_send_records_endpoint_host_health(self, mock_get, mock_post):
+        mock_get.return_value = requests_response(
+            '<html><head><link rel="webmention" href="https://wm.io/endpoint"></html>')
+        mock_post.side_effect = requests.ConnectionError()
+
+        obj = Object(id='http://mas.to/like#ok', as2=test_activitypub.LIKE,
+                     source_protocol='ui')
+        with self.assertRaises(requests.ConnectionError):
+            Web.send(obj, 'https://user.com/post')
+
+        # the endpoint's host failed, not the target's
+        health = memcache.pickle_memcache.get(memcache.key('host-health-wm.io'))
+        self.assertEqual(1, health['failures'])
+        self.assertIsNone(memcache.pickle_memcache.get(
+            memcache.key('host-health-user.com')))
+
+        # send_task checks the endpoint's host
+        self.assertEqual('wm.io', Web.send_host('https://user.com/post'))
+        self.assertEqual('other.com', Web.send_host('https://other.com/post'))
+
     def test_convert(self, mock_get, __):
         mock_get.return_value = ACTOR_HTML_RESP
 
@@ -1,4 +1,5 @@
 """Common test utility code."""
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
 import copy
 from datetime import datetime, timezone
@@ -42,7 +43,7 @@ import requests
 from common import GCP_PROJECT_ID, long_to_base64, NDB_CONTEXT_KWARGS, TASKS_LOCATION
 import ids
 import models
-from models import KEY_BITS, Object, PROTOCOLS, Target, User
+from models import CopyIndex, KEY_BITS, Object, PROTOCOLS, Target, User
 import nostr
 import nostr_hub
 import protocol
@@ -300,6 +301,10 @@ from web import Web
 for proto in (ActivityPub, ATProto, Nostr, Web):
     proto.DEFAULT_ENABLED_PROTOCOLS += ('fake', 'other')
 
+# serial, so that blob fetch order is deterministic
+atproto.blob_executor = ThreadPoolExecutor(max_workers=1)
+protocol.load_executor = ThreadPoolExecutor(max_workers=1)
+
 # used in TestCase.make_user() to reuse keys across Users since they're
 # expensive to generate.
 requests.post(f'http://{ndb_client.host}/reset')
@@ -317,6 +322,13 @@ class TestCase(unittest.TestCase, testutil.Asserts):
         appengine_info.APP_ID = 'my-app'
         appengine_info.LOCAL_SERVER = False
         common.RUN_TASKS_INLINE = True
+        # serial, so that fan out delivery order is deterministic
+        activitypub.SEND_BATCH_WORKERS = 1
+        activitypub._signature_auth.cache.clear()
+        activitypub.public_keys.clear()
+        # go through the requests module functions so that tests can mock them
+        activitypub.delivery_client = activitypub.DeliveryClient(
+            new_session=lambda: requests)
         app.testing = True
 
         memcache.client_pool.clear()
@@ -324,6 +336,9 @@ class TestCase(unittest.TestCase, testutil.Asserts):
         global_cache.clear()
 
         models.get_original_object_key.cache_clear()
+        models.object_local_cache.clear()
+        models.nostr_pubkey_synced.clear()
+        models.did_changes_synced.clear()
         models.get_original_user_key.cache_clear()
         did.resolve_handle.cache.clear()
         did.resolve_plc.cache.clear()
@@ -331,7 +346,6 @@ class TestCase(unittest.TestCase, testutil.Asserts):
         ids.web_ap_base_domain.cache.clear()
         protocol.Protocol.for_id.cache.clear()
         protocol.Protocol.for_handle.cache.clear()
-        User.count_followers.cache.clear()
         common.protocol_user_copy_ids.cache_clear()
 
         for cls in ExplicitFake, Fake, OtherFake:
@@ -472,6 +486,8 @@ class TestCase(unittest.TestCase, testutil.Asserts):
                 source_protocol=cls.LABEL).key
 
         user.put()
+        # the app adds copies with User.add, which indexes them
+        CopyIndex.update_for(user)
         return user
 
     def add_objects(self):
@@ -517,6 +533,8 @@ class TestCase(unittest.TestCase, testutil.Asserts):
     def store_object(**kwargs):
         obj = Object(**kwargs)
         obj.put()
+        # the app adds copies with Object.add, which indexes them
+        CopyIndex.update_for(obj)
         return obj
 
     @staticmethod
@@ -4,6 +4,7 @@ import difflib
 import logging
 import re
 import statistics
+import time
 import urllib.parse
 from urllib.parse import quote, urlencode, urljoin, urlparse
 from xml.etree import ElementTree
@@ -20,6 +21,7 @@ from oauth_dropins.webutil import appengine_info
 from oauth_dropins.webutil.flask_util import cloud_tasks_only, error, flash
 from oauth_dropins.webutil.util import domain_from_link, json_dumps, json_loads
 from oauth_dropins.webutil import webmention
+import requests
 from requests import HTTPError, RequestException
 from requests.auth import HTTPBasicAuth
 from werkzeug.exceptions import BadGateway, BadRequest, HTTPException, NotFound
@@ -502,13 +504,48 @@ class Web(User, Protocol):
         # we only send webmentions for responses. for sending normal posts etc
         # to followers, we just update our stored objects (elsewhere) and web
         # users consume them via feeds.
-        endpoint = webmention_discover(target).endpoint
+        #
+        # discovery requests go to the target's host, but the webmention
+        # itself goes to the endpoint's, which is often different, eg
+        # webmention.io, so record their health separately. send_task checks
+        # the endpoint's host via send_host.
+        host = domain_from_link(target, minimize=False)
+        try:
+            endpoint = webmention_discover(target).endpoint
+        except BaseException as e:
+            if _host_failed(e):
+                memcache.record_host_request(host, ok=False)
+            raise
+
         if not endpoint:
+            memcache.record_host_request(host, ok=True)
             return False
 
-        webmention.send(endpoint, source_url, target)
+        host = domain_from_link(endpoint, minimize=False)
+        start = time.perf_counter()
+        try:
+            webmention.send(endpoint, source_url, target)
+        except BaseException as e:
+            if _host_failed(e):
+                memcache.record_host_request(host, ok=False)
+            raise
+
+        memcache.record_host_request(host, ok=True,
+                                     latency=time.perf_counter() - start)
         return True
 
+    @classmethod
+    def send_host(cls, target):
+        """Returns the host of the target's webmention endpoint, if we know it.
+
+        Only uses a cached discovery, never fetches. Otherwise falls back to
+        the target's host.
+        """
+        discovered = webmention_discover.peek(target)
+        if discovered and discovered.endpoint:
+            return domain_from_link(discovered.endpoint, minimize=False)
+        return super().send_host(target)
+
     @classmethod
     def load(cls, id, **kwargs):
         """Wrap :meth:`Protocol.load` to convert domains to homepage URLs."""
@@ -1021,6 +1058,7 @@ def webmention_task():
                 field = ('actor' if obj.our_as1.get('objectType') == 'activity'
                          else 'author')
                 obj.our_as1[field] = user.web_url()
+            obj.clear_as1_cache()
 
     try:
         return Web.receive(obj, authed_as=user.key.id(), internal=internal)
@@ -1052,7 +1090,22 @@ def webmention_endpoint_cache_key(url):
     return key
 
 
-@memcache.memoize(expire=timedelta(hours=2), key=webmention_endpoint_cache_key)
+def _host_failed(e):
+    """Returns True if an exception means the host we requested is unhealthy.
+
+    Args:
+      e (BaseException)
+
+    Returns:
+      bool: True for connection errors, timeouts, and HTTP 5xx
+    """
+    code, _ = util.interpret_http_exception(e)
+    return (isinstance(e, (requests.ConnectionError, requests.Timeout))
+            or bool(code and int(code) // 100 == 5))
+
+
+@memcache.memoize(expire=timedelta(hours=2), key=webmention_endpoint_cache_key,
+                  local_size=5000, local_ttl=timedelta(minutes=10))
 def webmention_discover(url, **kwargs):
     """Thin cache around :func:`oauth_dropins.webutil.webmention.discover`."""
     # discard the response since we don't use it and it's occasionally too big for